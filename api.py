@@ -0,0 +1,245 @@
+"""Read-only JSON API for books and authors, under ``/api/v1``.
+
+Lists and searches use the same queries and keyset cursors as the HTML
+listing. ``?fields=`` picks the fields to return; only their columns are
+loaded, so the synopsis and biography are read only when asked for.
+Responses are compact JSON and go through the same conditional GET and page
+cache support as the pages (see row_versions.py and page_cache.py).
+
+    GET /api/v1/books?q=&sort=&limit=&after=&before=&fields=
+        sort: title, author, rating, published, added or relevance; a "-"
+        prefix reverses it (e.g. -rating for the best rated first)
+    GET /api/v1/books/<id>?fields=
+    GET /api/v1/authors?q=&limit=&after=&before=&fields=
+    GET /api/v1/authors/<id>?fields=
+"""
+
+import json
+from datetime import date, datetime
+from urllib.parse import urljoin
+
+from flask import Blueprint, current_app, request
+from werkzeug.exceptions import HTTPException
+
+import page_cache
+import row_versions
+from covers import cover_src
+from data_models import db, Author, Book
+from helpers import _book_query_and_keys, _keyset_page
+from page_cache import add_cache_tags, cached_page
+from row_versions import conditional_page
+
+DEFAULT_CONFIG = {
+    "API_PAGE_SIZE": 50,
+    "API_MAX_PAGE_SIZE": 500,
+}
+
+bp = Blueprint("api_v1", __name__, url_prefix="/api/v1")
+
+
+def _cover(book):
+    src = cover_src(book, "thumb")
+    return urljoin(request.host_url, src) if src else None
+
+
+# Field name: (model attributes to load, value getter).
+BOOK_FIELDS = {
+    "id": ((Book.id,), lambda book: book.id),
+    "isbn": ((Book.isbn,), lambda book: book.isbn),
+    "title": ((Book.title,), lambda book: book.title),
+    "publication_date": (
+        (Book.publication_date,),
+        lambda book: book.publication_date,
+    ),
+    "rating": ((Book.rating,), lambda book: book.rating),
+    # The local thumbnail if one is stored, else the remote cover.
+    "cover": ((Book.cover_url, Book.cover_file), _cover),
+    "synopsis": ((Book.synopsis,), lambda book: book.synopsis),
+    "author_id": ((Book.author_id,), lambda book: book.author_id),
+    "author": ((Book.author_id,), lambda book: book.author.name),
+    "updated_at": ((Book.updated_at,), lambda book: book.updated_at),
+}
+DEFAULT_BOOK_FIELDS = [name for name in BOOK_FIELDS if name != "synopsis"]
+
+
+def _author_stat(name):
+    def get(author):
+        stats = author.stats
+        if stats is None:
+            return 0 if name.endswith("_count") else None
+        return getattr(stats, name)
+
+    return get
+
+
+AUTHOR_FIELDS = {
+    "id": ((Author.id,), lambda author: author.id),
+    "name": ((Author.name,), lambda author: author.name),
+    "birth_date": ((Author.birth_date,), lambda author: author.birth_date),
+    "death_date": ((Author.death_date,), lambda author: author.death_date),
+    "bio": ((Author.bio,), lambda author: author.bio),
+    "updated_at": ((Author.updated_at,), lambda author: author.updated_at),
+    # Aggregates over the author's books (see author_stats.py).
+    "book_count": ((), _author_stat("book_count")),
+    "rated_count": ((), _author_stat("rated_count")),
+    "average_rating": ((), _author_stat("average_rating")),
+    "latest_publication": ((), _author_stat("latest_publication")),
+}
+AUTHOR_STATS_FIELDS = {
+    "book_count",
+    "rated_count",
+    "average_rating",
+    "latest_publication",
+}
+DEFAULT_AUTHOR_FIELDS = [name for name in AUTHOR_FIELDS if name != "bio"]
+
+
+class BadRequest(ValueError):
+    """An invalid query parameter; answered with a 400 JSON error."""
+
+
+def _parse_fields(available, default):
+    value = request.args.get("fields", "")
+    if not value.strip():
+        return default
+    fields = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = [name for name in fields if name not in available]
+    if unknown:
+        raise BadRequest(
+            f"Unknown fields: {', '.join(unknown)}. "
+            f"Available: {', '.join(available)}."
+        )
+    return list(dict.fromkeys(["id"] + fields))
+
+
+def _load_only(available, fields, *always):
+    attributes = {attribute for name in fields for attribute in available[name][0]}
+    return db.load_only(*attributes, *always, raiseload=True)
+
+
+def _book_options(fields):
+    # The listing query always joins the author; only its name is read.
+    return [
+        _load_only(BOOK_FIELDS, fields, Book.author_id),
+        db.joinedload(Book.author).load_only(Author.name),
+    ]
+
+
+def _author_options(fields):
+    options = [_load_only(AUTHOR_FIELDS, fields)]
+    if AUTHOR_STATS_FIELDS.intersection(fields):
+        options.append(db.joinedload(Author.stats))
+    return options
+
+
+def _page_size():
+    limit = request.args.get("limit", current_app.config["API_PAGE_SIZE"], type=int)
+    return max(1, min(limit, current_app.config["API_MAX_PAGE_SIZE"]))
+
+
+def _serialize(obj, available, fields):
+    return {name: available[name][1](obj) for name in fields}
+
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def json_response(payload, status=200):
+    """Return ``payload`` as compact JSON."""
+    return current_app.response_class(
+        json.dumps(
+            payload, separators=(",", ":"), ensure_ascii=False, default=_json_default
+        ),
+        status=status,
+        mimetype="application/json",
+    )
+
+
+def _page_payload(items, next_cursor, prev_cursor):
+    return {"data": items, "next": next_cursor, "prev": prev_cursor}
+
+
+# --- Views ---
+
+
+@bp.route("/books")
+@conditional_page(row_versions.library_version)
+@cached_page(page_cache.LISTING_TAG)
+def list_books():
+    """List or search books, one keyset page at a time."""
+    fields = _parse_fields(BOOK_FIELDS, DEFAULT_BOOK_FIELDS)
+    search_query = request.args.get("q", "").strip()
+    sort_by = request.args.get("sort") or ("relevance" if search_query else "title")
+
+    query, sort_keys = _book_query_and_keys(sort_by, search_query)
+    books, next_cursor, prev_cursor = _keyset_page(
+        query.options(*_book_options(fields)),
+        sort_keys,
+        _page_size(),
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+    )
+    items = [_serialize(book, BOOK_FIELDS, fields) for book in books]
+    return json_response(_page_payload(items, next_cursor, prev_cursor))
+
+
+@bp.route("/books/<int:book_id>")
+@conditional_page(row_versions.book_version)
+@cached_page("book:{book_id}")
+def get_book(book_id):
+    """Return one book."""
+    fields = _parse_fields(BOOK_FIELDS, DEFAULT_BOOK_FIELDS)
+    book = Book.query.options(*_book_options(fields)).get_or_404(book_id)
+    add_cache_tags(f"author:{book.author_id}")
+    return json_response(_serialize(book, BOOK_FIELDS, fields))
+
+
+@bp.route("/authors")
+@conditional_page(row_versions.library_version)
+@cached_page(page_cache.LISTING_TAG)
+def list_authors():
+    """List authors by name, or those whose name contains ``q``."""
+    fields = _parse_fields(AUTHOR_FIELDS, DEFAULT_AUTHOR_FIELDS)
+    search_query = request.args.get("q", "").strip()
+
+    query = Author.query.options(*_author_options(fields))
+    if search_query:
+        query = query.filter(Author.name.ilike(f"%{search_query}%"))
+    authors, next_cursor, prev_cursor = _keyset_page(
+        query,
+        [Author.name.collate("nocase"), Author.id],
+        _page_size(),
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+    )
+    items = [_serialize(author, AUTHOR_FIELDS, fields) for author in authors]
+    return json_response(_page_payload(items, next_cursor, prev_cursor))
+
+
+@bp.route("/authors/<int:author_id>")
+@conditional_page(row_versions.author_version)
+@cached_page("author:{author_id}")
+def get_author(author_id):
+    """Return one author."""
+    fields = _parse_fields(AUTHOR_FIELDS, DEFAULT_AUTHOR_FIELDS)
+    author = Author.query.options(*_author_options(fields)).get_or_404(author_id)
+    return json_response(_serialize(author, AUTHOR_FIELDS, fields))
+
+
+@bp.errorhandler(BadRequest)
+def _bad_request(error):
+    return json_response({"error": str(error)}, 400)
+
+
+@bp.errorhandler(HTTPException)
+def _http_error(error):
+    return json_response({"error": error.description}, error.code)
+
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    app.register_blueprint(bp)
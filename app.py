@@ -2,12 +2,29 @@ import os
 from flask import Flask, request, render_template, flash, redirect, url_for
 from datetime import datetime
 from data_models import db, Author, Book
+import api
+import author_stats
+import benchmarks
+import catalog_io
+import covers
+import enrichment
+import http_cache
+import isbns
+import metrics
+import migrations
+import page_cache
+import row_versions
+import search
 import seed
+import sqlite_tuning
+from page_cache import add_cache_tags, cached_page
+from row_versions import conditional_page
 from helpers import (
-    _build_book_query,
-    _fetch_and_update_book_metadata,
-    _update_db_if_needed,
+    BOOK_LISTING,
+    _book_query_and_keys,
     _handle_invalid_isbns,
+    _keyset_page,
+    _reset_lookup_backoff,
 )
 
 app = Flask(__name__)
@@ -18,101 +35,117 @@ app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(
     basedir, "data", "library.sqlite"
 )
 app.config["SECRET_KEY"] = "your_secret_key"
+# Books shown per page on the home listing; ?per_page= may ask for up to MAX.
+app.config["BOOKS_PER_PAGE"] = 50
+app.config["MAX_BOOKS_PER_PAGE"] = 200
 
+# Allow any setting to be overridden with FLASK_<NAME> environment variables.
+app.config.from_prefixed_env()
+
+# Sets engine options, so it must run before db.init_app().
+sqlite_tuning.init_app(app)
 db.init_app(app)
+# First, so that its timings cover the other modules' request hooks.
+metrics.init_app(app)
 seed.init_cli(app)
+enrichment.init_app(app)
+http_cache.init_cli(app)
+search.init_app(app)
+migrations.init_cli(app)
+page_cache.init_app(app)
+row_versions.init_app(app)
+covers.init_app(app)
+api.init_app(app)
+author_stats.init_app(app)
+isbns.init_cli(app)
+catalog_io.init_app(app)
+benchmarks.init_cli(app)
 
 # Create tables if they don't exist. For production, use Flask-Migrate.
 with app.app_context():
     db.create_all()
-
-
-def is_valid_isbn(isbn):
-    """Check if the ISBN is in a valid format (not a checksum validation)."""
-    if not isbn:
-        return False
-    isbn = isbn.replace("-", "").replace(" ", "").upper()
-    if len(isbn) == 10 and (
-        isbn[:-1].isdigit() and (isbn[-1].isdigit() or isbn[-1] == "X")
-    ):
-        return True
-    if len(isbn) == 13 and isbn.isdigit():
-        return True
-    return False
+    migrations.upgrade_schema()
+    search.ensure_search_index()
+    row_versions.ensure_version_triggers()
+    author_stats.ensure_author_stats()
+    isbns.normalize_stored_isbns()
 
 
 @app.route("/")
+@conditional_page(row_versions.library_version)
+@cached_page(page_cache.LISTING_TAG)
 def home():
     """Display the homepage with a list of books.
 
-    Handles sorting and searching of books.
-    Fetches book metadata (cover, synopsis) if missing and updates
-    the database.
+    Handles sorting, searching and cursor-based pagination of books.
+    Only the columns the page shows are selected, into BookListing rows.
+    Books missing metadata (cover, synopsis) are queued for background
+    enrichment; the page renders with whatever the database already holds.
     """
-    sort_by = request.args.get("sort", "title")
     search_query = request.args.get("search_query", "")
-
-    query = _build_book_query(sort_by, search_query)
-    books = query.all()
-
-    books_data = []
-    invalid_isbns = []
-    updated_books = False
-
-    for book in books:
-        cover_url, synopsis = _fetch_and_update_book_metadata(book)
-
-        if not book.cover_url and not is_valid_isbn(book.isbn):
-            invalid_isbns.append(
-                {"id": book.id, "title": book.title, "isbn": book.isbn}
-            )
-
-        if _update_db_if_needed(book, cover_url, synopsis):
-            updated_books = True
-
-        books_data.append(
-            {
-                "id": book.id,
-                "title": book.title,
-                "author_id": book.author.id,
-                "author": book.author.name,
-                "cover_url": cover_url or book.cover_url,
-                "rating": book.rating,
-            }
-        )
-
-    if updated_books:
-        try:
-            db.session.commit()
-            print("Committed updated cover URLs and/or synopses to database.")
-        except Exception as e:
-            db.session.rollback()
-            print(f"Error committing updates: {e}")
-            flash("Error saving updated book details to the database.", "error")
-
+    sort_by = request.args.get("sort") or ("relevance" if search_query else "title")
+
+    per_page = request.args.get("per_page", app.config["BOOKS_PER_PAGE"], type=int)
+    per_page = max(1, min(per_page, app.config["MAX_BOOKS_PER_PAGE"]))
+
+    query, sort_keys = _book_query_and_keys(sort_by, search_query, BOOK_LISTING)
+    books, next_cursor, prev_cursor = _keyset_page(
+        query,
+        sort_keys,
+        per_page,
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+    )
+
+    enrichment.schedule_enrichment(books)
+
+    # Validated when written (see isbns.py); None means not checked yet.
+    invalid_isbns = [
+        {"id": book.id, "title": book.title, "isbn": book.isbn}
+        for book in books
+        if not book.cover_url and book.isbn_valid is False
+    ]
     _handle_invalid_isbns(invalid_isbns)
 
-    return render_template("home.html", books=books_data, search_query=search_query)
+    return render_template(
+        "home.html",
+        books=books,
+        search_query=search_query,
+        next_cursor=next_cursor,
+        prev_cursor=prev_cursor,
+    )
 
 
 # --- Detail Page Routes ---
 
 
 @app.route("/book/<int:book_id>")
+@conditional_page(row_versions.book_version)
+@cached_page("book:{book_id}")
 def book_detail(book_id):
     """Display the detail page for a specific book."""
     # Eager load author, no need to fetch synopsis here
     # as it should be fetched by home()
-    book = Book.query.options(db.joinedload(Book.author)).get_or_404(book_id)
+    book = Book.query.options(
+        db.joinedload(Book.author), db.undefer(Book.synopsis)
+    ).get_or_404(book_id)
+    # The page shows the author's name too.
+    add_cache_tags(f"author:{book.author_id}")
     return render_template("book_detail.html", book=book)
 
 
 @app.route("/author/<int:author_id>")
+@conditional_page(row_versions.author_version)
+@cached_page("author:{author_id}")
 def author_detail(author_id):
     """Display the detail page for a specific author and their books."""
     # Use get_or_404 to handle cases where the author ID doesn't exist
     # Eager load books for the author detail page
-    author = Author.query.options(db.joinedload(Author.books)).get_or_404(author_id)
+    author = Author.query.options(
+        db.joinedload(Author.books),
+        db.joinedload(Author.stats),
+        db.undefer(Author.bio),
+    ).get_or_404(author_id)
     return render_template("author_detail.html", author=author)
 
 
@@ -138,8 +171,13 @@ def remove_cover(book_id):
     """Remove the cover URL for a book, allowing it to be re-fetched."""
     book = Book.query.get_or_404(book_id)
     if book.cover_url:
+        cover_file = book.cover_file
         book.cover_url = None
+        book.cover_file = None
+        # Let the next page load look the cover up again straight away.
+        _reset_lookup_backoff([book.id])
         db.session.commit()
+        covers.release_covers([cover_file])
         flash(
             f'Cover removed for "{book.title}".It will be re-fetched on next load.',
             "success",
@@ -153,9 +191,11 @@ def remove_cover(book_id):
 def delete_book(book_id):
     """Delete a book from the database."""
     book = Book.query.get_or_404(book_id)
+    cover_file = book.cover_file
     try:
         db.session.delete(book)
         db.session.commit()
+        covers.release_covers([cover_file])
         flash(f'Book "{book.title}" deleted successfully.', "success")
         return redirect(url_for("home"))
     except Exception as e:
@@ -169,11 +209,13 @@ def delete_author(author_id):
     """Delete an author and all their associated books from the database."""
     author = Author.query.get_or_404(author_id)
     author_name = author.name  # Get name before deleting
+    cover_files = [book.cover_file for book in author.books]
     try:
         # Because of cascade='all, delete-orphan', deleting the author
         # will automatically delete their associated books.
         db.session.delete(author)
         db.session.commit()
+        covers.release_covers(cover_files)
         flash(
             f'Author "{author_name}" and all associated books deleted successfully.',
             "success",
@@ -231,7 +273,7 @@ def add_book():
     """
     authors = Author.query.order_by(Author.name).all()
     if request.method == "POST":
-        isbn = request.form["isbn"]
+        isbn, isbn_valid = isbns.normalize_isbn(request.form["isbn"])
         title = request.form["title"]
         publication_date_str = request.form["publication_year"]
         author_id = request.form["author_id"]
@@ -247,12 +289,14 @@ def add_book():
         except ValueError:
             flash("Invalid publication date format. Please use YYYY-MM-DD.", "error")
             return render_template("add_book.html", authors=authors)
-        existing_book = Book.query.filter_by(isbn=isbn).first()
+        # Also finds the book if it was stored under its ISBN-10.
+        existing_book = Book.query.filter(Book.isbn.in_(isbns.isbn_forms(isbn))).first()
         if existing_book:
             flash("A book with this ISBN already exists.", "error")
             return render_template("add_book.html", authors=authors)
         new_book = Book(
             isbn=isbn,
+            isbn_valid=isbn_valid,
             title=title,
             publication_date=publication_date_obj,
             author_id=int(author_id),
@@ -260,6 +304,13 @@ def add_book():
         db.session.add(new_book)
         db.session.commit()
         flash("Book added successfully!", "success")
+        # Kept and flagged, like an import does, rather than rejected.
+        if not isbn_valid:
+            flash(
+                "The ISBN fails its checksum; the book is listed as having an "
+                "invalid ISBN.",
+                "info",
+            )
         return redirect(url_for("add_book"))
 
     return render_template("add_book.html", authors=authors)
@@ -0,0 +1,227 @@
+"""Per-author aggregates: book count, rated-book count, average rating and
+latest publication date.
+
+``author_stats`` holds one row per author. Triggers on ``book`` and
+``authors`` apply each insert, update and delete as a delta, so the rows stay
+current for every write path (the routes, bulk imports and raw SQL) without
+re-aggregating an author's books. Only removing an author's latest book
+looks the latest date up again, through ``ix_book_author_publication``.
+
+``flask author-stats-rebuild`` recomputes every row from scratch and
+``flask author-stats-check`` compares the rows with a fresh aggregate.
+"""
+
+import click
+import sqlalchemy as sa
+from flask.cli import with_appcontext
+
+from data_models import db
+
+
+def _add_book(prefix):
+    """Add the ``prefix`` (new/old) book row to its author's aggregates."""
+    return f"""
+        INSERT INTO author_stats (
+            author_id, book_count, rated_count, rating_sum, latest_publication
+        )
+        VALUES (
+            {prefix}.author_id,
+            1,
+            {prefix}.rating IS NOT NULL,
+            coalesce({prefix}.rating, 0),
+            {prefix}.publication_date
+        )
+        ON CONFLICT (author_id) DO UPDATE SET
+            book_count = book_count + 1,
+            rated_count = rated_count + excluded.rated_count,
+            rating_sum = rating_sum + excluded.rating_sum,
+            latest_publication = coalesce(
+                max(latest_publication, excluded.latest_publication),
+                latest_publication,
+                excluded.latest_publication
+            );
+    """
+
+
+def _remove_book(prefix):
+    """Take the ``prefix`` (new/old) book row out of its author's aggregates.
+
+    Runs after the row is gone (or changed), so recomputing the latest date
+    no longer sees it.
+    """
+    return f"""
+        UPDATE author_stats SET
+            book_count = book_count - 1,
+            rated_count = rated_count - ({prefix}.rating IS NOT NULL),
+            rating_sum = rating_sum - coalesce({prefix}.rating, 0),
+            latest_publication = CASE
+                WHEN {prefix}.publication_date >= latest_publication THEN (
+                    SELECT max(publication_date) FROM book
+                    WHERE author_id = {prefix}.author_id
+                )
+                ELSE latest_publication
+            END
+        WHERE author_id = {prefix}.author_id;
+    """
+
+
+TRIGGERS = (
+    (
+        "author_stats_after_book_insert",
+        f"AFTER INSERT ON book BEGIN {_add_book('new')} END",
+    ),
+    (
+        "author_stats_after_book_delete",
+        f"AFTER DELETE ON book BEGIN {_remove_book('old')} END",
+    ),
+    (
+        "author_stats_after_book_update",
+        "AFTER UPDATE OF author_id, rating, publication_date ON book BEGIN "
+        f"{_remove_book('old')} {_add_book('new')} END",
+    ),
+    (
+        "author_stats_after_author_insert",
+        """AFTER INSERT ON authors BEGIN
+            INSERT OR IGNORE INTO author_stats (
+                author_id, book_count, rated_count, rating_sum
+            )
+            VALUES (new.id, 0, 0, 0);
+        END""",
+    ),
+    (
+        "author_stats_after_author_delete",
+        """AFTER DELETE ON authors BEGIN
+            DELETE FROM author_stats WHERE author_id = old.id;
+        END""",
+    ),
+)
+
+# The aggregates as computed from scratch, one row per author.
+AGGREGATE_SQL = """
+    SELECT
+        authors.id AS author_id,
+        count(book.id) AS book_count,
+        count(book.rating) AS rated_count,
+        coalesce(sum(book.rating), 0) AS rating_sum,
+        max(book.publication_date) AS latest_publication
+    FROM authors LEFT JOIN book ON book.author_id = authors.id
+    GROUP BY authors.id
+"""
+
+REBUILD_SQL = (
+    "DELETE FROM author_stats",
+    "INSERT INTO author_stats "
+    "(author_id, book_count, rated_count, rating_sum, latest_publication) "
+    f"{AGGREGATE_SQL}",
+)
+
+COLUMNS = ("book_count", "rated_count", "rating_sum", "latest_publication")
+
+
+def ensure_author_stats():
+    """(Re)create the aggregate triggers, and refill the table if any were missing.
+
+    Writes made while a trigger was missing (a new database, or triggers
+    dropped for a bulk load) are not reflected in the table, so it is
+    rebuilt then. Returns True if it was. Requires an app context and an
+    up-to-date schema.
+    """
+    with db.engine.begin() as conn:
+        existing = set(
+            conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+            ).scalars()
+        )
+        for name, body in TRIGGERS:
+            conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+            conn.exec_driver_sql(f"CREATE TRIGGER {name} {body}")
+        if all(name in existing for name, _ in TRIGGERS):
+            return False
+        for statement in REBUILD_SQL:
+            conn.exec_driver_sql(statement)
+    return True
+
+
+def rebuild_author_stats():
+    """Recompute every author's aggregates from the book table."""
+    with db.engine.begin() as conn:
+        for statement in REBUILD_SQL:
+            conn.exec_driver_sql(statement)
+
+
+def check_author_stats(limit=None):
+    """Compare ``author_stats`` with the aggregates computed from scratch.
+
+    Returns ``(author_id, column, stored, expected)`` for every difference,
+    at most ``limit`` of them. A missing row shows up with ``stored`` None
+    and an extra row (for an author that no longer exists) with
+    ``expected`` None, both under the column "row".
+    """
+    columns = ", ".join(f"s.{name}, e.{name}" for name in COLUMNS)
+    differs = " OR ".join(f"s.{name} IS NOT e.{name}" for name in COLUMNS)
+    sql = f"""
+        WITH e AS ({AGGREGATE_SQL})
+        SELECT e.author_id, s.author_id IS NULL, {columns}
+        FROM e LEFT JOIN author_stats AS s ON s.author_id = e.author_id
+        WHERE s.author_id IS NULL OR {differs}
+        UNION ALL
+        SELECT s.author_id, NULL, {", ".join("NULL, NULL" for _ in COLUMNS)}
+        FROM author_stats AS s
+        WHERE s.author_id NOT IN (SELECT id FROM authors)
+        ORDER BY 1
+    """
+    problems = []
+    with db.engine.connect() as conn:
+        for row in conn.exec_driver_sql(sql):
+            author_id, missing, values = row[0], row[1], row[2:]
+            if missing is None:
+                problems.append((author_id, "row", author_id, None))
+            elif missing:
+                problems.append((author_id, "row", None, author_id))
+            else:
+                for i, name in enumerate(COLUMNS):
+                    stored, expected = values[2 * i], values[2 * i + 1]
+                    if stored != expected:
+                        problems.append((author_id, name, stored, expected))
+            if limit is not None and len(problems) >= limit:
+                return problems[:limit]
+    return problems
+
+
+@click.command("author-stats-rebuild")
+@with_appcontext
+def author_stats_rebuild_command():
+    """Recompute the aggregates of every author."""
+    ensure_author_stats()
+    rebuild_author_stats()
+    count = db.session.execute(sa.text("SELECT count(*) FROM author_stats")).scalar()
+    click.echo(f"Rebuilt the aggregates of {count} authors.")
+
+
+@click.command("author-stats-check")
+@click.option("--limit", default=20, show_default=True, help="Differences to show.")
+@click.option("--repair", is_flag=True, help="Rebuild the table if it is off.")
+@with_appcontext
+def author_stats_check_command(limit, repair):
+    """Check the author aggregates against the book table.
+
+    Exits with status 1 if any author's aggregates differ, unless --repair
+    rebuilds them.
+    """
+    problems = check_author_stats()
+    if not problems:
+        click.echo("Author aggregates are consistent.")
+        return
+    for author_id, column, stored, expected in problems[:limit]:
+        click.echo(f"author {author_id}: {column} is {stored!r}, expected {expected!r}")
+    authors = len({author_id for author_id, *_ in problems})
+    if repair:
+        rebuild_author_stats()
+        click.echo(f"Rebuilt the aggregates after differences for {authors} authors.")
+        return
+    raise click.ClickException(f"Aggregates differ for {authors} authors.")
+
+
+def init_app(app):
+    app.cli.add_command(author_stats_rebuild_command)
+    app.cli.add_command(author_stats_check_command)
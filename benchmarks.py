@@ -0,0 +1,677 @@
+"""Synthetic libraries and a repeatable benchmark of the web routes.
+
+``flask bench-generate`` fills the configured database with a synthetic
+library whose authors follow a long-tail distribution: a few prolific
+authors and many with one or two books. Point FLASK_SQLALCHEMY_DATABASE_URI
+at a scratch file to keep it apart from the real library.
+
+``flask bench-routes`` drives the app through Flask's test client with the
+metadata providers stubbed out. For every route it records latency
+percentiles, SQL statements per request and peak Python memory, and writes
+them as JSON so runs can be compared across commits with
+``flask bench-compare``.
+"""
+
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+import click
+import requests
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import with_appcontext
+
+import author_stats
+import helpers
+import row_versions
+import search
+from data_models import db, Author, Book
+from enrichment import EnrichmentWorkerPool
+
+SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+# Average number of books per author.
+BOOKS_PER_AUTHOR = 8
+INSERT_CHUNK_SIZE = 10_000
+
+FIRST_NAMES = (
+    "Ada Alan Alice Amara Anna Ben Carla Chen David Elena Emil Farah George "
+    "Grace Hana Ivan Jonas Julia Kenji Laura Leo Maya Nadia Omar Paula Quinn "
+    "Rosa Sam Tariq Uma Victor Wen Yara Zoe"
+).split()
+LAST_NAMES = (
+    "Abbott Baker Castillo Dubois Eriksen Fischer Garcia Haddad Ito Jensen "
+    "Kowalski Larsen Moreau Nakamura Okafor Petrov Quintero Rossi Schmidt "
+    "Tanaka Underwood Varga Walsh Xu Yilmaz Zimmermann Novak Silva Murphy "
+    "Keller Lindqvist Mendes Horvat Byrne Sato"
+).split()
+WORDS = (
+    "shadow river garden winter empire silent house night glass city storm "
+    "letters island memory fire stone crown secret orchard harbor lantern "
+    "mountain daughter thief clockwork ocean forest ember ghost road summer "
+    "paper wolf kingdom echo mirror journey star silver iron last first "
+    "lost hidden burning quiet broken golden long little distant forgotten"
+).split()
+
+
+# --- Synthetic library ---
+
+
+def isbn13(serial):
+    """Return a valid ISBN-13 for a 9-digit serial number."""
+    digits = f"978{serial:09d}"
+    total = sum(int(d) * (1 if i % 2 == 0 else 3) for i, d in enumerate(digits))
+    return digits + str((10 - total % 10) % 10)
+
+
+def _author_name(index):
+    first = FIRST_NAMES[index % len(FIRST_NAMES)]
+    last = LAST_NAMES[(index // len(FIRST_NAMES)) % len(LAST_NAMES)]
+    generation = index // (len(FIRST_NAMES) * len(LAST_NAMES))
+    return f"{first} {last}" + (f" {generation + 1}" if generation else "")
+
+
+def _random_date(rng, start_year, end_year):
+    start = date(start_year, 1, 1)
+    return start + timedelta(days=rng.randrange((end_year - start_year) * 365))
+
+
+def _sentence(rng, low, high):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def _authors(rng, count, now):
+    for index in range(count):
+        yield {
+            "name": _author_name(index),
+            "birth_date": _random_date(rng, 1900, 1995),
+            "death_date": None,
+            "bio": _sentence(rng, 30, 80).capitalize() if rng.random() < 0.3 else None,
+            "version": 1,
+            "updated_at": now,
+        }
+
+
+def _books(rng, count, author_ids, first_serial, now):
+    for index in range(count):
+        isbn = isbn13(first_serial + index)
+        # Skewed towards the first authors: a long tail of one-book authors.
+        author_id = author_ids[int(len(author_ids) * rng.random() ** 3)]
+        yield {
+            "isbn": isbn,
+            "isbn_valid": True,
+            "title": _sentence(rng, 2, 5).title(),
+            "publication_date": (
+                _random_date(rng, 1900, 2025) if rng.random() < 0.95 else None
+            ),
+            "author_id": author_id,
+            "synopsis": (
+                _sentence(rng, 40, 120).capitalize() if rng.random() < 0.7 else None
+            ),
+            "cover_url": (
+                f"https://covers.openlibrary.org/b/isbn/{isbn}-L.jpg"
+                if rng.random() < 0.6
+                else None
+            ),
+            "rating": rng.randint(1, 10) if rng.random() < 0.5 else None,
+            "version": 1,
+            "updated_at": now,
+        }
+
+
+def _insert_chunked(conn, table, rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == INSERT_CHUNK_SIZE:
+            conn.execute(sa.insert(table), chunk)
+            chunk = []
+    if chunk:
+        conn.execute(sa.insert(table), chunk)
+
+
+@contextmanager
+def _triggers_suspended():
+    """Drop the triggers on book and authors, and restore them afterwards.
+
+    Bulk generation is much faster without per-row trigger work; the derived
+    data (the search index and author aggregates) is rebuilt once at the end
+    instead.
+    """
+    with db.engine.begin() as conn:
+        names = conn.exec_driver_sql(
+            "SELECT name FROM sqlite_master "
+            "WHERE type = 'trigger' AND tbl_name IN ('book', 'authors')"
+        ).scalars()
+        for name in list(names):
+            conn.exec_driver_sql(f"DROP TRIGGER {name}")
+    try:
+        yield
+    finally:
+        if search.ensure_search_index():
+            search.rebuild_search_index()
+        row_versions.ensure_version_triggers()
+        author_stats.ensure_author_stats()
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql(
+                "UPDATE library_state SET version = version + 1, "
+                f"updated_at = {row_versions.SQL_NOW}"
+            )
+            conn.exec_driver_sql("ANALYZE")
+
+
+def generate_library(books, seed=0):
+    """Add a synthetic library of ``books`` books to the database.
+
+    Returns ``(authors, books)`` counts.
+    """
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    author_count = max(1, books // BOOKS_PER_AUTHOR)
+    with _triggers_suspended(), db.engine.begin() as conn:
+        first_author = conn.execute(sa.select(sa.func.max(Author.id))).scalar() or 0
+        _insert_chunked(conn, Author.__table__, _authors(rng, author_count, now))
+        author_ids = list(range(first_author + 1, first_author + author_count + 1))
+        first_serial = (
+            conn.execute(sa.select(sa.func.count(Book.id))).scalar() + 100_000_000
+        )
+        _insert_chunked(
+            conn,
+            Book.__table__,
+            _books(rng, books, author_ids, first_serial, now),
+        )
+    return author_count, books
+
+
+@click.command("bench-generate")
+@click.option(
+    "--books",
+    "size",
+    default="10k",
+    show_default=True,
+    help="Library size: 10k, 100k, 1m or a number of books.",
+)
+@click.option("--seed", default=0, show_default=True, help="Random seed.")
+@click.option(
+    "--append",
+    is_flag=True,
+    help="Add to a database that already has books.",
+)
+@with_appcontext
+def bench_generate_command(size, seed, append):
+    """Fill the database with a synthetic library.
+
+    Use a scratch database, e.g.
+    FLASK_SQLALCHEMY_DATABASE_URI=sqlite:////tmp/bench.sqlite.
+    """
+    books = SIZES.get(size.lower()) or int(size)
+    if Book.query.count() and not append:
+        raise click.ClickException(
+            "The database already has books; pass --append or point "
+            "FLASK_SQLALCHEMY_DATABASE_URI at a scratch database."
+        )
+    started = time.perf_counter()
+    authors, books = generate_library(books, seed=seed)
+    click.echo(
+        f"Generated {books} books by {authors} authors "
+        f"in {time.perf_counter() - started:.1f}s."
+    )
+
+
+# --- Route benchmark ---
+
+
+class SQLCounter:
+    """Counts SQL statements executed by the benchmarking thread."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.thread_id = threading.get_ident()
+        self.count = 0
+
+    def _before_execute(self, *args, **kwargs):
+        if threading.get_ident() == self.thread_id:
+            self.count += 1
+
+    def __enter__(self):
+        sa.event.listen(self.engine, "before_cursor_execute", self._before_execute)
+        return self
+
+    def __exit__(self, *exc):
+        sa.event.remove(self.engine, "before_cursor_execute", self._before_execute)
+
+
+class ProviderStub:
+    """Answers every provider request with an empty 404, and counts them."""
+
+    def __init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def request(self, client, method, url, **kwargs):
+        with self._lock:
+            self.calls += 1
+        response = requests.Response()
+        response.status_code = 404
+        response._content = b"{}"
+        response.url = url
+        return response
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of ``values``."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(fraction * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def _sample_ids(column, count, rng, where=None):
+    stmt = sa.select(column)
+    if where is not None:
+        stmt = stmt.where(where)
+    # Sampling ids by random rowid is much cheaper than ORDER BY random().
+    high = db.session.execute(sa.select(sa.func.max(column))).scalar() or 0
+    ids = set()
+    for _ in range(5):
+        candidates = [rng.randint(1, high) for _ in range(count * 2)] if high else []
+        ids.update(
+            db.session.scalars(stmt.where(column.in_(candidates)).limit(count)).all()
+        )
+        if len(ids) >= count:
+            break
+    return list(ids)[:count] or [0]
+
+
+def _next_cursor(client):
+    """Follow the home page to its second page and return that URL."""
+    html = client.get("/").get_data(as_text=True)
+    marker = 'href="/?'
+    for part in html.split(marker)[1:]:
+        query = part.split('"', 1)[0].replace("&amp;", "&")
+        if "after=" in query:
+            return f"/?{query}"
+    return "/"
+
+
+def build_scenarios(rng, requests_per_route, include_writes=True):
+    """Return ``(name, method, make_request)`` for every benchmarked route.
+
+    ``make_request(i)`` returns ``(url, form_data)`` for the i-th request.
+    """
+    client = current_app.test_client()
+    book_ids = _sample_ids(Book.id, requests_per_route, rng)
+    author_ids = _sample_ids(Author.id, requests_per_route, rng)
+    top_author = db.session.execute(
+        sa.select(Book.author_id)
+        .group_by(Book.author_id)
+        .order_by(sa.func.count().desc())
+        .limit(1)
+    ).scalar()
+    second_page = _next_cursor(client)
+
+    def pick(ids):
+        return lambda i: ids[i % len(ids)]
+
+    scenarios = [
+        ("home", "GET", lambda i: ("/", None)),
+        ("home, author sort", "GET", lambda i: ("/?sort=author", None)),
+        ("home, second page", "GET", lambda i: (second_page, None)),
+        ("home, 200 per page", "GET", lambda i: ("/?per_page=200", None)),
+        (
+            "search",
+            "GET",
+            lambda i: (f"/?search_query={rng.choice(WORDS)}", None),
+        ),
+        (
+            "search, two words",
+            "GET",
+            lambda i: (f"/?search_query={rng.choice(WORDS)}+{rng.choice(WORDS)}", None),
+        ),
+        ("book_detail", "GET", lambda i: (f"/book/{pick(book_ids)(i)}", None)),
+        ("author_detail", "GET", lambda i: (f"/author/{pick(author_ids)(i)}", None)),
+        (
+            "author_detail, most books",
+            "GET",
+            lambda i: (f"/author/{top_author}", None),
+        ),
+        ("api books", "GET", lambda i: ("/api/v1/books", None)),
+        (
+            "api search",
+            "GET",
+            lambda i: (f"/api/v1/books?q={rng.choice(WORDS)}", None),
+        ),
+        (
+            "api book",
+            "GET",
+            lambda i: (f"/api/v1/books/{pick(book_ids)(i)}", None),
+        ),
+    ]
+    if not include_writes:
+        return scenarios
+
+    cover_ids = _sample_ids(
+        Book.id, requests_per_route, rng, Book.cover_url.isnot(None)
+    )
+    serial = 900_000_000 + rng.randrange(50_000_000)
+    added_isbns = []
+
+    def add_book(i):
+        isbn = isbn13(serial + i)
+        added_isbns.append(isbn)
+        return "/add_book", {
+            "isbn": isbn,
+            "title": _sentence(rng, 2, 4).title(),
+            "publication_year": "2020-01-01",
+            "author_id": str(pick(author_ids)(i)),
+        }
+
+    def delete_book(i):
+        # Deletes the books added by the add_book scenario. The lookup uses a
+        # raw connection so that it is not counted against the route.
+        isbn = added_isbns[i % len(added_isbns)] if added_isbns else None
+        conn = db.engine.raw_connection()
+        try:
+            row = conn.execute("SELECT id FROM book WHERE isbn = ?", (isbn,)).fetchone()
+        finally:
+            conn.close()
+        return f"/book/{row[0] if row else 0}/delete", {}
+
+    scenarios += [
+        (
+            "rate_book",
+            "POST",
+            lambda i: (
+                f"/book/{pick(book_ids)(i)}/rate",
+                {"rating": str(rng.randint(1, 10))},
+            ),
+        ),
+        (
+            "remove_cover",
+            "POST",
+            lambda i: (f"/book/{pick(cover_ids)(i)}/remove_cover", {}),
+        ),
+        (
+            "add_author",
+            "POST",
+            lambda i: (
+                "/add_author",
+                {
+                    "name": f"Benchmark Author {serial}-{i}",
+                    "birthdate": "1970-01-01",
+                    "date_of_death": "",
+                    "bio": "",
+                },
+            ),
+        ),
+        ("add_book", "POST", add_book),
+        ("delete_book", "POST", delete_book),
+    ]
+    return scenarios
+
+
+def _run_request(app, method, url, data):
+    # A fresh client per request, so flashed messages never pile up in the
+    # session cookie and every request is a first visit.
+    client = app.test_client()
+    if method == "POST":
+        return client.post(url, data=data)
+    return client.get(url)
+
+
+def benchmark_route(app, method, make_request, count, warmup, memory_samples):
+    """Time ``count`` requests; returns the route's result dict."""
+    for i in range(warmup):
+        _run_request(app, method, *make_request(i))
+
+    latencies = []
+    queries = []
+    statuses = {}
+    with SQLCounter(db.engine) as counter:
+        for i in range(count):
+            url, data = make_request(warmup + i)
+            before = counter.count
+            started = time.perf_counter()
+            response = _run_request(app, method, url, data)
+            latencies.append(time.perf_counter() - started)
+            queries.append(counter.count - before)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    # Memory is measured separately, since tracing allocations slows every
+    # request down.
+    peak = 0
+    tracemalloc.start()
+    try:
+        for i in range(memory_samples):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            _run_request(app, method, *make_request(warmup + count + i))
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "method": method,
+        "requests": count,
+        "statuses": {str(status): n for status, n in sorted(statuses.items())},
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p95": percentile(latencies, 0.95) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "mean": sum(latencies) / len(latencies) * 1000,
+            "max": max(latencies) * 1000,
+        },
+        "sql_queries": {
+            "mean": sum(queries) / len(queries),
+            "max": max(queries),
+        },
+        "peak_memory_kb": peak / 1024,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextmanager
+def benchmark_environment(app, use_cache):
+    """Stub the providers and keep background work out of the measurements.
+
+    Enrichment jobs are still queued by the routes, but the worker pool is
+    not started. Without ``use_cache`` the page cache is bypassed, so every
+    request renders.
+    """
+    stub = ProviderStub()
+    page_cache = app.extensions.get("page_cache")
+    if not use_cache:
+        app.extensions["page_cache"] = None
+    try:
+        with mock.patch.object(
+            helpers.ProviderClient, "request", autospec=True, side_effect=stub.request
+        ), mock.patch.object(EnrichmentWorkerPool, "start", lambda self: None):
+            yield stub
+    finally:
+        app.extensions["page_cache"] = page_cache
+
+
+def run_benchmark(requests_per_route, warmup, memory_samples, seed, routes, **options):
+    """Benchmark every route and return the results document."""
+    app = current_app._get_current_object()
+    rng = random.Random(seed)
+    results = {}
+    with benchmark_environment(app, options["use_cache"]) as stub:
+        scenarios = build_scenarios(
+            rng, requests_per_route, include_writes=options["include_writes"]
+        )
+        for name, method, make_request in scenarios:
+            if routes and name not in routes:
+                continue
+            calls_before = stub.calls
+            results[name] = benchmark_route(
+                app, method, make_request, requests_per_route, warmup, memory_samples
+            )
+            results[name]["provider_calls"] = stub.calls - calls_before
+            db.session.remove()
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "database": app.config["SQLALCHEMY_DATABASE_URI"],
+            "books": Book.query.count(),
+            "authors": Author.query.count(),
+            "requests_per_route": requests_per_route,
+            "warmup": warmup,
+            "page_cache": options["use_cache"],
+            "enrichment_mode": app.config["ENRICHMENT_MODE"],
+            "seed": seed,
+        },
+        "routes": results,
+    }
+
+
+def _echo_results(document):
+    click.echo(
+        f"{'route':<28}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+        f"{'SQL/req':>9}{'peak KB':>10}"
+    )
+    for name, result in document["routes"].items():
+        latency = result["latency_ms"]
+        click.echo(
+            f"{name:<28}{latency['p50']:>9.2f}{latency['p95']:>9.2f}"
+            f"{latency['p99']:>9.2f}{result['sql_queries']['mean']:>9.1f}"
+            f"{result['peak_memory_kb']:>10.0f}"
+        )
+
+
+@click.command("bench-routes")
+@click.option(
+    "--requests",
+    "requests_per_route",
+    default=100,
+    show_default=True,
+    help="Timed requests per route.",
+)
+@click.option("--warmup", default=5, show_default=True, help="Untimed requests first.")
+@click.option(
+    "--memory-samples",
+    default=10,
+    show_default=True,
+    help="Extra requests per route run with allocation tracing.",
+)
+@click.option("--seed", default=0, show_default=True, help="Random seed.")
+@click.option(
+    "--route",
+    "routes",
+    multiple=True,
+    help="Only benchmark this route (repeatable), e.g. --route search.",
+)
+@click.option(
+    "--writes/--no-writes",
+    "include_writes",
+    default=True,
+    show_default=True,
+    help="Include the write routes, which modify the database.",
+)
+@click.option(
+    "--cache/--no-cache",
+    "use_cache",
+    default=False,
+    show_default=True,
+    help="Serve pages from the page cache when possible.",
+)
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False),
+    help="Where to write the JSON results "
+    "(default: data/benchmarks/routes-<commit>-<time>.json).",
+)
+@with_appcontext
+def bench_routes_command(
+    requests_per_route,
+    warmup,
+    memory_samples,
+    seed,
+    routes,
+    include_writes,
+    use_cache,
+    output,
+):
+    """Benchmark the web routes with the metadata providers stubbed out.
+
+    Write routes change the database, so run this against a synthetic
+    library from bench-generate.
+    """
+    document = run_benchmark(
+        requests_per_route,
+        warmup,
+        memory_samples,
+        seed,
+        set(routes),
+        include_writes=include_writes,
+        use_cache=use_cache,
+    )
+    _echo_results(document)
+    if output is None:
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        output = os.path.join(
+            current_app.root_path,
+            "data",
+            "benchmarks",
+            f"routes-{document['meta']['commit'] or 'unknown'}-{stamp}.json",
+        )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(document, f, indent=2)
+    click.echo(f"Results written to {output}")
+
+
+@click.command("bench-compare")
+@click.argument("baseline", type=click.File())
+@click.argument("candidate", type=click.File())
+def bench_compare_command(baseline, candidate):
+    """Compare two bench-routes result files route by route."""
+    before, after = json.load(baseline), json.load(candidate)
+    click.echo(
+        f"{before['meta']['commit']} -> {after['meta']['commit']}\n"
+        f"{'route':<28}{'p50 ms':>18}{'p95 ms':>18}{'SQL/req':>14}"
+    )
+    for name, result in after["routes"].items():
+        if name not in before["routes"]:
+            continue
+        old = before["routes"][name]
+        cells = []
+        for key in ("p50", "p95"):
+            a, b = old["latency_ms"][key], result["latency_ms"][key]
+            change = (b - a) / a * 100 if a else 0.0
+            cells.append(f"{a:.2f}->{b:.2f} {change:+.0f}%".rjust(18))
+        queries = (
+            f"{old['sql_queries']['mean']:.0f}->{result['sql_queries']['mean']:.0f}"
+        )
+        click.echo(f"{name:<28}{''.join(cells)}{queries:>14}")
+
+
+def init_cli(app):
+    app.cli.add_command(bench_generate_command)
+    app.cli.add_command(bench_routes_command)
+    app.cli.add_command(bench_compare_command)
@@ -0,0 +1,580 @@
+"""Bulk import and export of book catalogs as CSV or JSON Lines.
+
+Both directions stream. Imports are read row by row and written in chunks,
+each in its own transaction, so memory use depends on the chunk size and the
+number of authors, not on the size of the file. Each chunk commits together
+with an ``import_checkpoints`` row, which lets an interrupted import resume
+where it stopped. Exports fetch plain rows a chunk at a time and write them
+out as they arrive, from the CLI or the ``/export/books`` endpoint.
+"""
+
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import time
+import zlib
+from datetime import date, datetime
+
+import click
+import sqlalchemy as sa
+from flask import Response, abort, request, stream_with_context
+from flask.cli import with_appcontext
+from sqlalchemy.dialects.sqlite import insert
+
+import page_cache
+from data_models import db, Author, Book, ImportCheckpoint
+from isbns import normalize_isbn
+
+# Book columns an import writes; isbn_valid comes from the ISBN (see isbns.py).
+BOOK_FIELDS = (
+    "isbn",
+    "isbn_valid",
+    "title",
+    "publication_date",
+    "synopsis",
+    "cover_url",
+    "rating",
+)
+
+# How often to print progress, in seconds.
+PROGRESS_INTERVAL = 5.0
+# Invalid rows are counted, but only the first few are reported individually.
+MAX_REPORTED_ERRORS = 20
+
+
+class InvalidRow(ValueError):
+    """A catalog row that cannot be imported."""
+
+
+# --- Reading ---
+
+
+def _open_text(path):
+    """Open ``path`` for reading text, transparently decompressing ``.gz``."""
+    if path.endswith(".gz"):
+        return io.TextIOWrapper(gzip.open(path, "rb"), encoding="utf-8-sig", newline="")
+    return open(path, encoding="utf-8-sig", newline="")
+
+
+def detect_format(path):
+    """Guess "csv" or "jsonl" from the file name."""
+    name = path[:-3] if path.endswith(".gz") else path
+    return "jsonl" if name.endswith((".jsonl", ".ndjson", ".json")) else "csv"
+
+
+def read_rows(path, file_format):
+    """Yield each record of a catalog file as a dict, one at a time."""
+    with _open_text(path) as f:
+        if file_format == "csv":
+            yield from csv.DictReader(f)
+            return
+        for line in f:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Reported as an invalid row by parse_row().
+                    yield None
+
+
+# --- Row parsing ---
+
+
+def _text(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _parse_date(value):
+    """Parse ``YYYY-MM-DD`` or a bare year; empty values give None."""
+    value = _text(value)
+    if value is None:
+        return None
+    try:
+        if len(value) == 4 and value.isdigit():
+            return date(int(value), 1, 1)
+        return datetime.strptime(value[:10], "%Y-%m-%d").date()
+    except ValueError:
+        raise InvalidRow(f"invalid date {value!r}")
+
+
+def _parse_rating(value):
+    value = _text(value)
+    if value is None:
+        return None
+    try:
+        rating = int(float(value))
+    except ValueError:
+        raise InvalidRow(f"invalid rating {value!r}")
+    if not 1 <= rating <= 10:
+        raise InvalidRow(f"rating {rating} is outside 1-10")
+    return rating
+
+
+def parse_row(row):
+    """Turn a raw catalog record into ``(book_values, author_values)``.
+
+    The author is given by ``author_name`` (or ``author``); ``author_birth_date``
+    and ``author_death_date`` are only used when the author is created.
+    """
+    if not isinstance(row, dict):
+        raise InvalidRow("not a JSON object")
+    title = _text(row.get("title"))
+    author_name = _text(row.get("author_name") or row.get("author"))
+    if not title:
+        raise InvalidRow("missing title")
+    if not author_name:
+        raise InvalidRow("missing author_name")
+    # Invalid ISBNs are kept, flagged, so the book is not lost over a typo.
+    isbn, isbn_valid = normalize_isbn(_text(row.get("isbn")))
+    if isbn and len(isbn) > 13:
+        raise InvalidRow(f"ISBN {isbn!r} is too long")
+    book = {
+        "isbn": isbn,
+        "isbn_valid": isbn_valid,
+        "title": title,
+        "publication_date": _parse_date(row.get("publication_date")),
+        "synopsis": _text(row.get("synopsis")),
+        "cover_url": _text(row.get("cover_url")),
+        "rating": _parse_rating(row.get("rating")),
+    }
+    author = {
+        "name": author_name,
+        "birth_date": _parse_date(row.get("author_birth_date")),
+        "death_date": _parse_date(row.get("author_death_date")),
+    }
+    return book, author
+
+
+# --- Writing ---
+
+
+def load_author_ids(conn):
+    """Return the name -> id map of existing authors (lowest id per name)."""
+    author_ids = {}
+    for author_id, name in conn.execute(
+        sa.select(Author.id, Author.name).order_by(Author.id.desc())
+    ):
+        author_ids[name] = author_id
+    return author_ids
+
+
+def _resolve_authors(conn, author_ids, authors):
+    """Create the authors in ``authors`` that are not in ``author_ids`` yet."""
+    new = {}
+    for author in authors:
+        if author["name"] not in author_ids:
+            new.setdefault(author["name"], author)
+    if new:
+        created = conn.execute(
+            insert(Author).returning(Author.id, Author.name), list(new.values())
+        )
+        author_ids.update({name: author_id for author_id, name in created})
+    return len(new)
+
+
+def _book_insert(on_duplicate):
+    stmt = insert(Book)
+    if on_duplicate == "upsert":
+        # Fields missing from the file keep their current values.
+        return stmt.on_conflict_do_update(
+            index_elements=[Book.isbn],
+            set_={
+                **{
+                    field: sa.func.coalesce(
+                        stmt.excluded[field], Book.__table__.c[field]
+                    )
+                    for field in BOOK_FIELDS
+                    if field != "isbn"
+                },
+                "author_id": stmt.excluded.author_id,
+            },
+        )
+    return stmt.on_conflict_do_nothing(index_elements=[Book.isbn])
+
+
+def write_chunk(conn, author_ids, rows, on_duplicate):
+    """Insert one chunk of parsed rows; returns ``(books_written, authors)``.
+
+    ``books_written`` counts inserted and, when upserting, updated books;
+    duplicates skipped under "skip" are not counted.
+    """
+    authors_created = _resolve_authors(conn, author_ids, [row[1] for row in rows])
+    books = [
+        {
+            **{field: book.get(field) for field in BOOK_FIELDS},
+            "author_id": author_ids[author["name"]],
+        }
+        for book, author in rows
+    ]
+    written = conn.execute(_book_insert(on_duplicate), books).rowcount
+    return written, authors_created
+
+
+def _source_key(path):
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+
+def _save_checkpoint(conn, source, rows_done, finished=False):
+    now = datetime.utcnow()
+    stmt = insert(ImportCheckpoint).values(
+        source=source,
+        rows_done=rows_done,
+        started_at=now,
+        updated_at=now,
+        finished_at=now if finished else None,
+    )
+    conn.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[ImportCheckpoint.source],
+            set_={
+                "rows_done": stmt.excluded.rows_done,
+                "updated_at": stmt.excluded.updated_at,
+                "finished_at": stmt.excluded.finished_at,
+            },
+        )
+    )
+
+
+def import_books(
+    path,
+    file_format=None,
+    chunk_size=1000,
+    on_duplicate="skip",
+    resume=True,
+    progress=None,
+):
+    """Stream a catalog file into the database.
+
+    ``on_duplicate`` is "skip" (keep the existing book) or "upsert" (update it
+    from the file). With ``resume``, rows already committed by an earlier run
+    over the same file are skipped. ``progress`` is called with the running
+    totals after each chunk. Returns the totals.
+    """
+    file_format = file_format or detect_format(path)
+    source = _source_key(path)
+    checkpoint = db.session.get(ImportCheckpoint, source) if resume else None
+    already_done = checkpoint.rows_done if checkpoint else 0
+    finished = checkpoint is not None and checkpoint.finished_at is not None
+    # Writes go through their own connection; release the session's.
+    db.session.rollback()
+
+    totals = {
+        "rows": already_done,
+        "written": 0,
+        "duplicates": 0,
+        "invalid": 0,
+        "invalid_isbns": 0,
+        "authors_created": 0,
+        "resumed_at": already_done,
+        "seconds": 0.0,
+    }
+    if finished:
+        return totals
+
+    started = time.perf_counter()
+    with db.engine.connect() as conn:
+        author_ids = load_author_ids(conn)
+        conn.rollback()
+        chunk = []
+        row_count = 0
+
+        def flush():
+            with conn.begin():
+                parsed = [row for row in chunk if row is not None]
+                written, created = (
+                    write_chunk(conn, author_ids, parsed, on_duplicate)
+                    if parsed
+                    else (0, 0)
+                )
+                _save_checkpoint(conn, source, row_count)
+            totals["rows"] = row_count
+            totals["written"] += written
+            totals["duplicates"] += len(parsed) - written
+            totals["invalid_isbns"] += sum(
+                1 for book, _ in parsed if book["isbn"] and not book["isbn_valid"]
+            )
+            totals["authors_created"] += created
+            totals["seconds"] = time.perf_counter() - started
+            chunk.clear()
+            if progress is not None:
+                progress(totals)
+
+        for row_count, row in enumerate(read_rows(path, file_format), start=1):
+            if row_count <= already_done:
+                continue
+            try:
+                chunk.append(parse_row(row))
+            except InvalidRow as e:
+                totals["invalid"] += 1
+                chunk.append(None)
+                if totals["invalid"] <= MAX_REPORTED_ERRORS:
+                    click.echo(f"Row {row_count}: skipped, {e}", err=True)
+            if len(chunk) >= chunk_size:
+                flush()
+        flush()
+        with conn.begin():
+            _save_checkpoint(conn, source, row_count, finished=True)
+
+    totals["seconds"] = time.perf_counter() - started
+    # Core inserts bypass the ORM events the page cache listens to.
+    page_cache.invalidate_all()
+    return totals
+
+
+@click.command("import-books")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(["csv", "jsonl"]),
+    help="File format; guessed from the extension by default.",
+)
+@click.option("--chunk-size", default=1000, show_default=True, help="Rows per commit.")
+@click.option(
+    "--on-duplicate",
+    type=click.Choice(["skip", "upsert"]),
+    default="skip",
+    show_default=True,
+    help="What to do with books whose ISBN already exists.",
+)
+@click.option(
+    "--restart",
+    is_flag=True,
+    help="Ignore progress saved by an earlier run over the same file.",
+)
+@with_appcontext
+def import_books_command(path, file_format, chunk_size, on_duplicate, restart):
+    """Import books from a CSV or JSON Lines file (optionally gzipped).
+
+    Columns: title and author_name are required; isbn, publication_date,
+    synopsis, cover_url, rating, author_birth_date and author_death_date are
+    optional. Unknown authors are created. ISBNs are stored as ISBN-13, so a
+    book already stored under its ISBN-10 or ISBN-13 is a duplicate. An
+    interrupted import resumes from its last committed chunk when run again.
+    """
+    last_report = [0.0]
+
+    def report(totals):
+        if totals["seconds"] - last_report[0] >= PROGRESS_INTERVAL:
+            last_report[0] = totals["seconds"]
+            rate = (totals["rows"] - totals["resumed_at"]) / totals["seconds"]
+            click.echo(f"  {totals['rows']} rows ({rate:,.0f} rows/s)")
+
+    totals = import_books(
+        path,
+        file_format=file_format,
+        chunk_size=chunk_size,
+        on_duplicate=on_duplicate,
+        resume=not restart,
+        progress=report,
+    )
+    processed = totals["rows"] - totals["resumed_at"]
+    if not processed:
+        click.echo("Nothing to import; use --restart to import the file again.")
+        return
+    if totals["resumed_at"]:
+        click.echo(f"Resumed after row {totals['resumed_at']}.")
+    rate = processed / totals["seconds"] if totals["seconds"] else 0.0
+    if on_duplicate == "upsert":
+        written = f"{totals['written']} books added or updated"
+    else:
+        written = (
+            f"{totals['written']} books added, "
+            f"{totals['duplicates']} duplicate ISBNs skipped"
+        )
+    click.echo(
+        f"Imported {processed} rows in {totals['seconds']:.1f}s ({rate:,.0f} rows/s): "
+        f"{written}, {totals['invalid']} invalid rows, "
+        f"{totals['invalid_isbns']} invalid ISBNs kept, "
+        f"{totals['authors_created']} authors created."
+    )
+
+
+# --- Export ---
+
+# Exportable columns, in their default order. Names match the import format,
+# so an export can be imported elsewhere.
+EXPORT_COLUMNS = {
+    "id": Book.id,
+    "isbn": Book.isbn,
+    "title": Book.title,
+    "author_name": Author.name,
+    "publication_date": Book.publication_date,
+    "rating": Book.rating,
+    "cover_url": Book.cover_url,
+    "synopsis": Book.synopsis,
+    "author_id": Author.id,
+    "author_birth_date": Author.birth_date,
+    "author_death_date": Author.death_date,
+}
+
+EXPORT_FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+# Rows fetched from the database at a time, and rows per output chunk.
+EXPORT_CHUNK_SIZE = 1000
+
+
+def parse_columns(columns):
+    """Return the column names selected by a comma-separated list.
+
+    An empty selection means every column. Raises ValueError for unknown
+    names.
+    """
+    names = [name.strip() for name in (columns or "").split(",") if name.strip()]
+    unknown = [name for name in names if name not in EXPORT_COLUMNS]
+    if unknown:
+        raise ValueError(
+            f"Unknown columns: {', '.join(unknown)}. "
+            f"Choose from: {', '.join(EXPORT_COLUMNS)}."
+        )
+    return names or list(EXPORT_COLUMNS)
+
+
+def export_rows(columns, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield the catalog as tuples of ``columns``, ordered by book id.
+
+    Only plain column values are selected and fetched ``chunk_size`` at a time,
+    so no ORM objects accumulate in the session.
+    """
+    stmt = (
+        sa.select(*(EXPORT_COLUMNS[name].label(name) for name in columns))
+        .select_from(Book)
+        .join(Author, Author.id == Book.author_id)
+        .order_by(Book.id)
+        .execution_options(yield_per=chunk_size)
+    )
+    yield from db.session.execute(stmt)
+
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+
+def _csv_chunks(rows, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(["" if value is None else value for value in row])
+        if count % EXPORT_CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _jsonl_chunks(rows, columns):
+    lines = []
+    for row in rows:
+        record = dict(zip(columns, (_json_value(value) for value in row)))
+        lines.append(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+        if len(lines) == EXPORT_CHUNK_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_chunks(file_format, columns, compress=False):
+    """Yield the encoded export in chunks: text, or bytes when compressed."""
+    encode = _csv_chunks if file_format == "csv" else _jsonl_chunks
+    chunks = encode(export_rows(columns), columns)
+    if compress:
+        return _gzip_chunks(chunk.encode("utf-8") for chunk in chunks)
+    return chunks
+
+
+def export_books_view():
+    """Stream the catalog: ``?format=csv|jsonl&columns=a,b&gzip=1``."""
+    file_format = request.args.get("format", "csv")
+    if file_format not in EXPORT_FORMATS:
+        abort(400, f"format must be one of: {', '.join(EXPORT_FORMATS)}")
+    try:
+        columns = parse_columns(request.args.get("columns"))
+    except ValueError as e:
+        abort(400, str(e))
+    compress = request.args.get("gzip", "").lower() in ("1", "true", "yes")
+
+    filename = f"books.{file_format}"
+    mimetype = EXPORT_FORMATS[file_format]
+    if compress:
+        filename += ".gz"
+        mimetype = "application/gzip"
+    response = Response(
+        stream_with_context(export_chunks(file_format, columns, compress)),
+        mimetype=mimetype,
+    )
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
+
+
+@click.command("export-books")
+@click.argument("output", type=click.Path(dir_okay=False, allow_dash=True), default="-")
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(list(EXPORT_FORMATS)),
+    help="Output format; guessed from the file name by default.",
+)
+@click.option(
+    "--columns",
+    help=f"Comma-separated columns to export (default: all of "
+    f"{', '.join(EXPORT_COLUMNS)}).",
+)
+@click.option(
+    "--gzip",
+    "compress",
+    is_flag=True,
+    help="Compress the output (implied by a .gz file name).",
+)
+@with_appcontext
+def export_books_command(output, file_format, columns, compress):
+    """Export the catalog as CSV or JSON Lines to OUTPUT (default: stdout)."""
+    try:
+        columns = parse_columns(columns)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--columns")
+    if output != "-":
+        compress = compress or output.endswith(".gz")
+        file_format = file_format or detect_format(output)
+    file_format = file_format or "csv"
+
+    started = time.perf_counter()
+    if output == "-":
+        stream = sys.stdout.buffer if compress else sys.stdout
+        for chunk in export_chunks(file_format, columns, compress):
+            stream.write(chunk)
+        stream.flush()
+        return
+    if compress:
+        f = open(output, "wb")
+    else:
+        f = open(output, "w", encoding="utf-8", newline="")
+    with f:
+        for chunk in export_chunks(file_format, columns, compress):
+            f.write(chunk)
+    click.echo(
+        f"Exported to {output} in {time.perf_counter() - started:.1f}s.", err=True
+    )
+
+
+def init_app(app):
+    app.add_url_rule("/export/books", "export_books", export_books_view)
+    app.cli.add_command(import_books_command)
+    app.cli.add_command(export_books_command)
@@ -0,0 +1,131 @@
+"""Circuit breakers for the metadata providers.
+
+Each provider client records whether its requests failed (connection
+errors, timeouts, 429 and 5xx responses). When the failures in the last
+``window`` seconds reach ``failure_ratio`` of at least ``min_requests``
+requests, the breaker opens: requests to that provider fail at once instead
+of waiting for a timeout. After ``open_seconds`` it is half-open and lets
+one probe request through; a success closes it again and a failure opens it
+for another ``open_seconds``.
+"""
+
+import threading
+import time
+from collections import deque
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATES = (CLOSED, HALF_OPEN, OPEN)
+
+
+class CircuitBreaker:
+    """Thread-safe breaker over a sliding window of request outcomes."""
+
+    def __init__(
+        self,
+        window=60,
+        min_requests=10,
+        failure_ratio=0.5,
+        open_seconds=30,
+        half_open_probes=1,
+    ):
+        self.window = window
+        self.min_requests = min_requests
+        self.failure_ratio = failure_ratio
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.state = CLOSED
+        self.trips = 0
+        self.rejections = 0
+        self._lock = threading.Lock()
+        # (monotonic time, failed) for each request in the window.
+        self._outcomes = deque()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+
+    def _trim(self, now):
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            _, failed = self._outcomes.popleft()
+            self._failures -= failed
+
+    def _open(self, now):
+        self.state = OPEN
+        self._opened_at = now
+        self.trips += 1
+        self._outcomes.clear()
+        self._failures = 0
+
+    def is_open(self):
+        """Return True while requests are being rejected outright."""
+        with self._lock:
+            return (
+                self.state == OPEN
+                and time.monotonic() - self._opened_at < self.open_seconds
+            )
+
+    def allow(self):
+        """Return True if a request may be sent now.
+
+        Every allowed request must be followed by record().
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.state == OPEN:
+                if now - self._opened_at < self.open_seconds:
+                    self.rejections += 1
+                    return False
+                self.state = HALF_OPEN
+                self._probes = 0
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_probes:
+                    self.rejections += 1
+                    return False
+                self._probes += 1
+            return True
+
+    def record(self, failed):
+        """Record the outcome of an allowed request."""
+        now = time.monotonic()
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probes -= 1
+                if failed:
+                    self._open(now)
+                else:
+                    self.state = CLOSED
+                return
+            if self.state == OPEN:
+                # A request sent before the breaker opened.
+                return
+            self._outcomes.append((now, failed))
+            self._failures += failed
+            self._trim(now)
+            requests = len(self._outcomes)
+            if (
+                requests >= self.min_requests
+                and self._failures >= self.failure_ratio * requests
+            ):
+                self._open(now)
+
+    def snapshot(self):
+        with self._lock:
+            self._trim(time.monotonic())
+            return {
+                "state": self.state,
+                "trips": self.trips,
+                "rejections": self.rejections,
+                "window_requests": len(self._outcomes),
+                "window_failures": self._failures,
+            }
+
+
+def breaker_from_config(config):
+    """Build a CircuitBreaker from app config, or None when disabled."""
+    if not config.get("PROVIDER_BREAKER_ENABLED", True):
+        return None
+    return CircuitBreaker(
+        window=config["PROVIDER_BREAKER_WINDOW"],
+        min_requests=config["PROVIDER_BREAKER_MIN_REQUESTS"],
+        failure_ratio=config["PROVIDER_BREAKER_FAILURE_RATIO"],
+        open_seconds=config["PROVIDER_BREAKER_OPEN_SECONDS"],
+    )
@@ -0,0 +1,315 @@
+"""Local store of book cover images.
+
+Each cover is downloaded once and saved under a name derived from a hash of
+its content, so identical covers share files and a file's content never
+changes. That lets ``/covers/<name>`` be served with far-future cache headers.
+
+With Pillow installed, every cover is stored as one JPEG thumbnail per size
+in COVER_SIZES (``<hash>-<size>.jpg``) and ``Book.cover_file`` holds the
+bare hash. Without it, the original image is stored as ``<hash>.<ext>`` and
+used for every size.
+"""
+
+import hashlib
+import io
+import mimetypes
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import click
+from flask import current_app, send_from_directory, url_for
+from flask.cli import with_appcontext
+
+from data_models import db, Book
+from helpers import _download_image
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; covers are then stored unresized.
+    Image = None
+
+DEFAULT_CONFIG = {
+    "COVER_STORE_ENABLED": True,
+    "COVER_STORE_DIR": os.path.join(
+        os.path.abspath(os.path.dirname(__file__)), "static", "covers"
+    ),
+    # Thumbnail bounding boxes (width, height) by name.
+    "COVER_SIZES": {"thumb": (200, 300), "detail": (400, 600)},
+    "COVER_JPEG_QUALITY": 85,
+    "COVER_MAX_BYTES": 5 * 1024 * 1024,
+    "COVER_CACHE_MAX_AGE": 365 * 24 * 3600,
+}
+
+
+def _store_dir():
+    return current_app.config["COVER_STORE_DIR"]
+
+
+def variant_filename(cover_file, size):
+    """Return the file name holding ``cover_file`` at ``size``."""
+    if "." in cover_file:
+        # Stored without Pillow: one unresized file for every size.
+        return cover_file
+    return f"{cover_file}-{size}.jpg"
+
+
+def cover_src(book, size):
+    """Return the URL to show for a book's cover, or None if it has none.
+
+    ``book`` may be a Book or a dict with ``cover_file`` and ``cover_url``.
+    The local copy is preferred; the remote URL is used until one exists.
+    """
+    if isinstance(book, dict):
+        cover_file, cover_url = book.get("cover_file"), book.get("cover_url")
+    else:
+        cover_file, cover_url = book.cover_file, book.cover_url
+    if cover_file and current_app.config["COVER_STORE_ENABLED"]:
+        return url_for("cover_image", filename=variant_filename(cover_file, size))
+    return cover_url
+
+
+def needs_local_cover(book):
+    """Return True if the book has a remote cover that is not stored yet."""
+    return (
+        current_app.config["COVER_STORE_ENABLED"]
+        and bool(book.cover_url)
+        and not book.cover_file
+    )
+
+
+def _write_atomic(path, content):
+    # A unique temp name, as several threads may save the same cover at once.
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(content)
+        os.replace(temp_path, path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _thumbnails(content, sizes, quality):
+    """Return ``{size: jpeg_bytes}`` for an image, or None if it is unreadable."""
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            image = image.convert("RGB")
+            thumbnails = {}
+            for size, box in sizes.items():
+                thumbnail = image.copy()
+                thumbnail.thumbnail(box)
+                output = io.BytesIO()
+                thumbnail.save(
+                    output, "JPEG", quality=quality, optimize=True, progressive=True
+                )
+                thumbnails[size] = output.getvalue()
+            return thumbnails
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def save_cover(content, content_type, config):
+    """Write a downloaded cover to the store and return its cover_file key.
+
+    Returns None if the image cannot be decoded. Files that already exist are
+    left alone, since their content is identified by the name.
+    """
+    digest = hashlib.sha256(content).hexdigest()[:32]
+    store_dir = config["COVER_STORE_DIR"]
+    os.makedirs(store_dir, exist_ok=True)
+
+    if Image is None:
+        extension = mimetypes.guess_extension(content_type) or ".img"
+        cover_file = f"{digest}{extension}"
+        path = os.path.join(store_dir, cover_file)
+        if not os.path.exists(path):
+            _write_atomic(path, content)
+        return cover_file
+
+    sizes = config["COVER_SIZES"]
+    if all(
+        os.path.exists(os.path.join(store_dir, variant_filename(digest, size)))
+        for size in sizes
+    ):
+        return digest
+    thumbnails = _thumbnails(content, sizes, config["COVER_JPEG_QUALITY"])
+    if thumbnails is None:
+        return None
+    for size, data in thumbnails.items():
+        _write_atomic(os.path.join(store_dir, variant_filename(digest, size)), data)
+    return digest
+
+
+def _download_and_save(cover_url, config):
+    downloaded = _download_image(cover_url, config["COVER_MAX_BYTES"])
+    if downloaded is None:
+        return None
+    return save_cover(*downloaded, config)
+
+
+def store_covers(books, max_workers=8, timeout=None):
+    """Download and store the covers of ``books`` that have no local copy.
+
+    Downloads run concurrently, through the cover download client. Sets
+    ``cover_file`` on each stored book; the caller commits. Downloads still
+    running after ``timeout`` seconds are not waited for; their files are
+    left to collect_garbage(). Returns the books whose cover was stored.
+    """
+    books = [book for book in books if needs_local_cover(book)]
+    if not books:
+        return []
+    config = current_app.config
+    executor = ThreadPoolExecutor(
+        max_workers=min(max_workers, len(books)), thread_name_prefix="covers"
+    )
+    try:
+        futures = [
+            executor.submit(_download_and_save, book.cover_url, config)
+            for book in books
+        ]
+        done, _ = wait(futures, timeout=timeout)
+    finally:
+        executor.shutdown(wait=timeout is None, cancel_futures=True)
+    stored = []
+    for book, future in zip(books, futures):
+        if future not in done:
+            continue
+        # One failed cover only skips its own book.
+        try:
+            cover_file = future.result()
+        except Exception as e:
+            print(f"Error storing cover {book.cover_url}: {e}")
+            continue
+        if cover_file:
+            book.cover_file = cover_file
+            stored.append(book)
+    return stored
+
+
+# --- Garbage collection ---
+
+
+def _files_for(cover_file):
+    return {
+        variant_filename(cover_file, size) for size in current_app.config["COVER_SIZES"]
+    }
+
+
+def _remove_files(names):
+    removed = 0
+    for name in names:
+        try:
+            os.remove(os.path.join(_store_dir(), name))
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def release_covers(cover_files):
+    """Delete the stored files of covers that no book uses any more.
+
+    Call after committing the change that dropped the references. Returns the
+    number of files removed.
+    """
+    cover_files = {cover_file for cover_file in cover_files if cover_file}
+    if not cover_files:
+        return 0
+    in_use = set(
+        db.session.scalars(
+            db.select(Book.cover_file).where(Book.cover_file.in_(cover_files))
+        )
+    )
+    removed = 0
+    for cover_file in cover_files - in_use:
+        removed += _remove_files(_files_for(cover_file))
+    return removed
+
+
+def collect_garbage(min_age=3600):
+    """Delete every file in the store that no book refers to.
+
+    Files younger than ``min_age`` seconds are kept, as a worker may not have
+    committed the book that uses them yet. Returns the number of files
+    removed.
+    """
+    try:
+        names = os.listdir(_store_dir())
+    except FileNotFoundError:
+        return 0
+    in_use = set(
+        db.session.scalars(
+            db.select(Book.cover_file).where(Book.cover_file.isnot(None))
+        )
+    )
+    cutoff = time.time() - min_age
+    orphans = []
+    for name in names:
+        # "<hash>-<size>.jpg" with Pillow, "<hash>.<ext>" without.
+        key = name.split("-")[0] if "-" in name else name
+        if key in in_use or name.endswith(".tmp"):
+            continue
+        if os.path.getmtime(os.path.join(_store_dir(), name)) < cutoff:
+            orphans.append(name)
+    return _remove_files(orphans)
+
+
+# --- Serving ---
+
+
+def cover_image(filename):
+    """Serve a stored cover. Names change with content, so caching is forever."""
+    response = send_from_directory(
+        _store_dir(), filename, max_age=current_app.config["COVER_CACHE_MAX_AGE"]
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+# --- CLI ---
+
+
+@click.command("covers-store")
+@click.option("--workers", default=8, show_default=True, help="Parallel downloads.")
+@with_appcontext
+def covers_store_command(workers):
+    """Download local copies of every remote cover not stored yet."""
+    stored = 0
+    last_id = 0
+    while True:
+        books = (
+            Book.query.filter(
+                Book.id > last_id,
+                Book.cover_url.isnot(None),
+                Book.cover_file.is_(None),
+            )
+            .order_by(Book.id)
+            .limit(100)
+            .all()
+        )
+        if not books:
+            break
+        last_id = books[-1].id
+        stored += len(store_covers(books, max_workers=workers))
+        db.session.commit()
+    click.echo(f"Stored {stored} covers.")
+
+
+@click.command("covers-gc")
+@with_appcontext
+def covers_gc_command():
+    """Delete stored cover files that no book uses."""
+    click.echo(f"Removed {collect_garbage()} unused cover files.")
+
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    app.add_url_rule("/covers/<path:filename>", "cover_image", cover_image)
+    app.add_template_global(cover_src)
+    app.cli.add_command(covers_store_command)
+    app.cli.add_command(covers_gc_command)
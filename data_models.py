@@ -1,7 +1,11 @@
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
 
+# Current UTC time as SQLite text in a format SQLAlchemy's DateTime reads.
+SQL_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
 
 class Author(db.Model):
     __tablename__ = "authors"
@@ -9,10 +13,17 @@ class Author(db.Model):
     name = db.Column(db.String(100), nullable=False)
     birth_date = db.Column(db.Date, nullable=True)
     death_date = db.Column(db.Date, nullable=True)
-    bio = db.Column(db.Text, nullable=True)
+    # Deferred, like Book.synopsis: only the author page shows it.
+    bio = db.deferred(db.Column(db.Text, nullable=True))
+    # Bumped by triggers (see row_versions.py) whenever the author or any of
+    # their books changes.
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    updated_at = db.Column(db.DateTime, nullable=True, info={"backfill": SQL_NOW})
     books = db.relationship(
         "Book", back_populates="author", lazy=True, cascade="all, delete-orphan"
     )
+    # Maintained by triggers (see author_stats.py), never written by the ORM.
+    stats = db.relationship("AuthorStats", uselist=False, lazy=True, viewonly=True)
 
     def __repr__(self):
         return f"<Author {self.name}>"
@@ -23,17 +34,150 @@ class Author(db.Model):
 
 class Book(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    # Canonical ISBN-13 when valid (see isbns.py); isbn_valid is NULL until
+    # the ISBN has been checked.
     isbn = db.Column(db.String(13), unique=True, nullable=True)
+    isbn_valid = db.Column(db.Boolean, nullable=True)
     title = db.Column(db.String(120), nullable=False)
     publication_date = db.Column(db.Date, nullable=True)
     author_id = db.Column(db.Integer, db.ForeignKey("authors.id"), nullable=False)
-    synopsis = db.Column(db.Text, nullable=True)
+    # Large text that only the detail page shows, so it is not loaded with
+    # the rest of the row; use db.undefer(Book.synopsis) to load it eagerly.
+    synopsis = db.deferred(db.Column(db.Text, nullable=True))
     cover_url = db.Column(db.String(255), nullable=True)
+    # Content-hash key of the locally stored copy of the cover (see covers.py).
+    cover_file = db.Column(db.String(64), nullable=True)
     rating = db.Column(db.Integer, nullable=True)
+    # Bumped by triggers (see row_versions.py) whenever the book changes.
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    updated_at = db.Column(db.DateTime, nullable=True, info={"backfill": SQL_NOW})
     author = db.relationship("Author", back_populates="books")
+    enrichment_job = db.relationship(
+        "EnrichmentJob", uselist=False, lazy=True, cascade="all, delete-orphan"
+    )
+    enrichment_state = db.relationship(
+        "BookEnrichmentState",
+        uselist=False,
+        lazy=True,
+        cascade="all, delete-orphan",
+    )
 
     def __repr__(self):
         return f"<Book {self.title}>"
 
     def __str__(self):
         return super().__str__()
+
+
+# Indexes for the listing sorts and the author join. Sort columns are indexed
+# together with the primary key so that keyset pagination is a single index
+# range scan. Existing databases get them from migrations.upgrade_schema().
+db.Index("ix_book_title_nocase", Book.title.collate("nocase"), Book.id)
+db.Index("ix_book_author_id", Book.author_id, Book.id)
+
+# Non-null sort keys for the nullable rating and publication date, one per
+# direction, so that unrated and undated books come last either way and a
+# keyset cursor never holds a NULL. Ratings are 1-10. Queries must use these
+# exact expressions for SQLite to match them to the expression indexes.
+RATING_ASC_KEY = db.func.coalesce(Book.rating, db.literal_column("11"))
+RATING_DESC_KEY = db.func.coalesce(Book.rating, db.literal_column("0"))
+PUBLISHED_ASC_KEY = db.func.coalesce(
+    Book.publication_date, db.literal_column("'9999-12-31'"), type_=db.String
+)
+PUBLISHED_DESC_KEY = db.func.coalesce(
+    Book.publication_date, db.literal_column("''"), type_=db.String
+)
+db.Index("ix_book_rating_asc", RATING_ASC_KEY, Book.id)
+db.Index("ix_book_rating_desc", RATING_DESC_KEY, Book.id)
+db.Index("ix_book_published_asc", PUBLISHED_ASC_KEY, Book.id)
+db.Index("ix_book_published_desc", PUBLISHED_DESC_KEY, Book.id)
+db.Index("ix_authors_name_nocase", Author.name.collate("nocase"), Author.id)
+# Lets cover garbage collection check whether a stored file is still used.
+db.Index("ix_book_cover_file", Book.cover_file)
+# Finds books with invalid or not yet checked ISBNs (see isbns.py).
+db.Index("ix_book_isbn_valid", Book.isbn_valid, Book.id)
+# Finds an author's latest publication when author_stats must recompute it.
+db.Index("ix_book_author_publication", Book.author_id, Book.publication_date)
+
+
+class AuthorStats(db.Model):
+    """Aggregates over an author's books, kept up to date by triggers."""
+
+    __tablename__ = "author_stats"
+    author_id = db.Column(db.Integer, db.ForeignKey("authors.id"), primary_key=True)
+    book_count = db.Column(db.Integer, nullable=False, default=0)
+    rated_count = db.Column(db.Integer, nullable=False, default=0)
+    # Sum of the ratings of the rated books, so the average stays exact.
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    latest_publication = db.Column(db.Date, nullable=True)
+
+    @property
+    def average_rating(self):
+        if not self.rated_count:
+            return None
+        return self.rating_sum / self.rated_count
+
+    def __repr__(self):
+        return f"<AuthorStats author={self.author_id} books={self.book_count}>"
+
+
+class LibraryState(db.Model):
+    """A single row whose version changes with any book or author."""
+
+    __tablename__ = "library_state"
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+
+class EnrichmentJob(db.Model):
+    """A queued request to fetch missing cover/synopsis data for a book."""
+
+    __tablename__ = "enrichment_jobs"
+    id = db.Column(db.Integer, primary_key=True)
+    book_id = db.Column(
+        db.Integer, db.ForeignKey("book.id"), nullable=False, unique=True
+    )
+    # One of "pending", "running", "done" or "failed".
+    status = db.Column(db.String(16), nullable=False, default="pending", index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    enqueued_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
+    def __repr__(self):
+        return f"<EnrichmentJob book={self.book_id} {self.status}>"
+
+
+class BookEnrichmentState(db.Model):
+    """Metadata lookup history for a book, used to back off failed lookups."""
+
+    __tablename__ = "book_enrichment_state"
+    book_id = db.Column(db.Integer, db.ForeignKey("book.id"), primary_key=True)
+    last_attempt_at = db.Column(db.DateTime, nullable=True)
+    # Consecutive attempts that left the book without a cover or synopsis.
+    attempt_count = db.Column(db.Integer, nullable=False, default=0)
+    # JSON object mapping each provider lookup to "hit", "miss" or "error".
+    provider_outcomes = db.Column(db.Text, nullable=True)
+    next_eligible_at = db.Column(db.DateTime, nullable=True, index=True)
+
+    def __repr__(self):
+        return (
+            f"<BookEnrichmentState book={self.book_id} attempts={self.attempt_count}>"
+        )
+
+
+class ImportCheckpoint(db.Model):
+    """Progress of a bulk import, so an interrupted one can resume."""
+
+    __tablename__ = "import_checkpoints"
+    # Absolute path, size and modification time of the imported file.
+    source = db.Column(db.String(512), primary_key=True)
+    rows_done = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<ImportCheckpoint {self.source} rows={self.rows_done}>"
@@ -0,0 +1,607 @@
+"""Background enrichment of book covers and synopses.
+
+Books that are missing metadata are queued in the ``enrichment_jobs`` table
+and processed by a pool of workers, so page requests never wait on the
+external metadata providers.
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app, flash
+from flask.cli import with_appcontext
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.dialects.sqlite import insert
+
+from covers import needs_local_cover, store_covers
+from data_models import db, Book, EnrichmentJob
+from metadata_pipeline import METADATA_PROVIDERS
+from helpers import (
+    PROVIDER_CONFIG_DEFAULTS,
+    BookListing,
+    _books_in_backoff,
+    _configure_providers,
+    _fetch_metadata_for_books,
+    _needs_metadata,
+    _provider_stats,
+    _reset_lookup_backoff,
+    _update_db_if_needed,
+)
+
+DEFAULT_CONFIG = {
+    # "background" queues work for the worker pool, "inline" fetches metadata
+    # while rendering the page (the original behaviour).
+    "ENRICHMENT_MODE": "background",
+    # Seconds an "inline" page request may spend on metadata and covers;
+    # books not resolved by then render without them. None waits for all.
+    "ENRICHMENT_REQUEST_BUDGET": 2.0,
+    "ENRICHMENT_WORKERS": 8,
+    # "thread" or "process"
+    "ENRICHMENT_WORKER_TYPE": "thread",
+    "ENRICHMENT_THREADS_PER_PROCESS": 4,
+    "ENRICHMENT_BATCH_SIZE": 50,
+    "ENRICHMENT_POLL_INTERVAL": 5.0,
+    # Seconds after which a "running" job is considered abandoned.
+    "ENRICHMENT_JOB_TIMEOUT": 300,
+    # Seconds before a finished job may be queued again for the same book.
+    "ENRICHMENT_REQUEUE_AFTER": 3600,
+    # Books that stay unresolved are retried after BASE * 2 ** (attempts - 1)
+    # seconds, up to MAX.
+    "ENRICHMENT_BACKOFF_BASE": 3600,
+    "ENRICHMENT_BACKOFF_MAX": 30 * 24 * 3600,
+}
+
+ENQUEUE_CHUNK_SIZE = 500
+
+
+class EnrichmentMetrics:
+    """Thread-safe throughput counters for the workers of this process."""
+
+    def __init__(self, window=60):
+        self._lock = threading.Lock()
+        self._window = window
+        self._recent = deque()
+        self.processed = 0
+        self.updated = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+
+    def record(self, jobs, duration, updated=0, failed=0):
+        now = time.monotonic()
+        with self._lock:
+            self.processed += jobs
+            self.updated += updated
+            self.failed += failed
+            self.busy_seconds += duration
+            self._recent.append((now, jobs))
+            self._trim(now)
+
+    def _trim(self, now):
+        while self._recent and now - self._recent[0][0] > self._window:
+            self._recent.popleft()
+
+    def snapshot(self):
+        with self._lock:
+            self._trim(time.monotonic())
+            return {
+                "processed": self.processed,
+                "updated": self.updated,
+                "failed": self.failed,
+                "avg_job_seconds": (
+                    self.busy_seconds / self.processed if self.processed else 0.0
+                ),
+                "jobs_per_minute": (
+                    sum(jobs for _, jobs in self._recent) * 60.0 / self._window
+                ),
+            }
+
+
+# --- Queue operations (require an app context) ---
+
+
+def enqueue_books(book_ids, force=False):
+    """Queue enrichment jobs for the given book ids.
+
+    Books that already have a pending or running job are left alone, and
+    finished jobs are only re-queued once ENRICHMENT_REQUEUE_AFTER has passed
+    (or straight away with ``force``).
+    Returns the number of jobs that were added or re-queued.
+    """
+    book_ids = list(dict.fromkeys(book_ids))
+    if not book_ids:
+        return 0
+
+    now = datetime.utcnow()
+    requeue_before = now - timedelta(
+        seconds=current_app.config["ENRICHMENT_REQUEUE_AFTER"]
+    )
+    # Read first which books are already taken care of, so that a page whose
+    # books are all queued or recently enriched does not take the write lock.
+    settled = EnrichmentJob.status.in_(("pending", "running"))
+    if not force:
+        settled = or_(settled, EnrichmentJob.finished_at >= requeue_before)
+    skipped = set()
+    for start in range(0, len(book_ids), ENQUEUE_CHUNK_SIZE):
+        chunk = book_ids[start : start + ENQUEUE_CHUNK_SIZE]
+        skipped.update(
+            db.session.scalars(
+                select(EnrichmentJob.book_id).where(
+                    EnrichmentJob.book_id.in_(chunk), settled
+                )
+            )
+        )
+    book_ids = [book_id for book_id in book_ids if book_id not in skipped]
+    if not book_ids:
+        return 0
+
+    queued = 0
+    # The queue is written on its own connection: committing the session
+    # would expire the Book objects the calling page is still rendering.
+    with db.engine.begin() as conn:
+        for start in range(0, len(book_ids), ENQUEUE_CHUNK_SIZE):
+            chunk = book_ids[start : start + ENQUEUE_CHUNK_SIZE]
+            stmt = insert(EnrichmentJob).values(
+                [
+                    {"book_id": book_id, "status": "pending", "enqueued_at": now}
+                    for book_id in chunk
+                ]
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[EnrichmentJob.book_id],
+                set_={"status": "pending", "enqueued_at": now, "last_error": None},
+                where=and_(
+                    EnrichmentJob.status.in_(("done", "failed")),
+                    True if force else EnrichmentJob.finished_at < requeue_before,
+                ),
+            )
+            queued += conn.execute(stmt).rowcount
+
+    if queued:
+        get_worker_pool().wake()
+    return queued
+
+
+def claim_jobs(limit):
+    """Atomically mark up to ``limit`` pending jobs as running.
+
+    Jobs left "running" for longer than ENRICHMENT_JOB_TIMEOUT (for example
+    by a worker process that died) are claimed again.
+    Returns a list of ``(job_id, book_id)`` tuples.
+    """
+    now = datetime.utcnow()
+    stale_before = now - timedelta(seconds=current_app.config["ENRICHMENT_JOB_TIMEOUT"])
+    claimable = (
+        select(EnrichmentJob.id)
+        .where(
+            or_(
+                EnrichmentJob.status == "pending",
+                and_(
+                    EnrichmentJob.status == "running",
+                    EnrichmentJob.started_at < stale_before,
+                ),
+            )
+        )
+        .order_by(EnrichmentJob.id)
+        .limit(limit)
+    )
+    stmt = (
+        update(EnrichmentJob)
+        .where(EnrichmentJob.id.in_(claimable.scalar_subquery()))
+        .values(
+            status="running",
+            started_at=now,
+            attempts=EnrichmentJob.attempts + 1,
+        )
+        .returning(EnrichmentJob.id, EnrichmentJob.book_id)
+        .execution_options(synchronize_session=False)
+    )
+    rows = db.session.execute(stmt).all()
+    db.session.commit()
+    return [tuple(row) for row in rows]
+
+
+def _finish_jobs(job_ids, error=None):
+    """Mark claimed jobs as done, or as failed with the given error."""
+    db.session.execute(
+        update(EnrichmentJob)
+        .where(EnrichmentJob.id.in_(job_ids))
+        .values(
+            status="failed" if error else "done",
+            finished_at=datetime.utcnow(),
+            last_error=error,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+def queue_depth():
+    """Return the number of jobs in each status."""
+    counts = dict.fromkeys(("pending", "running", "done", "failed"), 0)
+    rows = db.session.execute(
+        select(EnrichmentJob.status, func.count()).group_by(EnrichmentJob.status)
+    )
+    counts.update({status: count for status, count in rows})
+    return counts
+
+
+def enrichment_stats():
+    """Return queue depth and worker throughput metrics."""
+    return {"queue": queue_depth(), "workers": get_worker_pool().metrics.snapshot()}
+
+
+# --- Job execution ---
+
+
+def _load_books_for_lookup(book_ids):
+    """Load the books a metadata lookup reads, with their synopses."""
+    return (
+        Book.query.options(db.joinedload(Book.author), db.undefer(Book.synopsis))
+        .filter(Book.id.in_(book_ids))
+        .all()
+    )
+
+
+def _enrich_books(book_ids, max_workers):
+    """Fetch missing metadata for a group of books and store it.
+
+    Returns the number of books that were updated.
+    """
+    books = _load_books_for_lookup(book_ids)
+    results = _fetch_metadata_for_books(books, max_workers=max_workers)
+    updated = set()
+    for book in books:
+        if book.id in results and _update_db_if_needed(book, *results[book.id]):
+            updated.add(book.id)
+    updated.update(book.id for book in store_covers(books, max_workers=max_workers))
+    db.session.commit()
+    return len(updated)
+
+
+def _run_jobs(jobs, max_workers):
+    """Process a group of claimed jobs inside the current app context."""
+    started = time.perf_counter()
+    updated = 0
+    error = None
+    try:
+        updated = _enrich_books([book_id for _, book_id in jobs], max_workers)
+    except Exception as e:
+        db.session.rollback()
+        error = f"{type(e).__name__}: {e}"
+    _finish_jobs([job_id for job_id, _ in jobs], error)
+    return updated, error, time.perf_counter() - started
+
+
+_process_app = None
+
+
+def _init_process_worker():
+    """Load the Flask app in a worker process and drop inherited connections."""
+    global _process_app
+    from app import app
+
+    _process_app = app
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def _run_jobs_in_process(jobs, max_workers):
+    with _process_app.app_context():
+        return _run_jobs(jobs, max_workers)
+
+
+class EnrichmentWorkerPool:
+    """A pool of thread or process workers that drains the enrichment queue.
+
+    Jobs are claimed in batches. With thread workers a batch is resolved by
+    the concurrent batch lookup in helpers, using ``workers`` threads; with
+    process workers the batch is split between ``workers`` processes.
+
+    ``drain()`` processes the queue in the calling thread until it is empty.
+    ``start()`` runs a daemon dispatcher thread that keeps polling the queue,
+    which is how the web process enriches books in the background.
+    """
+
+    def __init__(self, app, workers=None, worker_type=None):
+        self.app = app
+        self.workers = workers or app.config["ENRICHMENT_WORKERS"]
+        self.worker_type = worker_type or app.config["ENRICHMENT_WORKER_TYPE"]
+        self.batch_size = max(app.config["ENRICHMENT_BATCH_SIZE"], self.workers)
+        self.poll_interval = app.config["ENRICHMENT_POLL_INTERVAL"]
+        self.metrics = EnrichmentMetrics()
+        self._executor = None
+        self._dispatcher = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init_process_worker
+            )
+        return self._executor
+
+    def _process(self, jobs):
+        """Run claimed jobs and record their metrics."""
+        if self.worker_type != "process":
+            with self.app.app_context():
+                outcomes = [_run_jobs(jobs, self.workers)]
+            groups = [jobs]
+        else:
+            # Provider lookups are I/O bound, so each process still resolves
+            # its share of the batch with a few threads.
+            threads = max(1, self.app.config["ENRICHMENT_THREADS_PER_PROCESS"])
+            groups = [jobs[i :: self.workers] for i in range(self.workers)]
+            groups = [group for group in groups if group]
+            futures = [
+                self._get_executor().submit(_run_jobs_in_process, group, threads)
+                for group in groups
+            ]
+            outcomes = []
+            for future in futures:
+                try:
+                    outcomes.append(future.result())
+                except Exception as e:
+                    # The worker process itself failed; its jobs stay
+                    # "running" and are reclaimed after ENRICHMENT_JOB_TIMEOUT.
+                    outcomes.append((0, str(e), 0.0))
+        for group, (updated, error, duration) in zip(groups, outcomes):
+            self.metrics.record(
+                len(group),
+                duration,
+                updated=updated,
+                failed=len(group) if error else 0,
+            )
+
+    def run_batch(self):
+        """Claim one batch of jobs and wait for it to finish.
+
+        Returns the number of jobs processed.
+        """
+        with self.app.app_context():
+            jobs = claim_jobs(self.batch_size)
+        if jobs:
+            self._process(jobs)
+        return len(jobs)
+
+    def drain(self):
+        """Process jobs until the queue is empty. Returns the job count."""
+        total = 0
+        while True:
+            processed = self.run_batch()
+            if not processed:
+                return total
+            total += processed
+
+    def start(self):
+        """Start the background dispatcher thread if it is not running."""
+        with self._lock:
+            if self._dispatcher and self._dispatcher.is_alive():
+                return
+            self._stopping.clear()
+            self._dispatcher = threading.Thread(
+                target=self._dispatch_loop,
+                name="enrichment-dispatcher",
+                daemon=True,
+            )
+            self._dispatcher.start()
+
+    def wake(self):
+        """Tell the dispatcher that new jobs are waiting."""
+        self._wakeup.set()
+
+    def stop(self, wait=True):
+        self._stopping.set()
+        self._wakeup.set()
+        if wait and self._dispatcher:
+            self._dispatcher.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    def _dispatch_loop(self):
+        while not self._stopping.is_set():
+            try:
+                processed = self.run_batch()
+            except Exception as e:
+                print(f"Enrichment dispatcher error: {e}")
+                processed = 0
+            if not processed:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+
+def get_worker_pool(app=None):
+    """Return the shared worker pool for the app, creating it if needed."""
+    app = app or current_app._get_current_object()
+    pool = app.extensions.get("enrichment")
+    if pool is None:
+        pool = app.extensions["enrichment"] = EnrichmentWorkerPool(app)
+    return pool
+
+
+# --- Request path helpers ---
+
+
+def schedule_enrichment(books):
+    """Arrange for missing metadata on ``books`` to be fetched.
+
+    In "background" mode the books are queued and the worker pool is started;
+    nothing blocks on the providers. In "inline" mode the metadata is fetched
+    and saved before returning.
+
+    ``books`` are Book or BookListing rows.
+    """
+    if current_app.config["ENRICHMENT_MODE"] == "inline":
+        _enrich_books_inline(books)
+        return
+    pending = [
+        book.id for book in books if _needs_metadata(book) or needs_local_cover(book)
+    ]
+    if pending:
+        backing_off = _books_in_backoff(pending)
+        pending = [book_id for book_id in pending if book_id not in backing_off]
+    if pending:
+        get_worker_pool().start()
+        enqueue_books(pending)
+
+
+def _enrich_books_inline(rows):
+    """Fetch and commit missing metadata for ``rows`` synchronously.
+
+    The books that need metadata are loaded in full, and BookListing rows
+    are updated with what was found. Spends at most ENRICHMENT_REQUEST_BUDGET
+    seconds waiting on providers.
+    """
+    pending = [row.id for row in rows if _needs_metadata(row) or needs_local_cover(row)]
+    if not pending:
+        return
+    books = _load_books_for_lookup(pending)
+    budget = current_app.config["ENRICHMENT_REQUEST_BUDGET"]
+    deadline = time.monotonic() + budget if budget else None
+    max_workers = current_app.config["ENRICHMENT_WORKERS"]
+    results = _fetch_metadata_for_books(books, max_workers=max_workers, budget=budget)
+    updated_books = False
+    for book in books:
+        if book.id in results and _update_db_if_needed(book, *results[book.id]):
+            updated_books = True
+    if deadline is None:
+        stored = store_covers(books, max_workers=max_workers)
+    elif deadline > time.monotonic():
+        stored = store_covers(
+            books, max_workers=max_workers, timeout=deadline - time.monotonic()
+        )
+    else:
+        stored = []
+    if stored:
+        updated_books = True
+    # Read before committing, which expires the loaded books.
+    found = {
+        book.id: (book.cover_url, book.cover_file, bool(book.synopsis))
+        for book in books
+    }
+
+    if updated_books:
+        try:
+            db.session.commit()
+            print("Committed updated cover URLs and/or synopses to database.")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error committing updates: {e}")
+            flash("Error saving updated book details to the database.", "error")
+            return
+
+    for row in rows:
+        if isinstance(row, BookListing) and row.id in found:
+            row.cover_url, row.cover_file, row.has_synopsis = found[row.id]
+
+
+# --- CLI ---
+
+
+@click.command("enrich-drain")
+@click.option("--workers", type=int, default=None, help="Number of workers.")
+@click.option(
+    "--worker-type",
+    type=click.Choice(["thread", "process"]),
+    default=None,
+    help="Run jobs in threads or in separate processes.",
+)
+@click.option(
+    "--enqueue-missing",
+    is_flag=True,
+    help="First queue every book that lacks a cover or synopsis.",
+)
+@with_appcontext
+def enrich_drain_command(workers, worker_type, enqueue_missing):
+    """Process every queued enrichment job, then report throughput."""
+    if enqueue_missing:
+        missing = db.session.scalars(
+            select(Book.id).where(
+                or_(Book.cover_url.is_(None), Book.synopsis.is_(None))
+            )
+        )
+        click.echo(f"Queued {enqueue_books(missing)} books.")
+
+    pool = EnrichmentWorkerPool(
+        current_app._get_current_object(), workers=workers, worker_type=worker_type
+    )
+    started = time.perf_counter()
+    try:
+        processed = pool.drain()
+    finally:
+        pool.stop()
+    elapsed = time.perf_counter() - started
+    stats = pool.metrics.snapshot()
+    rate = processed / elapsed if elapsed else 0.0
+    click.echo(
+        f"Processed {processed} jobs in {elapsed:.1f}s ({rate:.2f} jobs/s): "
+        f"{stats['updated']} updated, {stats['failed']} failed."
+    )
+    # Worker processes keep their own clients, so only report thread runs.
+    if pool.worker_type != "process":
+        for name, conn in _provider_stats().items():
+            click.echo(
+                f"{name}: {conn['requests']} requests over "
+                f"{conn['connections']} connections "
+                f"({conn['reuse_ratio']:.0%} reused, "
+                f"~{conn['saved_connect_seconds']:.1f}s of handshakes saved)."
+            )
+        for name, lookups in METADATA_PROVIDERS.stats().items():
+            if not lookups["lookups"]:
+                continue
+            click.echo(
+                f"{name}: {lookups['lookups']} lookups, "
+                f"{lookups['success_rate']:.0%} hits, "
+                f"{lookups['errors']} errors, {lookups['skipped']} skipped, "
+                f"{lookups['mean_seconds'] * 1000:.0f}ms mean, "
+                f"{lookups['answers']} fields answered first."
+            )
+        click.echo(
+            "Suggested METADATA_PROVIDER_ORDER: "
+            + ", ".join(METADATA_PROVIDERS.suggested_order())
+        )
+
+
+@click.command("enrich-status")
+@with_appcontext
+def enrich_status_command():
+    """Show the enrichment queue depth."""
+    for status, count in queue_depth().items():
+        click.echo(f"{status:>8}: {count}")
+
+
+@click.command("enrich-reset-backoff")
+@click.argument("book_ids", nargs=-1, type=int)
+@click.option("--all", "reset_all", is_flag=True, help="Reset every book.")
+@with_appcontext
+def enrich_reset_backoff_command(book_ids, reset_all):
+    """Clear the lookup backoff for BOOK_IDS (or --all) and queue them again."""
+    if not book_ids and not reset_all:
+        raise click.UsageError("Pass one or more book ids, or --all.")
+    reset = _reset_lookup_backoff(None if reset_all else list(book_ids))
+    db.session.commit()
+    click.echo(f"Reset lookup backoff for {reset} books.")
+
+    candidates = select(Book.id).where(
+        or_(Book.cover_url.is_(None), Book.synopsis.is_(None))
+    )
+    if not reset_all:
+        candidates = candidates.where(Book.id.in_(book_ids))
+    # Finished jobs must not wait for ENRICHMENT_REQUEUE_AFTER either.
+    queued = enqueue_books(db.session.scalars(candidates), force=True)
+    click.echo(f"Queued {queued} books for enrichment.")
+
+
+def init_app(app):
+    for key, value in {**DEFAULT_CONFIG, **PROVIDER_CONFIG_DEFAULTS}.items():
+        app.config.setdefault(key, value)
+    _configure_providers(app.config)
+    app.cli.add_command(enrich_drain_command)
+    app.cli.add_command(enrich_status_command)
+    app.cli.add_command(enrich_reset_backoff_command)
@@ -1,102 +1,1086 @@
+import base64
+import json
+import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
 import requests
-from flask import flash, url_for
-from sqlalchemy import or_
-from data_models import db, Author, Book
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import current_app, flash, url_for
+from sqlalchemy import and_, or_, select, tuple_, update
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import UnaryExpression
+from data_models import (
+    db,
+    Author,
+    Book,
+    BookEnrichmentState,
+    PUBLISHED_ASC_KEY,
+    PUBLISHED_DESC_KEY,
+    RATING_ASC_KEY,
+    RATING_DESC_KEY,
+)
+from circuit_breaker import breaker_from_config
+from http_cache import cache_from_config
+from isbns import to_isbn10, to_isbn13
+from metadata_pipeline import (
+    FIELDS,
+    METADATA_PROVIDERS,
+    SKIPPED,
+    MetadataProvider,
+    ProviderSkipped,
+)
+from search import fts_enabled, search_rank_subquery
+from single_flight import single_flight_from_config
+
+# Listing sort orders. A "-" prefix reverses one, e.g. "-rating" for the best
+# rated books first; "relevance" also needs a full-text search.
+SORT_ORDERS = ("title", "author", "rating", "published", "added")
+
+
+def _book_sort_keys(sort_by, search_rank=None):
+    """Return the ORDER BY expressions for a listing sort order.
+
+    Every order ends in a unique column, so it is total and can be used for
+    keyset pagination, and each one is backed by an index in data_models, so
+    a page is an index range scan rather than a sort. Reversed orders return
+    ``.desc()`` keys, read by scanning the same kind of index backwards.
+    Unrated and undated books come last in both directions of "rating" and
+    "published". "relevance" needs the ``search_rank`` subquery of a
+    full-text search and otherwise falls back to title order.
+    """
+    descending = sort_by.startswith("-")
+    sort_by = sort_by.lstrip("-")
+    if sort_by == "relevance" and search_rank is not None:
+        keys = [search_rank.c.rank, Book.id]
+    # Case-insensitive, matching the NOCASE indexes in data_models.
+    elif sort_by == "author":
+        keys = [Author.name.collate("nocase"), Author.id, Book.id]
+    elif sort_by == "rating":
+        keys = [RATING_DESC_KEY if descending else RATING_ASC_KEY, Book.id]
+    elif sort_by == "published":
+        keys = [PUBLISHED_DESC_KEY if descending else PUBLISHED_ASC_KEY, Book.id]
+    elif sort_by == "added":
+        # Ids are handed out in insertion order.
+        keys = [Book.id]
+    else:
+        keys = [Book.title.collate("nocase"), Book.id]
+    if descending:
+        return [key.desc() for key in keys]
+    return keys
+
+
+def _split_sort_keys(sort_keys):
+    """Return the expressions of ``sort_keys`` and whether they are descending.
+
+    All keys of an order run in the same direction (see _book_sort_keys).
+    """
+    first = sort_keys[0]
+    if isinstance(first, UnaryExpression) and first.modifier is operators.desc_op:
+        return [key.element for key in sort_keys], True
+    return list(sort_keys), False
+
+
+class BookListing:
+    """A book as a listing page shows it, without the rest of the row.
+
+    ``author`` is the author's name. The synopsis text is never shown on a
+    listing, so only ``has_synopsis`` is read, to decide on lookups.
+    """
+
+    __slots__ = (
+        "id",
+        "isbn",
+        "isbn_valid",
+        "title",
+        "rating",
+        "cover_url",
+        "cover_file",
+        "author_id",
+        "author",
+        "has_synopsis",
+    )
+
+    def __init__(
+        self,
+        id,
+        isbn,
+        isbn_valid,
+        title,
+        rating,
+        cover_url,
+        cover_file,
+        author_id,
+        author,
+        has_synopsis,
+    ):
+        self.id = id
+        self.isbn = isbn
+        self.isbn_valid = isbn_valid
+        self.title = title
+        self.rating = rating
+        self.cover_url = cover_url
+        self.cover_file = cover_file
+        self.author_id = author_id
+        self.author = author
+        self.has_synopsis = has_synopsis
+
+    def __repr__(self):
+        return f"<BookListing {self.title}>"
+
+
+class _BookListingBundle(db.Bundle):
+    """Selects the listing columns and builds a BookListing for each row."""
+
+    def create_row_processor(self, query, procs, labels):
+        def proc(row):
+            return BookListing(*(getter(row) for getter in procs))
+
+        return proc
+
+
+# Columns in BookListing.__slots__ order.
+BOOK_LISTING = _BookListingBundle(
+    "book_listing",
+    Book.id,
+    Book.isbn,
+    Book.isbn_valid,
+    Book.title,
+    Book.rating,
+    Book.cover_url,
+    Book.cover_file,
+    Book.author_id,
+    Author.name.label("author"),
+    # A NULL check, so SQLite does not have to read the text itself.
+    Book.synopsis.isnot(None).label("has_synopsis"),
+)
+
+
+def _book_query_and_keys(sort_by, search_query, projection=None):
+    """Build the unordered listing query and the sort keys to page it by.
+
+    The query returns Book entities with their authors, or the rows of
+    ``projection`` (e.g. BOOK_LISTING) if one is given. Searches use the
+    FTS5 index (ranked with bm25) when it is available and the original
+    LIKE search otherwise.
+    """
+    if projection is None:
+        query = Book.query.options(db.joinedload(Book.author)).join(Author)
+    else:
+        query = db.session.query(projection).select_from(Book).join(Author)
+    search_rank = None
+
+    if search_query:
+        if fts_enabled():
+            search_rank = search_rank_subquery(search_query)
+        if search_rank is not None:
+            query = query.join(search_rank, search_rank.c.book_id == Book.id)
+        else:
+            search_term = f"%{search_query}%"
+            query = query.filter(
+                or_(Book.title.ilike(search_term), Author.name.ilike(search_term))
+            )
+
+    return query, _book_sort_keys(sort_by, search_rank)
 
 
 def _build_book_query(sort_by, search_query):
     """Build the query for fetching books based on sort and search parameters."""
-    query = Book.query.options(db.joinedload(Book.author)).join(Author)
+    query, sort_keys = _book_query_and_keys(sort_by, search_query)
+    return query.order_by(*sort_keys)
 
-    if search_query:
-        search_term = f"%{search_query}%"
-        query = query.filter(
-            or_(Book.title.ilike(search_term), Author.name.ilike(search_term))
+
+def _encode_cursor(values):
+    """Encode the sort key values of a row as an opaque URL-safe cursor."""
+    raw = json.dumps(list(values), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(cursor, size):
+    """Decode a cursor made by _encode_cursor(); None if it is not valid."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except ValueError:
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    return values
+
+
+def _keyset_condition(sort_keys, values, forward=True):
+    """Return a filter for rows strictly after (or before) the given key values.
+
+    ``sort_keys`` are plain, ascending expressions; ``forward`` selects the
+    rows with greater keys. Written as
+    ``k1 >= v1 AND (k1 > v1 OR (k2, ...) > (v2, ...))`` rather than a single
+    row-value comparison, because SQLite only seeks an index on a COLLATE
+    NOCASE column or on an expression through a plain comparison.
+    """
+    first, rest = sort_keys[0], sort_keys[1:]
+    if forward:
+        if not rest:
+            return first > values[0]
+        return and_(
+            first >= values[0],
+            or_(first > values[0], tuple_(*rest) > tuple_(*values[1:])),
         )
+    if not rest:
+        return first < values[0]
+    return and_(
+        first <= values[0],
+        or_(first < values[0], tuple_(*rest) < tuple_(*values[1:])),
+    )
+
 
-    if sort_by == "author":
-        query = query.order_by(Author.name)
+def _keyset_query(query, sort_keys, page_size, after=None, before=None):
+    """Limit ``query`` to the rows of one keyset page, plus one look-ahead row.
+
+    ``after``/``before`` are decoded cursors (lists of sort key values). Each
+    row gets the sort key values appended as extra columns. Pages read
+    backwards (``before``) come out in reverse order.
+    """
+    columns, descending = _split_sort_keys(sort_keys)
+    query = query.order_by(None).add_columns(*columns)
+    # Rows after the cursor of an ascending order, or before the cursor of a
+    # descending one, come in increasing key order.
+    increasing = (before is None) != descending
+    cursor = before if before is not None else after
+    if cursor is not None:
+        query = query.filter(_keyset_condition(columns, cursor, increasing))
+    if increasing:
+        query = query.order_by(*columns)
     else:
-        query = query.order_by(Book.title)
+        query = query.order_by(*(column.desc() for column in columns))
+    return query.limit(page_size + 1)
+
+
+def _keyset_page(query, sort_keys, page_size, after=None, before=None):
+    """Fetch one page of ``query`` using keyset (cursor) pagination.
+
+    ``sort_keys`` is the full ordering (see _book_sort_keys). Instead of an
+    OFFSET, the page starts right after (or ends right before) the row whose
+    key values are encoded in the cursor, so every page costs the same index
+    range scan however deep it is.
+
+    Returns ``(rows, next_cursor, prev_cursor)``; a cursor is None when there
+    is no page in that direction.
+    """
+    size = len(sort_keys)
+    after = _decode_cursor(after, size)
+    before = _decode_cursor(before, size) if after is None else None
+
+    rows = _keyset_query(query, sort_keys, page_size, after, before).all()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if before is not None:
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        first_key, last_key = rows[0][1:], rows[-1][1:]
+        if before is not None:
+            next_cursor = _encode_cursor(last_key)
+            prev_cursor = _encode_cursor(first_key) if has_more else None
+        else:
+            next_cursor = _encode_cursor(last_key) if has_more else None
+            prev_cursor = _encode_cursor(first_key) if after is not None else None
+    return [row[0] for row in rows], next_cursor, prev_cursor
+
+
+# --- Metadata provider clients ---
 
-    return query
+PROVIDER_CONFIG_DEFAULTS = {
+    # Simultaneous requests allowed to each provider per process.
+    "GOOGLE_BOOKS_CONCURRENCY": 8,
+    "OPEN_LIBRARY_CONCURRENCY": 4,
+    # Cover image downloads have their own client and circuit breaker, so a
+    # slow image host does not cut off the metadata APIs.
+    "COVER_DOWNLOAD_CONCURRENCY": 8,
+    # Keep-alive connections kept open per host.
+    "GOOGLE_BOOKS_POOL_SIZE": 8,
+    "OPEN_LIBRARY_POOL_SIZE": 4,
+    "COVER_DOWNLOAD_POOL_SIZE": 8,
+    "PROVIDER_CONNECT_TIMEOUT": 3.05,
+    "GOOGLE_BOOKS_READ_TIMEOUT": 5,
+    # ISBNs combined into one Google Books query ("isbn:A OR isbn:B ...");
+    # 1 looks every book up on its own.
+    "GOOGLE_BOOKS_BATCH_SIZE": 20,
+    "OPEN_LIBRARY_READ_TIMEOUT": 3,
+    "COVER_DOWNLOAD_READ_TIMEOUT": 5,
+    # Retries on connection errors and 429/5xx responses, with exponential
+    # backoff (backoff * 2 ** retry seconds) unless Retry-After says otherwise.
+    "PROVIDER_MAX_RETRIES": 2,
+    "PROVIDER_RETRY_BACKOFF": 0.5,
+    # Shared on-disk cache of provider responses (see http_cache.py).
+    "PROVIDER_CACHE_ENABLED": True,
+    "PROVIDER_CACHE_PATH": os.path.join(
+        os.path.abspath(os.path.dirname(__file__)), "data", "provider_cache.sqlite"
+    ),
+    "PROVIDER_CACHE_DEFAULT_TTL": 30 * 24 * 3600,
+    "PROVIDER_CACHE_MAX_TTL": 90 * 24 * 3600,
+    "PROVIDER_CACHE_MAX_BYTES": 64 * 1024 * 1024,
+    "PROVIDER_CACHE_MAX_ENTRIES": 100_000,
+    # Concurrent lookups of the same ISBN (or title and author) share one
+    # provider request, across processes through a lock table (see
+    # single_flight.py). Without a path, only within a process.
+    "LOOKUP_SINGLE_FLIGHT_ENABLED": True,
+    "LOOKUP_LOCK_PATH": os.path.join(
+        os.path.abspath(os.path.dirname(__file__)), "data", "lookup_locks.sqlite"
+    ),
+    # Seconds before the lock of an owner that died is taken over.
+    "LOOKUP_LOCK_TIMEOUT": 30,
+    # Seconds a finished lookup's result is reused by other callers.
+    "LOOKUP_RESULT_TTL": 10,
+    # Circuit breaker per provider (see circuit_breaker.py): opens when at
+    # least FAILURE_RATIO of MIN_REQUESTS or more requests in the last WINDOW
+    # seconds failed, and probes again after OPEN_SECONDS.
+    "PROVIDER_BREAKER_ENABLED": True,
+    "PROVIDER_BREAKER_WINDOW": 60,
+    "PROVIDER_BREAKER_MIN_REQUESTS": 10,
+    "PROVIDER_BREAKER_FAILURE_RATIO": 0.5,
+    "PROVIDER_BREAKER_OPEN_SECONDS": 30,
+    # Metadata providers (see metadata_pipeline.py) in order of preference;
+    # registered providers not listed here are tried after these.
+    "METADATA_PROVIDER_ORDER": (
+        "google_books_isbn",
+        "open_library",
+        "google_books_title",
+    ),
+    # Seconds to wait for a provider before also starting the next one.
+    # 0 starts every provider at once, None waits for each in turn.
+    "METADATA_HEDGE_DELAY": 0.5,
+}
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class ProviderUnavailable(requests.exceptions.ConnectionError, ProviderSkipped):
+    """Raised instead of sending a request while a provider's breaker is open."""
+
+
+# Largest page of results the Google Books volumes endpoint returns.
+GOOGLE_BOOKS_MAX_RESULTS = 40
+
+# Called after every provider request that goes over the network, as
+# ``listener(provider, seconds, outcome)`` where outcome is the status class
+# ("2xx", "4xx", ...) or "error". Used by metrics.py.
+PROVIDER_LISTENERS = []
+
+
+def _notify_provider_listeners(provider, seconds, outcome):
+    for listener in PROVIDER_LISTENERS:
+        listener(provider, seconds, outcome)
+
+
+class _ConnectionStats:
+    """Counts requests and new connections, and times connection setup."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.connect_seconds = 0.0
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_connect(self, seconds):
+        with self._lock:
+            self.connections += 1
+            self.connect_seconds += seconds
+
+    def snapshot(self):
+        with self._lock:
+            reused = max(self.requests - self.connections, 0)
+            avg_connect = (
+                self.connect_seconds / self.connections if self.connections else 0.0
+            )
+            return {
+                "requests": self.requests,
+                "connections": self.connections,
+                "reused": reused,
+                "reuse_ratio": reused / self.requests if self.requests else 0.0,
+                "avg_connect_seconds": avg_connect,
+                # Handshakes avoided by keep-alive, at the observed cost of one.
+                "saved_connect_seconds": reused * avg_connect,
+            }
+
+
+class _InstrumentedAdapter(HTTPAdapter):
+    """HTTPAdapter that reports requests and timed connects to _ConnectionStats."""
+
+    def __init__(self, stats, **kwargs):
+        self._stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        stats = self._stats
+
+        def timed(connection_cls):
+            class TimedConnection(connection_cls):
+                def connect(self):
+                    started = time.perf_counter()
+                    try:
+                        super().connect()
+                    finally:
+                        stats.record_connect(time.perf_counter() - started)
+
+            return TimedConnection
+
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: type(
+                pool_cls.__name__,
+                (pool_cls,),
+                {"ConnectionCls": timed(pool_cls.ConnectionCls)},
+            )
+            for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    def send(self, request, **kwargs):
+        self._stats.record_request()
+        return super().send(request, **kwargs)
+
+
+class ProviderClient:
+    """A pooled, keep-alive HTTP session for one metadata provider.
+
+    Requests share a connection pool, are retried with backoff on connection
+    errors and 429/5xx responses, and are limited to ``concurrency`` at a
+    time across all threads. GET and HEAD responses are answered from
+    ``cache`` (an http_cache.ResponseCache) when possible. While ``breaker``
+    (a circuit_breaker.CircuitBreaker) is open, other requests fail at once
+    with ProviderUnavailable.
+    """
+
+    def __init__(
+        self,
+        name,
+        concurrency=4,
+        pool_size=4,
+        connect_timeout=3.05,
+        read_timeout=5,
+        max_retries=2,
+        retry_backoff=0.5,
+        cache=None,
+        breaker=None,
+    ):
+        self.name = name
+        self.cache = cache
+        self.breaker = breaker
+        self.timeout = (connect_timeout, read_timeout)
+        self.stats = _ConnectionStats()
+        self._semaphore = threading.BoundedSemaphore(concurrency)
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=retry_backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset({"GET", "HEAD"}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        # Mounted for every URL, so redirect targets (e.g. Open Library
+        # covers served from archive.org) are pooled too.
+        adapter = _InstrumentedAdapter(
+            self.stats,
+            pool_connections=4,
+            pool_maxsize=pool_size,
+            max_retries=retry,
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, url, use_cache=True, **kwargs):
+        cache = self.cache if use_cache and method in ("GET", "HEAD") else None
+        if cache is not None:
+            cached = cache.get(method, url)
+            if cached is not None:
+                return cached
+        if self.breaker is not None and not self.breaker.allow():
+            raise ProviderUnavailable(f"{self.name} circuit breaker is open")
+        kwargs.setdefault("timeout", self.timeout)
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            with self._semaphore:
+                response = self.session.request(method, url, **kwargs)
+            outcome = f"{response.status_code // 100}xx"
+        finally:
+            if self.breaker is not None:
+                self.breaker.record(
+                    outcome == "error" or response.status_code in RETRY_STATUSES
+                )
+            _notify_provider_listeners(
+                self.name, time.perf_counter() - started, outcome
+            )
+        if cache is not None:
+            cache.store(method, url, response)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def _build_provider_clients(config):
+    """Create the provider clients from a config mapping."""
+    settings = {**PROVIDER_CONFIG_DEFAULTS, **config}
+    shared = {
+        "connect_timeout": settings["PROVIDER_CONNECT_TIMEOUT"],
+        "max_retries": settings["PROVIDER_MAX_RETRIES"],
+        "retry_backoff": settings["PROVIDER_RETRY_BACKOFF"],
+        "cache": cache_from_config(settings),
+    }
+    return {
+        "google_books": ProviderClient(
+            "google_books",
+            concurrency=settings["GOOGLE_BOOKS_CONCURRENCY"],
+            pool_size=settings["GOOGLE_BOOKS_POOL_SIZE"],
+            read_timeout=settings["GOOGLE_BOOKS_READ_TIMEOUT"],
+            breaker=breaker_from_config(settings),
+            **shared,
+        ),
+        "open_library": ProviderClient(
+            "open_library",
+            concurrency=settings["OPEN_LIBRARY_CONCURRENCY"],
+            pool_size=settings["OPEN_LIBRARY_POOL_SIZE"],
+            read_timeout=settings["OPEN_LIBRARY_READ_TIMEOUT"],
+            breaker=breaker_from_config(settings),
+            **shared,
+        ),
+        "covers": ProviderClient(
+            "covers",
+            concurrency=settings["COVER_DOWNLOAD_CONCURRENCY"],
+            pool_size=settings["COVER_DOWNLOAD_POOL_SIZE"],
+            read_timeout=settings["COVER_DOWNLOAD_READ_TIMEOUT"],
+            breaker=breaker_from_config(settings),
+            **{**shared, "cache": None},
+        ),
+    }
+
+
+_providers = _build_provider_clients({})
+_single_flight = single_flight_from_config(PROVIDER_CONFIG_DEFAULTS)
+# Lookups run outside the app context, so these settings are copied here.
+_pipeline_settings = {
+    "order": PROVIDER_CONFIG_DEFAULTS["METADATA_PROVIDER_ORDER"],
+    "hedge_delay": PROVIDER_CONFIG_DEFAULTS["METADATA_HEDGE_DELAY"],
+}
+
+
+def _configure_providers(config):
+    """Replace the provider clients using settings from ``config``."""
+    global _providers, _single_flight
+    settings = {**PROVIDER_CONFIG_DEFAULTS, **config}
+    old, _providers = _providers, _build_provider_clients(config)
+    for client in old.values():
+        client.close()
+    _single_flight = single_flight_from_config(settings)
+    _pipeline_settings["order"] = tuple(settings["METADATA_PROVIDER_ORDER"])
+    _pipeline_settings["hedge_delay"] = settings["METADATA_HEDGE_DELAY"]
+
+
+def _shared_lookup(key, fetch):
+    """Return ``fetch()``, shared with concurrent lookups of the same ``key``."""
+    if _single_flight is None:
+        return fetch()
+    return _single_flight.do(key, fetch)
+
+
+def _provider_breakers():
+    """Return a snapshot of each provider's circuit breaker, if it has one."""
+    return {
+        name: client.breaker.snapshot()
+        for name, client in _providers.items()
+        if client.breaker is not None
+    }
+
+
+def _provider_stats():
+    """Return connection reuse statistics for each provider client."""
+    return {name: client.stats.snapshot() for name, client in _providers.items()}
+
+
+def _download_image(url, max_bytes):
+    """Download an image through the "covers" client.
+
+    Image hosts get their own connection pool and circuit breaker, apart
+    from the metadata APIs, and bypass the provider response cache. Returns
+    ``(content, content_type)``, or None if the download fails, is not an
+    image or is larger than ``max_bytes``.
+    """
+    try:
+        response = _providers["covers"].get(url, use_cache=False, stream=True)
+        with response:
+            content_type = response.headers.get("Content-Type", "").split(";")[0]
+            if response.status_code != 200 or not content_type.startswith("image/"):
+                return None
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(64 * 1024):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > max_bytes:
+                    return None
+    except requests.exceptions.RequestException as e:
+        print(f"Error downloading cover {url}: {e}")
+        return None
+    return b"".join(chunks), content_type
 
 
 def _fetch_from_google_books(query_url):
-    """Fetch book metadata from Google Books API."""
+    """Fetch book metadata from Google Books API.
+
+    Returns None if the request fails, but lets ProviderUnavailable through
+    so that callers can tell a lookup that was never sent.
+    """
     try:
-        response = requests.get(query_url, timeout=5)
+        response = _providers["google_books"].get(query_url)
         response.raise_for_status()
         return response.json()
+    except ProviderUnavailable:
+        raise
     except requests.exceptions.RequestException:
         return None
 
 
-def _fetch_cover_from_open_library(isbn):
-    """Fetch book cover from Open Library API."""
+def _lookup_open_library_cover(isbn):
+    """Check Open Library for a cover.
+
+    Returns ``(outcome, cover_url)`` where outcome is "hit", "miss", "error"
+    or SKIPPED.
+    """
     open_library_cover_url = (
         f"https://covers.openlibrary.org/b/isbn/{isbn}-M.jpg?default=false"
     )
     try:
-        head_response = requests.head(
-            open_library_cover_url, timeout=3, allow_redirects=True
+        head_response = _providers["open_library"].head(
+            open_library_cover_url, allow_redirects=True
         )
-        if (
-            head_response.status_code == 200
-            and "image" in head_response.headers.get("Content-Type", "").lower()
-        ):
-            return open_library_cover_url
+    except ProviderUnavailable:
+        return SKIPPED, None
     except requests.exceptions.RequestException:
-        pass
-    return None
+        return "error", None
+    if (
+        head_response.status_code == 200
+        and "image" in head_response.headers.get("Content-Type", "").lower()
+    ):
+        return "hit", open_library_cover_url
+    if head_response.status_code >= 500:
+        return "error", None
+    return "miss", None
 
 
-def _fetch_and_update_book_metadata(book):
-    """Fetch and update book metadata (cover and synopsis) if missing."""
-    cover_url = book.cover_url
-    synopsis = book.synopsis
-
-    if not cover_url or not synopsis:
-        if book.isbn:
-            google_books_api_url_isbn = (
-                f"https://www.googleapis.com/books/v1/volumes?q=isbn:{book.isbn}"
-            )
-            data = _fetch_from_google_books(google_books_api_url_isbn)
-            if data and data.get("totalItems", 0) > 0 and "items" in data:
-                volume_info = data["items"][0].get("volumeInfo", {})
-                if not cover_url:
-                    image_links = volume_info.get("imageLinks", {})
-                    cover_url = image_links.get("thumbnail") or image_links.get(
-                        "smallThumbnail"
-                    )
-                if not synopsis:
-                    synopsis = volume_info.get("description")
-
-        if not cover_url and book.isbn:
-            cover_url = _fetch_cover_from_open_library(book.isbn)
-
-        if not cover_url or not synopsis:
-            query_title = re.sub(r"[^\w\s]", "", book.title)
-            query_author = re.sub(r"[^\w\s]", "", book.author.name)
-            google_books_api_url_title = (
-                "https://www.googleapis.com/books/v1/volumes?q=intitle:"
-                f"{query_title}+inauthor:{query_author}"
+def _fetch_cover_from_open_library(isbn):
+    """Fetch book cover from Open Library API."""
+    return _lookup_open_library_cover(isbn)[1]
+
+
+def _needs_metadata(book):
+    """Return True if the book is missing its cover or synopsis.
+
+    ``book`` may be a Book or a BookListing.
+    """
+    if isinstance(book, BookListing):
+        return not book.cover_url or not book.has_synopsis
+    return not book.cover_url or not book.synopsis
+
+
+def _needs_metadata_fields(lookup):
+    """Return True if a _lookup_fields() dict lacks a cover or synopsis."""
+    return not lookup["cover_url"] or not lookup["synopsis"]
+
+
+def _lookup_fields(book):
+    """Copy the fields needed for a metadata lookup out of a Book row.
+
+    The result is a plain dict, so lookups can run in worker threads without
+    touching the ORM session.
+    """
+    return {
+        "id": book.id,
+        "isbn": book.isbn,
+        "title": book.title,
+        "author_name": book.author.name,
+        "cover_url": book.cover_url,
+        "synopsis": book.synopsis,
+    }
+
+
+def _google_books_values(data):
+    """Return the cover and synopsis of the first volume in a Google Books
+    response, or None for a failed request."""
+    if data is None:
+        return None
+    if data.get("totalItems", 0) == 0 or "items" not in data:
+        return {}
+    volume_info = data["items"][0].get("volumeInfo", {})
+    image_links = volume_info.get("imageLinks", {})
+    return {
+        "cover_url": image_links.get("thumbnail") or image_links.get("smallThumbnail"),
+        "synopsis": volume_info.get("description"),
+    }
+
+
+def _isbn_keys(isbn):
+    """Return the forms under which ``isbn`` may appear in industryIdentifiers.
+
+    Hyphens and spaces are dropped, and an ISBN-10 is also given as the
+    equivalent ISBN-13 (and a 978 ISBN-13 as its ISBN-10).
+    """
+    digits = re.sub(r"[^0-9Xx]", "", isbn or "").upper()
+    keys = {digits} if digits else set()
+    if len(digits) == 10:
+        keys.add(to_isbn13(digits))
+    elif len(digits) == 13 and digits.startswith("978"):
+        keys.add(to_isbn10(digits))
+    return keys
+
+
+def _google_books_batch(isbns):
+    """Look up several ISBNs with one OR-combined Google Books query.
+
+    Returns ``{isbn: data}`` with a single-item response for each ISBN that
+    one of the returned volumes lists in its industryIdentifiers, or None if
+    the request failed.
+    """
+    query = "+OR+".join(f"isbn:{isbn}" for isbn in isbns)
+    data = _fetch_from_google_books(
+        "https://www.googleapis.com/books/v1/volumes?q="
+        f"{query}&maxResults={GOOGLE_BOOKS_MAX_RESULTS}"
+    )
+    if data is None:
+        return None
+    wanted = {}
+    for isbn in isbns:
+        for key in _isbn_keys(isbn):
+            wanted.setdefault(key, isbn)
+    found = {}
+    for item in data.get("items", []):
+        identifiers = item.get("volumeInfo", {}).get("industryIdentifiers", [])
+        for identifier in identifiers:
+            keys = _isbn_keys(identifier.get("identifier"))
+            isbn = next((wanted[key] for key in keys if key in wanted), None)
+            if isbn is not None and isbn not in found:
+                found[isbn] = {"totalItems": 1, "items": [item]}
+    return found
+
+
+def _prefetch_google_books(lookups, executor, batch_size, deadline=None):
+    """Resolve the ISBNs of ``lookups`` through batched Google Books queries.
+
+    Batches run concurrently on ``executor``; those not done by ``deadline``
+    (a time.monotonic() value) are not waited for. Returns ``{isbn: data}``
+    for the ISBNs that were found; the others are left to single lookups.
+    """
+    isbns = list(
+        dict.fromkeys(
+            lookup["isbn"]
+            for lookup in lookups
+            if lookup["isbn"] and _needs_metadata_fields(lookup)
+        )
+    )
+    if batch_size <= 1 or len(isbns) < 2 or not _can_query("google_books", deadline):
+        return {}
+    # Each ISBN needs room for at least one volume in the response.
+    batch_size = min(batch_size, GOOGLE_BOOKS_MAX_RESULTS)
+    batches = [
+        isbns[start : start + batch_size] for start in range(0, len(isbns), batch_size)
+    ]
+    futures = [executor.submit(_google_books_batch, batch) for batch in batches]
+    done, _ = wait(futures, timeout=_time_left(deadline))
+    prefetched = {}
+    for future in futures:
+        if future not in done:
+            continue
+        try:
+            prefetched.update(future.result() or {})
+        except ProviderUnavailable:
+            pass
+    return prefetched
+
+
+def _time_left(deadline):
+    """Seconds until ``deadline`` (a time.monotonic() value); None for no limit."""
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0.0)
+
+
+def _can_query(provider, deadline):
+    """Return False if ``provider``'s breaker is open or ``deadline`` has passed."""
+    if deadline is not None and time.monotonic() >= deadline:
+        return False
+    client = _providers.get(provider)
+    return client is None or client.breaker is None or not client.breaker.is_open()
+
+
+# --- Metadata providers ---
+
+
+class GoogleBooksIsbn(MetadataProvider):
+    """Google Books volume search by ISBN."""
+
+    name = "google_books_isbn"
+    client = "google_books"
+    fields = frozenset(FIELDS)
+
+    def applies(self, lookup):
+        return bool(lookup["isbn"])
+
+    def fetch(self, lookup, wanted):
+        url = f"https://www.googleapis.com/books/v1/volumes?q=isbn:{lookup['isbn']}"
+        data = _shared_lookup(
+            f"google_books:isbn:{lookup['isbn']}",
+            lambda: _fetch_from_google_books(url),
+        )
+        return _google_books_values(data)
+
+
+class OpenLibraryCover(MetadataProvider):
+    """Open Library cover image by ISBN."""
+
+    name = "open_library"
+    client = "open_library"
+    fields = frozenset({"cover_url"})
+
+    def applies(self, lookup):
+        return bool(lookup["isbn"])
+
+    def fetch(self, lookup, wanted):
+        outcome, cover_url = _shared_lookup(
+            f"open_library:isbn:{lookup['isbn']}",
+            lambda: _lookup_open_library_cover(lookup["isbn"]),
+        )
+        if outcome == SKIPPED:
+            raise ProviderSkipped(self.name)
+        if outcome == "error":
+            return None
+        return {"cover_url": cover_url}
+
+
+class GoogleBooksTitle(MetadataProvider):
+    """Google Books volume search by title and author."""
+
+    name = "google_books_title"
+    client = "google_books"
+    fields = frozenset(FIELDS)
+
+    def fetch(self, lookup, wanted):
+        query_title = re.sub(r"[^\w\s]", "", lookup["title"])
+        query_author = re.sub(r"[^\w\s]", "", lookup["author_name"])
+        url = (
+            "https://www.googleapis.com/books/v1/volumes?q=intitle:"
+            f"{query_title}+inauthor:{query_author}"
+        )
+        data = _shared_lookup(
+            f"google_books:title:{query_title.lower()}|{query_author.lower()}",
+            lambda: _fetch_from_google_books(url),
+        )
+        return _google_books_values(data)
+
+
+METADATA_PROVIDERS.register(GoogleBooksIsbn())
+METADATA_PROVIDERS.register(OpenLibraryCover())
+METADATA_PROVIDERS.register(GoogleBooksTitle())
+
+
+def _resolve_metadata(lookup, prefetched=None, deadline=None):
+    """Resolve the missing cover and synopsis for a _lookup_fields() dict.
+
+    The registered metadata providers are run by the hedged engine in
+    METADATA_PROVIDER_ORDER. ``prefetched`` maps ISBNs to Google Books
+    responses already fetched by _prefetch_google_books(); those ISBNs are
+    not queried again. Providers whose breaker is open, and any provider
+    once ``deadline`` (a time.monotonic() value) has passed, are skipped.
+
+    Returns ``(cover_url, synopsis, outcomes)``, where outcomes maps each
+    provider that was needed to "hit", "miss", "error" or SKIPPED.
+    """
+    if not _needs_metadata_fields(lookup):
+        return lookup["cover_url"], lookup["synopsis"], {}
+    outcomes = {}
+    exclude = ()
+    if prefetched and lookup["isbn"] in prefetched:
+        found = _google_books_values(prefetched[lookup["isbn"]])
+        found = {
+            field: value
+            for field, value in found.items()
+            if value and not lookup[field]
+        }
+        outcomes[GoogleBooksIsbn.name] = "hit" if found else "miss"
+        lookup = {**lookup, **found}
+        exclude = (GoogleBooksIsbn.name,)
+
+    values, pipeline_outcomes = METADATA_PROVIDERS.resolve(
+        lookup,
+        order=_pipeline_settings["order"],
+        hedge_delay=_pipeline_settings["hedge_delay"],
+        deadline=deadline,
+        can_query=lambda provider: _can_query(provider.client, deadline),
+        exclude=exclude,
+    )
+    outcomes.update(pipeline_outcomes)
+    return (
+        values.get("cover_url") or lookup["cover_url"],
+        values.get("synopsis") or lookup["synopsis"],
+        outcomes,
+    )
+
+
+# --- Lookup backoff ---
+
+
+def _in_backoff(state, now=None):
+    """Return True if a BookEnrichmentState says the book must not be retried yet."""
+    if state is None or state.next_eligible_at is None:
+        return False
+    return state.next_eligible_at > (now or datetime.utcnow())
+
+
+def _record_lookup_attempt(book, state, cover_url, synopsis, outcomes):
+    """Update (or create) a book's enrichment state after a lookup.
+
+    A book that still lacks a cover or synopsis waits
+    ENRICHMENT_BACKOFF_BASE * 2 ** (attempts - 1) seconds, capped at
+    ENRICHMENT_BACKOFF_MAX, before it is looked up again.
+    """
+    if state is None:
+        state = BookEnrichmentState(book_id=book.id, attempt_count=0)
+        db.session.add(state)
+    now = datetime.utcnow()
+    state.last_attempt_at = now
+    state.provider_outcomes = json.dumps(outcomes, sort_keys=True)
+    if cover_url and synopsis:
+        state.attempt_count = 0
+        state.next_eligible_at = None
+    else:
+        state.attempt_count = (state.attempt_count or 0) + 1
+        delay = min(
+            current_app.config["ENRICHMENT_BACKOFF_BASE"]
+            * 2 ** (state.attempt_count - 1),
+            current_app.config["ENRICHMENT_BACKOFF_MAX"],
+        )
+        state.next_eligible_at = now + timedelta(seconds=delay)
+    return state
+
+
+def _books_in_backoff(book_ids):
+    """Return the subset of ``book_ids`` whose lookups are backing off."""
+    if not book_ids:
+        return set()
+    return set(
+        db.session.scalars(
+            select(BookEnrichmentState.book_id).where(
+                BookEnrichmentState.book_id.in_(book_ids),
+                BookEnrichmentState.next_eligible_at > datetime.utcnow(),
             )
-            data = _fetch_from_google_books(google_books_api_url_title)
-            if data and data.get("totalItems", 0) > 0 and "items" in data:
-                volume_info = data["items"][0].get("volumeInfo", {})
-                if not cover_url:
-                    image_links = volume_info.get("imageLinks", {})
-                    cover_url = image_links.get("thumbnail") or image_links.get(
-                        "smallThumbnail"
-                    )
-                if not synopsis:
-                    synopsis = volume_info.get("description")
+        )
+    )
+
 
+def _reset_lookup_backoff(book_ids=None):
+    """Make books eligible for lookups again; all books if ``book_ids`` is None.
+
+    Returns the number of books whose state was reset. The caller commits.
+    """
+    stmt = update(BookEnrichmentState).values(attempt_count=0, next_eligible_at=None)
+    if book_ids is not None:
+        stmt = stmt.where(BookEnrichmentState.book_id.in_(book_ids))
+    return db.session.execute(
+        stmt.execution_options(synchronize_session=False)
+    ).rowcount
+
+
+def _fetch_and_update_book_metadata(book):
+    """Fetch and update book metadata (cover and synopsis) if missing.
+
+    Books whose previous lookups failed are skipped until their backoff
+    expires. The attempt is recorded on the book's enrichment state.
+    """
+    if not _needs_metadata(book) or _in_backoff(book.enrichment_state):
+        return book.cover_url, book.synopsis
+    cover_url, synopsis, outcomes = _resolve_metadata(_lookup_fields(book))
+    if SKIPPED not in outcomes.values():
+        _record_lookup_attempt(
+            book, book.enrichment_state, cover_url, synopsis, outcomes
+        )
     return cover_url, synopsis
 
 
+def _fetch_metadata_for_books(books, max_workers=12, budget=None):
+    """Resolve missing metadata for many books concurrently.
+
+    Lookups run on a thread pool; the provider clients keep the number of
+    simultaneous requests to each host within its cap. ISBNs are first
+    looked up in batches of GOOGLE_BOOKS_BATCH_SIZE per Google Books query,
+    and only the books that no batch resolved are queried one by one.
+
+    With a ``budget`` in seconds, lookups still running when it is spent
+    are abandoned (they finish in the background) and their books left out.
+    Books in backoff are skipped, and every attempt is recorded on the
+    book's enrichment state, except those cut short by an open circuit
+    breaker or the budget. Returns a dict mapping book id to
+    ``(cover_url, synopsis)`` for every book that was looked up.
+    """
+    books = [book for book in books if _needs_metadata(book)]
+    if not books:
+        return {}
+    states = {
+        state.book_id: state
+        for state in BookEnrichmentState.query.filter(
+            BookEnrichmentState.book_id.in_([book.id for book in books])
+        )
+    }
+    books = [book for book in books if not _in_backoff(states.get(book.id))]
+    if not books:
+        return {}
+
+    lookups = [_lookup_fields(book) for book in books]
+    batch_size = current_app.config.get(
+        "GOOGLE_BOOKS_BATCH_SIZE", PROVIDER_CONFIG_DEFAULTS["GOOGLE_BOOKS_BATCH_SIZE"]
+    )
+    deadline = time.monotonic() + budget if budget else None
+    executor = ThreadPoolExecutor(
+        max_workers=min(max_workers, len(lookups)),
+        thread_name_prefix="metadata",
+    )
+    try:
+        prefetched = _prefetch_google_books(lookups, executor, batch_size, deadline)
+        futures = [
+            executor.submit(_resolve_metadata, lookup, prefetched, deadline)
+            for lookup in lookups
+        ]
+        done, _ = wait(futures, timeout=_time_left(deadline))
+    finally:
+        executor.shutdown(wait=deadline is None, cancel_futures=True)
+
+    results = {}
+    for book, future in zip(books, futures):
+        if future not in done:
+            continue
+        cover_url, synopsis, outcomes = future.result()
+        if SKIPPED not in outcomes.values():
+            _record_lookup_attempt(
+                book, states.get(book.id), cover_url, synopsis, outcomes
+            )
+        results[book.id] = (cover_url, synopsis)
+    return results
+
+
 def _update_db_if_needed(book, cover_url, synopsis):
     """Update the database if new metadata is found."""
     updated = False
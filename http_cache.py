@@ -0,0 +1,425 @@
+"""Cross-process cache of metadata provider responses.
+
+Responses are stored in their own SQLite file, keyed by request method and
+normalized URL, so every worker process (and every restart) shares them.
+Entries expire after a TTL and the least recently used ones are evicted once
+the cache grows past its size cap. The entry count and byte total are kept
+up to date by triggers, so a store costs the same however full the cache is,
+and reads only write (buffered) use times and counters now and then.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import click
+import requests
+from flask import current_app
+from flask.cli import with_appcontext
+
+# Bumped whenever the layout changes; older cache files are emptied and
+# recreated, since SQLite cannot reorder the columns of a table.
+SCHEMA_VERSION = 2
+
+# The body comes last, so reading the other columns never loads its
+# overflow pages. Triggers keep the entry count and byte total in
+# ``counters`` (under "entries" and "bytes"), so no write has to add them up.
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS responses (
+        key TEXT PRIMARY KEY,
+        status INTEGER NOT NULL,
+        headers TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        stored_at REAL NOT NULL,
+        expires_at REAL NOT NULL,
+        last_used_at REAL NOT NULL,
+        body BLOB NOT NULL
+    )""",
+    # Covers the LRU eviction scan, which needs only the use time and size.
+    "CREATE INDEX IF NOT EXISTS ix_responses_lru ON responses (last_used_at, size)",
+    "CREATE INDEX IF NOT EXISTS ix_responses_expires_at ON responses (expires_at)",
+    """CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS responses_after_insert
+    AFTER INSERT ON responses BEGIN
+        UPDATE counters SET value = value + 1 WHERE name = 'entries';
+        UPDATE counters SET value = value + new.size WHERE name = 'bytes';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS responses_after_update
+    AFTER UPDATE OF size ON responses BEGIN
+        UPDATE counters SET value = value + new.size - old.size
+        WHERE name = 'bytes';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS responses_after_delete
+    AFTER DELETE ON responses BEGIN
+        UPDATE counters SET value = value - 1 WHERE name = 'entries';
+        UPDATE counters SET value = value - old.size WHERE name = 'bytes';
+    END""",
+)
+
+# LRU touches and hit/miss counts are kept in memory and written together
+# once this many keys were used or this many seconds passed (or with the
+# next store), so a cache hit does not take the write lock.
+TOUCH_FLUSH_SIZE = 256
+TOUCH_FLUSH_SECONDS = 5.0
+
+# Eviction frees space down to this fraction of the caps, so a full cache
+# evicts once per batch of stores rather than on every store.
+EVICT_TO = 0.9
+
+# Provider answers worth remembering: found, and definitively not found.
+CACHEABLE_STATUSES = (200, 404)
+
+# Response headers worth keeping; the body is stored already decoded, so
+# transfer-related headers would be wrong on replay.
+STORED_HEADERS = ("Content-Type", "Cache-Control", "ETag", "Last-Modified")
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url):
+    """Return a canonical form of ``url`` for use as a cache key.
+
+    The scheme and host are lower-cased, default ports and fragments dropped
+    and query parameters sorted, so equivalent URLs share one entry.
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+
+def freshness_lifetime(cache_control, default_ttl, max_ttl):
+    """Return how many seconds a response may be cached, or None for never.
+
+    ``no-store``, ``no-cache`` and ``max-age=0`` (revalidate every time) are
+    not cached, and a positive ``max-age`` sets the lifetime (capped at
+    ``max_ttl``). Only a response without any of these is treated as stable
+    provider metadata and cached for ``default_ttl``.
+    """
+    directives = {}
+    for directive in (cache_control or "").lower().split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name] = value.strip('"')
+    if "no-store" in directives or "no-cache" in directives:
+        return None
+    max_age = directives.get("max-age", "")
+    if re.fullmatch(r"\d+", max_age):
+        return min(int(max_age), max_ttl) or None
+    return default_ttl
+
+
+class ResponseCache:
+    """An LRU/TTL cache of HTTP responses backed by a SQLite file."""
+
+    def __init__(
+        self,
+        path,
+        default_ttl=30 * 24 * 3600,
+        max_ttl=90 * 24 * 3600,
+        max_bytes=64 * 1024 * 1024,
+        max_entries=100_000,
+    ):
+        self.path = path
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._schema_ready = False
+        self._pending_lock = threading.Lock()
+        self._reset_pending()
+
+    def _reset_pending(self):
+        self._touches = {}
+        self._pending_counts = {"hits": 0, "misses": 0}
+        self._pending_since = time.monotonic()
+        self._pending_pid = os.getpid()
+
+    def _connect(self):
+        """Return this thread's connection, opening one if needed."""
+        conn = getattr(self._local, "conn", None)
+        # Connections must not be shared with a forked child process.
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._schema_ready:
+                self._ensure_schema(conn)
+                self._schema_ready = True
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _ensure_schema(self, conn):
+        if conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process may have upgraded the file meanwhile.
+            if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                conn.execute("DROP TABLE IF EXISTS responses")
+                for statement in SCHEMA:
+                    conn.execute(statement)
+                conn.execute(
+                    "INSERT OR REPLACE INTO counters (name, value) "
+                    "VALUES ('entries', 0), ('bytes', 0)"
+                )
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def _bump(self, conn, **counts):
+        conn.executemany(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            list(counts.items()),
+        )
+
+    # --- Buffered use times and counters ---
+
+    def _note_lookup(self, key, now):
+        """Record a hit on ``key`` (or a miss, for None); True if a flush is due."""
+        with self._pending_lock:
+            if self._pending_pid != os.getpid():
+                self._reset_pending()
+            if key is None:
+                self._pending_counts["misses"] += 1
+            else:
+                self._pending_counts["hits"] += 1
+                self._touches[key] = now
+            return (
+                len(self._touches) >= TOUCH_FLUSH_SIZE
+                or time.monotonic() - self._pending_since >= TOUCH_FLUSH_SECONDS
+            )
+
+    def _write_pending(self, conn):
+        """Write the buffered use times and counters; call inside a transaction."""
+        with self._pending_lock:
+            if self._pending_pid != os.getpid():
+                self._reset_pending()
+            touches, counts = self._touches, self._pending_counts
+            self._reset_pending()
+        if touches:
+            conn.executemany(
+                "UPDATE responses SET last_used_at = max(last_used_at, ?) "
+                "WHERE key = ?",
+                [(used_at, key) for key, used_at in touches.items()],
+            )
+        counts = {name: value for name, value in counts.items() if value}
+        if counts:
+            self._bump(conn, **counts)
+
+    def flush(self):
+        """Write the buffered use times and hit/miss counts now."""
+        try:
+            conn = self._connect()
+            with conn:
+                self._write_pending(conn)
+        except sqlite3.Error:
+            pass
+
+    def get(self, method, url):
+        """Return a cached ``requests.Response`` or None on a miss.
+
+        A cache that cannot be read (locked, corrupt, ...) counts as a miss.
+        """
+        try:
+            return self._get(method, url)
+        except sqlite3.Error:
+            return None
+
+    def _get(self, method, url):
+        key = f"{method} {normalize_url(url)}"
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(
+            "SELECT status, headers, body FROM responses "
+            "WHERE key = ? AND expires_at > ?",
+            (key, now),
+        ).fetchone()
+        if self._note_lookup(key if row is not None else None, now):
+            self.flush()
+        if row is None:
+            return None
+
+        status, headers, body = row
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(json.loads(headers))
+        response._content = body
+        response.url = url
+        response.encoding = "utf-8"
+        return response
+
+    def store(self, method, url, response):
+        """Store ``response`` if its status and Cache-Control allow it.
+
+        Returns True if it was stored.
+        """
+        try:
+            return self._store(method, url, response)
+        except sqlite3.Error:
+            return False
+
+    def _store(self, method, url, response):
+        if response.status_code not in CACHEABLE_STATUSES:
+            return False
+        lifetime = freshness_lifetime(
+            response.headers.get("Cache-Control"), self.default_ttl, self.max_ttl
+        )
+        if lifetime is None:
+            return False
+
+        key = f"{method} {normalize_url(url)}"
+        body = response.content or b""
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            # An upsert rather than INSERT OR REPLACE, whose implicit delete
+            # would not fire the delete trigger.
+            conn.execute(
+                "INSERT INTO responses (key, status, headers, size, stored_at, "
+                "expires_at, last_used_at, body) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET status = excluded.status, "
+                "headers = excluded.headers, size = excluded.size, "
+                "stored_at = excluded.stored_at, expires_at = excluded.expires_at, "
+                "last_used_at = excluded.last_used_at, body = excluded.body",
+                (
+                    key,
+                    response.status_code,
+                    json.dumps(
+                        {
+                            name: response.headers[name]
+                            for name in STORED_HEADERS
+                            if name in response.headers
+                        }
+                    ),
+                    len(body) + len(key),
+                    now,
+                    now + lifetime,
+                    now,
+                    body,
+                ),
+            )
+            self._bump(conn, stores=1)
+            self._write_pending(conn)
+            self._evict(conn, now)
+        return True
+
+    def _totals(self, conn):
+        counters = dict(
+            conn.execute(
+                "SELECT name, value FROM counters WHERE name IN ('entries', 'bytes')"
+            )
+        )
+        return counters.get("entries", 0), counters.get("bytes", 0)
+
+    def _evict(self, conn, now):
+        """Drop expired entries, then least recently used ones over the caps."""
+        expired = conn.execute(
+            "DELETE FROM responses WHERE expires_at <= ?", (now,)
+        ).rowcount
+        count, size = self._totals(conn)
+        evicted = 0
+        if count > self.max_entries or size > self.max_bytes:
+            # Running total of sizes from newest to oldest use, read from the
+            # covering LRU index; keep entries while both targets still hold.
+            evicted = conn.execute(
+                "DELETE FROM responses WHERE rowid IN ("
+                "  SELECT rowid FROM ("
+                "    SELECT rowid,"
+                "      row_number() OVER (ORDER BY last_used_at DESC) AS n,"
+                "      sum(size) OVER (ORDER BY last_used_at DESC) AS running"
+                "    FROM responses"
+                "  ) WHERE n > ? OR running > ?"
+                ")",
+                (int(self.max_entries * EVICT_TO), int(self.max_bytes * EVICT_TO)),
+            ).rowcount
+        if expired or evicted:
+            self._bump(conn, expired=expired, evictions=evicted)
+
+    def stats(self):
+        """Return hit/miss counters and current size."""
+        self.flush()
+        conn = self._connect()
+        counters = dict(conn.execute("SELECT name, value FROM counters"))
+        entries, size = counters.get("entries", 0), counters.get("bytes", 0)
+        hits = counters.get("hits", 0)
+        lookups = hits + counters.get("misses", 0)
+        return {
+            "hits": hits,
+            "misses": counters.get("misses", 0),
+            "hit_ratio": hits / lookups if lookups else 0.0,
+            "stores": counters.get("stores", 0),
+            "evictions": counters.get("evictions", 0),
+            "expired": counters.get("expired", 0),
+            "entries": entries,
+            "bytes": int(size),
+        }
+
+    def clear(self):
+        """Remove every entry and reset the counters."""
+        conn = self._connect()
+        with self._pending_lock:
+            self._reset_pending()
+        with conn:
+            conn.execute("DELETE FROM responses")
+            conn.execute("UPDATE counters SET value = 0")
+
+
+def cache_from_config(config):
+    """Build a ResponseCache from app config, or None when it is disabled."""
+    if not config.get("PROVIDER_CACHE_ENABLED", True):
+        return None
+    return ResponseCache(
+        config["PROVIDER_CACHE_PATH"],
+        default_ttl=config["PROVIDER_CACHE_DEFAULT_TTL"],
+        max_ttl=config["PROVIDER_CACHE_MAX_TTL"],
+        max_bytes=config["PROVIDER_CACHE_MAX_BYTES"],
+        max_entries=config["PROVIDER_CACHE_MAX_ENTRIES"],
+    )
+
+
+# --- CLI ---
+
+
+@click.command("provider-cache-stats")
+@with_appcontext
+def provider_cache_stats_command():
+    """Show provider response cache hit/miss counters and size."""
+    cache = cache_from_config(current_app.config)
+    if cache is None:
+        click.echo("The provider response cache is disabled.")
+        return
+    for name, value in cache.stats().items():
+        if name == "hit_ratio":
+            value = f"{value:.1%}"
+        click.echo(f"{name:>10}: {value}")
+
+
+@click.command("provider-cache-clear")
+@with_appcontext
+def provider_cache_clear_command():
+    """Empty the provider response cache."""
+    cache = cache_from_config(current_app.config)
+    if cache is not None:
+        cache.clear()
+    click.echo("Provider response cache cleared.")
+
+
+def init_cli(app):
+    app.cli.add_command(provider_cache_stats_command)
+    app.cli.add_command(provider_cache_clear_command)
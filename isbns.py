@@ -0,0 +1,181 @@
+"""ISBN canonicalization and checksum validation.
+
+Books store their ISBN in one canonical form: ISBN-13, digits only. Writes
+(``add_book``, catalog imports, the seed data) pass the ISBN as typed
+through normalize_isbn(), which drops hyphens and spaces, checks the check
+digit and converts a valid ISBN-10 to its ISBN-13. ``book.isbn_valid``
+records the result, so listings never validate ISBNs themselves and the same
+book entered as ISBN-10 and as ISBN-13 is one ISBN.
+
+``isbn_valid`` is NULL for rows that have not been checked yet: rows that
+predate the column and rows written by other means, such as raw SQL.
+normalize_stored_isbns() canonicalizes those at startup, or on demand with
+``flask isbn-normalize``.
+"""
+
+import re
+
+import click
+import sqlalchemy as sa
+from flask.cli import with_appcontext
+
+from data_models import db, Book
+
+_ISBN10 = re.compile(r"\d{9}[\dX]")
+_ISBN13 = re.compile(r"97[89]\d{10}")
+
+
+def _isbn10_check_digit(core):
+    total = sum(int(d) * (10 - i) for i, d in enumerate(core))
+    check = -total % 11
+    return "X" if check == 10 else str(check)
+
+
+def _isbn13_check_digit(core):
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(core))
+    return str(-total % 10)
+
+
+def clean_isbn(value):
+    """Drop hyphens and spaces and upper-case a trailing "x"."""
+    return re.sub(r"[\s-]", "", value or "").upper()
+
+
+def to_isbn13(isbn10):
+    """Return the ISBN-13 of a cleaned ISBN-10 (its check digit is not checked)."""
+    core = "978" + isbn10[:9]
+    return core + _isbn13_check_digit(core)
+
+
+def to_isbn10(isbn13):
+    """Return the ISBN-10 of a cleaned 978 ISBN-13, or None for 979 ones."""
+    if not isbn13.startswith("978"):
+        return None
+    core = isbn13[3:12]
+    return core + _isbn10_check_digit(core)
+
+
+def normalize_isbn(value):
+    """Return ``(isbn, valid)`` for an ISBN as typed.
+
+    A valid ISBN-10 or ISBN-13 comes back as ISBN-13. Anything else comes
+    back cleaned (see clean_isbn()) with ``valid`` False, and an empty value
+    as ``(None, False)``.
+    """
+    isbn = clean_isbn(value)
+    if not isbn:
+        return None, False
+    if _ISBN10.fullmatch(isbn) and isbn[9] == _isbn10_check_digit(isbn[:9]):
+        return to_isbn13(isbn), True
+    if _ISBN13.fullmatch(isbn) and isbn[12] == _isbn13_check_digit(isbn[:12]):
+        return isbn, True
+    return isbn, False
+
+
+def isbn_forms(isbn):
+    """Return the stored forms that denote the same book as ``isbn``.
+
+    For a canonical ISBN-13 that is itself and its ISBN-10, which a
+    duplicate row left by normalize_stored_isbns() may still hold.
+    """
+    forms = [isbn]
+    isbn10 = to_isbn10(isbn) if _ISBN13.fullmatch(isbn) else None
+    if isbn10:
+        forms.append(isbn10)
+    return forms
+
+
+# --- Backfill ---
+
+
+# The next batch of unchecked rows. Most rows are checked, but the planner
+# cannot tell from the index statistics and would walk the primary key
+# instead, so the index is named.
+UNCHECKED_SQL = sa.text(
+    "SELECT id, isbn FROM book INDEXED BY ix_book_isbn_valid "
+    "WHERE isbn_valid IS NULL AND id > :last_id ORDER BY id LIMIT :limit"
+)
+
+
+def _isbn_taken(conn, isbn, book_id):
+    # Any number of books may have no ISBN.
+    if isbn is None:
+        return False
+    return (
+        conn.execute(
+            db.select(Book.id).where(Book.isbn == isbn, Book.id != book_id)
+        ).first()
+        is not None
+    )
+
+
+def normalize_stored_isbns(batch_size=1000):
+    """Canonicalize the ISBNs of rows that have not been checked yet.
+
+    Walks the rows with a NULL ``isbn_valid`` through ``ix_book_isbn_valid``
+    in id order, a batch per transaction, so it costs one index probe when
+    there is nothing to do. A row whose canonical ISBN already belongs to
+    another book (the same book entered once as ISBN-10 and once as
+    ISBN-13) is a duplicate: it keeps its own ISBN, cleaned if that form is
+    free. Returns counts of the rows ``checked``, ``changed`` (rewritten),
+    ``invalid`` and ``duplicates``.
+    """
+    counts = dict.fromkeys(("checked", "changed", "invalid", "duplicates"), 0)
+    last_id = 0
+    while True:
+        with db.engine.begin() as conn:
+            rows = conn.execute(
+                UNCHECKED_SQL, {"last_id": last_id, "limit": batch_size}
+            ).all()
+            if not rows:
+                return counts
+            last_id = rows[-1].id
+            flags = []
+            for book_id, stored in rows:
+                isbn, valid = normalize_isbn(stored)
+                counts["checked"] += 1
+                counts["invalid"] += not valid
+                flags.append({"book_id": book_id, "valid": valid})
+                # The canonical form, or failing that at least the cleaned one.
+                for candidate in dict.fromkeys((isbn, clean_isbn(stored) or None)):
+                    if candidate == stored:
+                        break
+                    if _isbn_taken(conn, candidate, book_id):
+                        counts["duplicates"] += candidate == isbn
+                        continue
+                    conn.execute(
+                        db.update(Book).where(Book.id == book_id).values(isbn=candidate)
+                    )
+                    counts["changed"] += 1
+                    break
+            # Most rows only get their flag, in one executemany.
+            conn.execute(
+                db.update(Book)
+                .where(Book.id == sa.bindparam("book_id"))
+                .values(isbn_valid=sa.bindparam("valid")),
+                flags,
+            )
+
+
+@click.command("isbn-normalize")
+@click.option("--limit", default=20, show_default=True, help="Invalid ISBNs to list.")
+@with_appcontext
+def isbn_normalize_command(limit):
+    """Canonicalize unchecked ISBNs and list the invalid ones."""
+    counts = normalize_stored_isbns()
+    click.echo(
+        f"Checked {counts['checked']} ISBNs: {counts['changed']} rewritten, "
+        f"{counts['invalid']} invalid, {counts['duplicates']} duplicates of other books."
+    )
+    invalid = db.session.execute(
+        db.select(Book.id, Book.isbn, Book.title)
+        .where(Book.isbn_valid.is_(False))
+        .order_by(Book.id)
+        .limit(limit)
+    ).all()
+    for book_id, isbn, title in invalid:
+        click.echo(f"book {book_id}: {isbn!r} ({title})")
+
+
+def init_cli(app):
+    app.cli.add_command(isbn_normalize_command)
@@ -0,0 +1,288 @@
+"""Pluggable metadata providers and a hedged lookup engine.
+
+A provider declares the book fields it can supply (``cover_url``,
+``synopsis``) and looks them up for one book. Providers are kept in a
+registry, in order of preference. To resolve a book, the engine starts the
+first provider that can supply a missing field and, if no answer has come
+back after ``hedge_delay`` seconds (or the provider answered without
+filling every field), starts the next one as well. The first answer for
+each field wins; providers that are no longer needed are not started, and
+those still running are abandoned. With a hedge delay of 0 every eligible
+provider runs at once; with None they run one after another.
+
+The registry keeps per-provider counts of hits, misses and errors and the
+time lookups took, so the order can be tuned from real numbers (see
+``suggested_order()``).
+
+Adding a provider does not touch the engine::
+
+    class WorldCat(MetadataProvider):
+        name = "worldcat"
+        client = "worldcat"
+        fields = frozenset({"synopsis"})
+
+        def fetch(self, lookup, wanted):
+            ...
+            return {"synopsis": text}
+
+    METADATA_PROVIDERS.register(WorldCat())
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+FIELDS = ("cover_url", "synopsis")
+
+# Lookup outcomes. SKIPPED marks a provider that was needed but not asked,
+# because its circuit breaker was open or the lookup's time budget ran out.
+HIT, MISS, ERROR, SKIPPED = "hit", "miss", "error", "skipped"
+
+# Threads shared by all lookups of a process for running providers. Each
+# provider client still caps its own simultaneous requests.
+MAX_PROVIDER_THREADS = 64
+
+
+class ProviderSkipped(Exception):
+    """Raised by MetadataProvider.fetch() for a lookup that was never sent."""
+
+
+class MetadataProvider:
+    """A source of book metadata.
+
+    ``name`` identifies the provider in the registry, in stats and in a
+    book's recorded lookup outcomes; ``client`` names the provider client
+    (and circuit breaker) its requests go through.
+    """
+
+    name = None
+    client = None
+    fields = frozenset()
+
+    def applies(self, lookup):
+        """Return True if the provider can look up this book at all."""
+        return True
+
+    def fetch(self, lookup, wanted):
+        """Look up the ``wanted`` fields of a _lookup_fields() dict.
+
+        Returns a dict of the fields found (possibly empty), or None if the
+        request failed. Raises ProviderSkipped if it was not sent.
+        """
+        raise NotImplementedError
+
+
+class _ProviderStats:
+    __slots__ = ("hits", "misses", "errors", "skipped", "answers", "seconds")
+
+    def __init__(self):
+        self.hits = self.misses = self.errors = self.skipped = 0
+        self.answers = 0
+        self.seconds = 0.0
+
+
+class ProviderRegistry:
+    """Metadata providers in order of preference, with their lookup stats."""
+
+    def __init__(self):
+        self._providers = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    def register(self, provider):
+        """Add ``provider``, or replace the one registered under its name."""
+        self._providers[provider.name] = provider
+        with self._lock:
+            self._stats.setdefault(provider.name, _ProviderStats())
+        return provider
+
+    def unregister(self, name):
+        self._providers.pop(name, None)
+
+    def names(self):
+        return list(self._providers)
+
+    def ordered(self, order=()):
+        """Return the providers named in ``order`` first, then the others."""
+        named = [self._providers[name] for name in order if name in self._providers]
+        return named + [
+            provider for provider in self._providers.values() if provider not in named
+        ]
+
+    # --- Stats ---
+
+    def _record(self, name, outcome, seconds):
+        with self._lock:
+            stats = self._stats.setdefault(name, _ProviderStats())
+            if outcome == HIT:
+                stats.hits += 1
+            elif outcome == MISS:
+                stats.misses += 1
+            elif outcome == ERROR:
+                stats.errors += 1
+            else:
+                stats.skipped += 1
+                return
+            stats.seconds += seconds
+
+    def _record_answers(self, name, count):
+        with self._lock:
+            self._stats[name].answers += count
+
+    def stats(self):
+        """Return per-provider lookup counts, success rate and mean latency.
+
+        ``answers`` counts the fields a provider supplied first; a provider
+        that hits but is always beaten by another one answers nothing.
+        """
+        with self._lock:
+            snapshot = {}
+            for name, stats in self._stats.items():
+                sent = stats.hits + stats.misses + stats.errors
+                snapshot[name] = {
+                    "lookups": sent,
+                    "hits": stats.hits,
+                    "misses": stats.misses,
+                    "errors": stats.errors,
+                    "skipped": stats.skipped,
+                    "answers": stats.answers,
+                    "seconds": stats.seconds,
+                    "success_rate": stats.hits / sent if sent else None,
+                    "mean_seconds": stats.seconds / sent if sent else None,
+                }
+            return snapshot
+
+    def reset_stats(self):
+        with self._lock:
+            for name in self._stats:
+                self._stats[name] = _ProviderStats()
+
+    def suggested_order(self):
+        """Return provider names by success rate, then by mean latency.
+
+        Providers with no lookups yet keep their place after the others.
+        """
+        stats = self.stats()
+        names = self.names()
+        measured = [name for name in names if stats.get(name, {}).get("lookups")]
+        measured.sort(
+            key=lambda name: (
+                -stats[name]["success_rate"],
+                stats[name]["mean_seconds"],
+            )
+        )
+        return measured + [name for name in names if name not in measured]
+
+    # --- Engine ---
+
+    def _get_executor(self):
+        # Threads do not survive a fork, so worker processes need their own.
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=MAX_PROVIDER_THREADS, thread_name_prefix="provider"
+                )
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _run(self, provider, lookup, wanted):
+        started = time.perf_counter()
+        try:
+            values = provider.fetch(lookup, wanted)
+        except ProviderSkipped:
+            outcome, values = SKIPPED, None
+        else:
+            if values is None:
+                outcome = ERROR
+            else:
+                values = {field: value for field, value in values.items() if value}
+                outcome = HIT if wanted & values.keys() else MISS
+        self._record(provider.name, outcome, time.perf_counter() - started)
+        return outcome, values
+
+    def resolve(
+        self,
+        lookup,
+        order=(),
+        hedge_delay=None,
+        deadline=None,
+        can_query=None,
+        exclude=(),
+    ):
+        """Resolve the missing fields of a _lookup_fields() dict.
+
+        Providers are tried in ``order`` (see ordered()), skipping those in
+        ``exclude``. ``can_query(provider)`` returning False marks a provider
+        SKIPPED without running it, e.g. while its circuit breaker is open.
+        Once ``deadline`` (a time.monotonic() value) has passed, the
+        providers still running or not yet started are marked SKIPPED.
+
+        Returns ``(values, outcomes)``: the fields found, and HIT, MISS,
+        ERROR or SKIPPED for each provider that was needed.
+        """
+        values = {}
+        outcomes = {}
+        missing = {field for field in FIELDS if not lookup.get(field)}
+        pending = [
+            provider
+            for provider in self.ordered(order)
+            if provider.name not in exclude and provider.applies(lookup)
+        ]
+        running = {}
+        next_start = time.monotonic()
+
+        while missing:
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                break
+            while pending and (
+                not running or (hedge_delay is not None and now >= next_start)
+            ):
+                provider = pending.pop(0)
+                if not provider.fields & missing:
+                    continue
+                if can_query is not None and not can_query(provider):
+                    outcomes[provider.name] = SKIPPED
+                    continue
+                wanted = provider.fields & missing
+                future = self._get_executor().submit(
+                    self._run, provider, lookup, wanted
+                )
+                running[future] = provider
+                if hedge_delay is not None:
+                    next_start = now + hedge_delay
+            if not running:
+                break
+
+            timeouts = []
+            if deadline is not None:
+                timeouts.append(deadline - now)
+            if pending and hedge_delay is not None:
+                timeouts.append(next_start - now)
+            done, _ = wait(
+                running,
+                timeout=max(min(timeouts), 0) if timeouts else None,
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                provider = running.pop(future)
+                outcome, found = future.result()
+                outcomes[provider.name] = outcome
+                answered = missing & (found or {}).keys()
+                for field in answered:
+                    values[field] = found[field]
+                missing -= answered
+                if answered:
+                    self._record_answers(provider.name, len(answered))
+
+        if missing and deadline is not None and time.monotonic() >= deadline:
+            for provider in list(running.values()) + pending:
+                if provider.fields & missing:
+                    outcomes[provider.name] = SKIPPED
+        return values, outcomes
+
+
+METADATA_PROVIDERS = ProviderRegistry()
@@ -0,0 +1,412 @@
+"""Per-request timing metrics, exposed at ``/metrics`` in Prometheus format.
+
+For every request this records the total latency, the number and time of
+SQL statements (from engine events), the number and time of metadata
+provider requests (from ``helpers.PROVIDER_LISTENERS``) and the time spent
+rendering templates, labelled by endpoint. Provider requests made outside a
+request thread (enrichment workers, cover downloads) are labelled
+``background``. The enrichment queue depth by status and the workers' job
+counts are read when the metrics are rendered.
+
+With METRICS_SERVER_TIMING set, the same breakdown is sent to the browser
+in a ``Server-Timing`` header and shows up in the devtools network panel.
+
+Metrics are kept in memory per process; with several server processes each
+one reports its own.
+"""
+
+import threading
+import time
+
+from flask import (
+    Response,
+    before_render_template,
+    current_app,
+    request,
+    template_rendered,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import circuit_breaker
+import enrichment
+import helpers
+from metadata_pipeline import METADATA_PROVIDERS
+
+DEFAULT_CONFIG = {
+    "METRICS_ENABLED": True,
+    "METRICS_SERVER_TIMING": False,
+    # Upper bounds, in seconds, of the latency histogram buckets.
+    "METRICS_BUCKETS": (
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+    ),
+}
+
+BACKGROUND = "background"
+
+# name: (type, help)
+METRICS = {
+    "http_requests_total": ("counter", "Requests handled, by status."),
+    "http_request_duration_seconds": ("histogram", "Request latency."),
+    "db_statements_total": ("counter", "SQL statements executed by requests."),
+    "db_statement_seconds_total": ("counter", "Time spent in SQL statements."),
+    "request_db_seconds": ("histogram", "SQL time per request."),
+    "provider_requests_total": (
+        "counter",
+        "Metadata provider requests sent over the network.",
+    ),
+    "provider_request_duration_seconds": (
+        "histogram",
+        "Metadata provider request latency.",
+    ),
+    "template_render_seconds": ("histogram", "Template render time per request."),
+    "provider_breaker_state": (
+        "gauge",
+        "Provider circuit breaker state: 0 closed, 1 half-open, 2 open.",
+    ),
+    "provider_breaker_trips_total": (
+        "counter",
+        "Times the provider circuit breaker opened.",
+    ),
+    "provider_breaker_rejections_total": (
+        "counter",
+        "Provider requests rejected by an open circuit breaker.",
+    ),
+    "metadata_lookups_total": (
+        "counter",
+        "Metadata provider lookups, by outcome (hit, miss, error, skipped).",
+    ),
+    "metadata_lookup_seconds_total": (
+        "counter",
+        "Time spent in metadata provider lookups that were sent.",
+    ),
+    "metadata_lookup_answers_total": (
+        "counter",
+        "Book fields a metadata provider supplied before any other provider.",
+    ),
+    "enrichment_queue_jobs": ("gauge", "Enrichment jobs in the queue, by status."),
+    "enrichment_jobs_processed_total": (
+        "counter",
+        "Enrichment jobs processed by this process's workers.",
+    ),
+    "enrichment_jobs_failed_total": (
+        "counter",
+        "Enrichment jobs that failed in this process's workers.",
+    ),
+    "enrichment_books_updated_total": (
+        "counter",
+        "Books updated by this process's enrichment workers.",
+    ),
+}
+
+
+class Registry:
+    """Thread-safe counters and histograms, rendered in Prometheus text format."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._counters = {}
+        # key: [count per bucket, sum, count]
+        self._histograms = {}
+        self._collectors = []
+
+    def add_collector(self, collect):
+        """Register ``collect()``, which returns ``(name, labels, value)``
+        samples read at render time, e.g. gauges of another module's state."""
+        self._collectors.append(collect)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, labels, value=1):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {
+                key: (list(counts), total, count)
+                for key, (counts, total, count) in self._histograms.items()
+            }
+        for collect in self._collectors:
+            for name, labels, value in collect():
+                counters[self._key(name, labels)] = value
+
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind in ("counter", "gauge"):
+                for (key_name, labels), value in sorted(counters.items()):
+                    if key_name == name:
+                        lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                continue
+            for (key_name, labels), (counts, total, count) in sorted(
+                histograms.items()
+            ):
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    le = labels + (("le", _number(bound)),)
+                    lines.append(f"{name}_bucket{_labels(le)} {cumulative}")
+                le = labels + (("le", "+Inf"),)
+                lines.append(f"{name}_bucket{_labels(le)} {count}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+                lines.append(f"{name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+# --- Per-request timings ---
+
+
+class RequestTimings:
+    """Time spent by one request, gathered on the thread that serves it."""
+
+    __slots__ = (
+        "started",
+        "status",
+        "sql_count",
+        "sql_seconds",
+        "provider_count",
+        "provider_seconds",
+        "template_seconds",
+        "template_starts",
+    )
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.status = 500
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.provider_count = 0
+        self.provider_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_starts = []
+
+
+_local = threading.local()
+
+
+def current_timings():
+    """Return the RequestTimings of the request on this thread, if any."""
+    return getattr(_local, "timings", None)
+
+
+def _endpoint():
+    return request.endpoint or "unmatched"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+    if current_timings() is not None:
+        conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, many):
+    started = conn.info.get("metrics_started")
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    timings = current_timings()
+    if timings is not None:
+        timings.sql_count += 1
+        timings.sql_seconds += elapsed
+
+
+def _before_render(sender, template, context, **extra):
+    timings = current_timings()
+    if timings is not None:
+        timings.template_starts.append(time.perf_counter())
+
+
+def _after_render(sender, template, context, **extra):
+    timings = current_timings()
+    if timings is not None and timings.template_starts:
+        started = timings.template_starts.pop()
+        # Nested renders are already part of the outer one.
+        if not timings.template_starts:
+            timings.template_seconds += time.perf_counter() - started
+
+
+def _provider_request(registry):
+    def record(provider, seconds, outcome):
+        timings = current_timings()
+        if timings is not None:
+            timings.provider_count += 1
+            timings.provider_seconds += seconds
+            endpoint = _endpoint()
+        else:
+            endpoint = BACKGROUND
+        registry.inc(
+            "provider_requests_total",
+            {"endpoint": endpoint, "provider": provider, "outcome": outcome},
+        )
+        registry.observe(
+            "provider_request_duration_seconds", {"provider": provider}, seconds
+        )
+
+    return record
+
+
+def _breaker_samples():
+    for provider, breaker in helpers._provider_breakers().items():
+        labels = {"provider": provider}
+        yield (
+            "provider_breaker_state",
+            labels,
+            circuit_breaker.STATES.index(breaker["state"]),
+        )
+        yield "provider_breaker_trips_total", labels, breaker["trips"]
+        yield "provider_breaker_rejections_total", labels, breaker["rejections"]
+
+
+def _metadata_provider_samples():
+    for provider, stats in METADATA_PROVIDERS.stats().items():
+        labels = {"provider": provider}
+        for outcome, count in (
+            ("hit", stats["hits"]),
+            ("miss", stats["misses"]),
+            ("error", stats["errors"]),
+            ("skipped", stats["skipped"]),
+        ):
+            yield "metadata_lookups_total", {**labels, "outcome": outcome}, count
+        yield "metadata_lookup_seconds_total", labels, stats["seconds"]
+        yield "metadata_lookup_answers_total", labels, stats["answers"]
+
+
+def _enrichment_samples():
+    stats = enrichment.enrichment_stats()
+    for status, count in stats["queue"].items():
+        yield "enrichment_queue_jobs", {"status": status}, count
+    workers = stats["workers"]
+    yield "enrichment_jobs_processed_total", {}, workers["processed"]
+    yield "enrichment_jobs_failed_total", {}, workers["failed"]
+    yield "enrichment_books_updated_total", {}, workers["updated"]
+
+
+def server_timing(timings):
+    """Return a Server-Timing header value for ``timings``."""
+    elapsed = time.perf_counter() - timings.started
+    return ", ".join(
+        [
+            f"app;dur={elapsed * 1000:.1f}",
+            f'db;dur={timings.sql_seconds * 1000:.1f};desc="{timings.sql_count} SQL"',
+            f"provider;dur={timings.provider_seconds * 1000:.1f}"
+            f';desc="{timings.provider_count} requests"',
+            f"template;dur={timings.template_seconds * 1000:.1f}",
+        ]
+    )
+
+
+def _start_request():
+    _local.timings = RequestTimings()
+
+
+def _finish_response(response):
+    timings = current_timings()
+    if timings is None:
+        return response
+    timings.status = response.status_code
+    if current_app.config["METRICS_SERVER_TIMING"]:
+        response.headers["Server-Timing"] = server_timing(timings)
+    return response
+
+
+def _record_request(exc):
+    timings = current_timings()
+    if timings is None:
+        return
+    _local.timings = None
+    registry = current_app.extensions["metrics"]
+    elapsed = time.perf_counter() - timings.started
+    endpoint = {"endpoint": _endpoint()}
+    status = 500 if exc is not None else timings.status
+    registry.inc(
+        "http_requests_total",
+        {**endpoint, "method": request.method, "status": status},
+    )
+    registry.observe("http_request_duration_seconds", endpoint, elapsed)
+    registry.inc("db_statements_total", endpoint, timings.sql_count)
+    registry.inc("db_statement_seconds_total", endpoint, timings.sql_seconds)
+    registry.observe("request_db_seconds", endpoint, timings.sql_seconds)
+    if timings.template_seconds:
+        registry.observe("template_render_seconds", endpoint, timings.template_seconds)
+
+
+def metrics_view():
+    return Response(
+        current_app.extensions["metrics"].render(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    if not app.config["METRICS_ENABLED"]:
+        return
+    registry = Registry(app.config["METRICS_BUCKETS"])
+    app.extensions["metrics"] = registry
+
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    helpers.PROVIDER_LISTENERS.append(_provider_request(registry))
+    registry.add_collector(_breaker_samples)
+    registry.add_collector(_metadata_provider_samples)
+    registry.add_collector(_enrichment_samples)
+
+    app.before_request(_start_request)
+    app.after_request(_finish_response)
+    app.teardown_request(_record_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
@@ -0,0 +1,317 @@
+"""Idempotent schema upgrades and query plan checks for the library database.
+
+``db.create_all()`` only creates missing tables, so databases created by an
+older version of the app never get columns or indexes added to existing
+tables. ``upgrade_schema()`` fills that gap and is safe to run on every start.
+"""
+
+import sqlite3
+import time
+
+import click
+import sqlalchemy as sa
+from flask.cli import with_appcontext
+
+from data_models import db, Book, PUBLISHED_ASC_KEY, RATING_DESC_KEY
+from helpers import BOOK_LISTING, SORT_ORDERS, _book_query_and_keys, _keyset_query
+from isbns import UNCHECKED_SQL
+
+
+def add_missing_columns():
+    """Add any column declared on the models that the database lacks.
+
+    New columns must be nullable or have a constant server default, as
+    SQLite's ALTER TABLE requires. A column whose ``info`` has a ``backfill``
+    SQL expression is filled with it for existing rows. Returns
+    ``table.column`` names.
+    """
+    inspector = sa.inspect(db.engine)
+    added = []
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    spec = sa.schema.CreateColumn(column).compile(dialect=conn.dialect)
+                    conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {spec}")
+                    if "backfill" in column.info:
+                        conn.exec_driver_sql(
+                            f"UPDATE {table.name} "
+                            f"SET {column.name} = {column.info['backfill']}"
+                        )
+                    added.append(f"{table.name}.{column.name}")
+    return added
+
+
+# Indexes older versions created that nothing uses any more. Rating and
+# publication date are sorted and filtered through the coalesce() keys, which
+# have their own indexes.
+RETIRED_INDEXES = ("ix_book_rating", "ix_book_publication_date")
+
+
+def drop_retired_indexes():
+    """Drop the RETIRED_INDEXES the database still has and return their names."""
+    with db.engine.begin() as conn:
+        existing = set(
+            conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            ).scalars()
+        )
+        retired = [name for name in RETIRED_INDEXES if name in existing]
+        for name in retired:
+            conn.exec_driver_sql(f'DROP INDEX "{name}"')
+    return retired
+
+
+def upgrade_schema():
+    """Create any column or index declared on the models that the database lacks.
+
+    Also drops the RETIRED_INDEXES. Returns the names of the columns and
+    indexes that were created. Requires an app context.
+    """
+    drop_retired_indexes()
+    created = add_missing_columns()
+    # Read from sqlite_master, as SQLAlchemy does not reflect expression
+    # indexes.
+    with db.engine.connect() as conn:
+        existing = set(
+            conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            ).scalars()
+        )
+    indexes = []
+    for table in db.metadata.sorted_tables:
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing:
+                index.create(db.engine)
+                indexes.append(index.name)
+    if indexes:
+        # Refresh the planner statistics so the new indexes get used.
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("ANALYZE")
+    return created + indexes
+
+
+# --- Query plan checks ---
+
+# How a hot query may start reading (see hot_queries()).
+SEEK, SCAN, ROWID = "seek", "scan", "rowid"
+
+# Sample cursor values per sort order; the plan does not depend on the
+# actual values.
+SAMPLE_CURSORS = {
+    "title": ["m", 0],
+    "author": ["m", 0, 0],
+    "rating": [5, 0],
+    "published": ["2000-01-01", 0],
+    "added": [0],
+}
+
+
+def _listing_query(sort_by, after=None):
+    query, sort_keys = _book_query_and_keys(sort_by, "", BOOK_LISTING)
+    return _keyset_query(query, sort_keys, 50, after=after)
+
+
+def _listing_queries():
+    """First and later pages of every listing sort order, in both directions."""
+    queries = []
+    for name in SORT_ORDERS:
+        # The "added" order reads the table itself, in rowid order.
+        first_page = ROWID if name == "added" else SCAN
+        for sort_by in (name, f"-{name}"):
+            queries.append(
+                (
+                    f"home, {sort_by} sort, first page",
+                    _listing_query(sort_by),
+                    first_page,
+                )
+            )
+            queries.append(
+                (
+                    f"home, {sort_by} sort, later page",
+                    _listing_query(sort_by, SAMPLE_CURSORS[name]),
+                    SEEK,
+                )
+            )
+    return queries
+
+
+def hot_queries():
+    """Return ``(name, query, access)`` for the queries the routes run most.
+
+    ``access`` is SEEK for queries that must start with an index seek rather
+    than an index scan from the beginning, such as later keyset pages, SCAN
+    for those that may scan an index in order, and ROWID for those that may
+    scan the table itself in rowid order.
+    """
+    return _listing_queries() + [
+        (
+            "author detail, books by author",
+            Book.query.filter_by(author_id=1),
+            SEEK,
+        ),
+        (
+            "add book, ISBN probe",
+            Book.query.filter(Book.isbn.in_(["9780000000000", "0000000000"])),
+            SEEK,
+        ),
+        (
+            "startup, unchecked ISBNs",
+            UNCHECKED_SQL.bindparams(last_id=0, limit=1000),
+            SEEK,
+        ),
+        (
+            "invalid ISBNs",
+            Book.query.filter(Book.isbn_valid.is_(False)).order_by(Book.id).limit(20),
+            SEEK,
+        ),
+        (
+            "author aggregates, latest publication",
+            db.session.query(sa.func.max(Book.publication_date)).filter(
+                Book.author_id == 1
+            ),
+            SEEK,
+        ),
+        (
+            "top rated books",
+            Book.query.filter(Book.rating.isnot(None))
+            .order_by(RATING_DESC_KEY.desc(), Book.id.desc())
+            .limit(20),
+            SCAN,
+        ),
+        (
+            "published since a date",
+            Book.query.filter(
+                PUBLISHED_ASC_KEY >= "2000-01-01", Book.publication_date.isnot(None)
+            )
+            .order_by(PUBLISHED_ASC_KEY, Book.id)
+            .limit(20),
+            SEEK,
+        ),
+    ]
+
+
+def compile_sql(query):
+    """Render a query (or a statement) as a literal SQL string for SQLite."""
+    statement = getattr(query, "statement", query)
+    return str(
+        statement.compile(
+            dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}
+        )
+    )
+
+
+def plan_problems(conn, sql, access=SCAN):
+    """Find the problem steps in the query plan of ``sql``.
+
+    A step is a problem if it scans a whole table without an index (unless
+    ``access`` is ROWID and it is the first step), sorts in a temporary
+    b-tree, or (with SEEK) scans where it should seek. ``conn`` is a DB-API
+    sqlite3 connection. Returns ``(problems, steps)``.
+    """
+    details = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+    problems = [
+        detail
+        for i, detail in enumerate(details)
+        if (
+            detail.startswith("SCAN ")
+            and " USING " not in detail
+            and not (access == ROWID and i == 0)
+        )
+        or "TEMP B-TREE" in detail
+    ]
+    if access == SEEK and details and details[0].startswith("SCAN "):
+        problems.append(details[0])
+    return problems, details
+
+
+def _time_query(conn, sql, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        conn.execute(sql).fetchall()
+    return (time.perf_counter() - started) / repeat
+
+
+def benchmark_indexes(source, queries, repeat):
+    """Time each query with and without the managed indexes.
+
+    The comparison runs on an in-memory copy of the database, so the real
+    file is never modified. Returns ``{name: (indexed_s, unindexed_s)}``.
+    """
+    copy = sqlite3.connect(":memory:")
+    source.backup(copy)
+    timings = {name: [_time_query(copy, sql, repeat)] for name, sql in queries}
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if not index.unique:
+                copy.execute(f"DROP INDEX IF EXISTS {index.name}")
+    for name, sql in queries:
+        timings[name].append(_time_query(copy, sql, repeat))
+    copy.close()
+    return {name: tuple(pair) for name, pair in timings.items()}
+
+
+@click.command("db-upgrade")
+@with_appcontext
+def db_upgrade_command():
+    """Add missing columns and indexes to an existing database."""
+    created = upgrade_schema()
+    if created:
+        click.echo(f"Created: {', '.join(created)}")
+    else:
+        click.echo("Schema is up to date.")
+
+
+@click.command("check-query-plans")
+@click.option(
+    "--benchmark",
+    is_flag=True,
+    help="Also time each query with and without the indexes.",
+)
+@click.option("--repeat", default=20, show_default=True, help="Runs per timing.")
+@with_appcontext
+def check_query_plans_command(benchmark, repeat):
+    """Fail if a hot query needs a full table scan or a sort.
+
+    Runs EXPLAIN QUERY PLAN for the listing, detail and lookup queries and
+    exits with status 1 if any of them scans a whole table, builds a
+    temporary b-tree to sort, or scans an index it should seek into.
+    """
+    queries = [
+        (name, compile_sql(query), access) for name, query, access in hot_queries()
+    ]
+    raw = db.engine.raw_connection()
+    try:
+        failures = 0
+        for name, sql, access in queries:
+            problems, details = plan_problems(raw.driver_connection, sql, access)
+            status = "FAIL" if problems else "ok"
+            failures += bool(problems)
+            click.echo(f"[{status}] {name}")
+            for detail in details:
+                click.echo(f"       {detail}")
+
+        if benchmark:
+            click.echo("\nMean time per query (ms): indexed / without indexes")
+            timings = benchmark_indexes(
+                raw.driver_connection,
+                [(name, sql) for name, sql, _ in queries],
+                repeat,
+            )
+            for name, (indexed, unindexed) in timings.items():
+                speedup = unindexed / indexed if indexed else float("inf")
+                click.echo(
+                    f"  {name}: {indexed * 1000:.2f} / {unindexed * 1000:.2f}"
+                    f" ({speedup:.1f}x)"
+                )
+    finally:
+        raw.close()
+
+    if failures:
+        raise click.ClickException(f"{failures} hot queries fall back to a scan.")
+
+
+def init_cli(app):
+    app.cli.add_command(db_upgrade_command)
+    app.cli.add_command(check_query_plans_command)
@@ -0,0 +1,585 @@
+"""Cache of rendered listing and detail pages.
+
+Pages are keyed by endpoint and normalized arguments and tagged with what
+they show (``listing``, ``book:<id>``, ``author:<id>``). Committed changes to
+Book and Author rows invalidate exactly the tags they affect, whether they
+come from a write route or from the background enrichment workers.
+
+Two backends are available: a bounded in-memory LRU for a single process,
+and an SQLite file shared by every worker process. The SQLite backend is not
+an LRU: once full it evicts the pages stored longest ago, however recently
+they were read, so that lookups stay read-only.
+"""
+
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import click
+from flask import current_app, g, make_response, request, session
+from flask.cli import with_appcontext
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from data_models import Author, Book
+
+DEFAULT_CONFIG = {
+    # "memory", "sqlite" or "none"
+    "PAGE_CACHE_BACKEND": "memory",
+    "PAGE_CACHE_PATH": os.path.join(
+        os.path.abspath(os.path.dirname(__file__)), "data", "page_cache.sqlite"
+    ),
+    "PAGE_CACHE_MAX_ENTRIES": 1000,
+    # Upper bound on staleness for changes the cache cannot see, such as
+    # writes made by another process when using the memory backend.
+    "PAGE_CACHE_TTL": 300,
+}
+
+LISTING_TAG = "listing"
+
+STAT_COUNTERS = ("hits", "misses", "stores", "invalidations")
+
+# The SQLite backend keeps its counters in memory and writes them once this
+# many were counted or this many seconds passed (or with the next store or
+# invalidation), so a lookup does not take the write lock.
+COUNT_FLUSH_SIZE = 256
+COUNT_FLUSH_SECONDS = 5.0
+
+
+class MemoryBackend:
+    """A thread-safe, bounded LRU of pages for one process."""
+
+    def __init__(self, max_entries=1000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._keys_by_tag = {}
+        self._generation = 0
+        self._counters = dict.fromkeys(STAT_COUNTERS, 0)
+
+    def generation(self):
+        return self._generation
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry["expires_at"] <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry["page"]
+
+    def set(self, key, page, tags, generation):
+        with self._lock:
+            # Something was invalidated while this page rendered; it may
+            # already be stale.
+            if generation != self._generation:
+                return False
+            self._remove(key)
+            self._entries[key] = {
+                "page": page,
+                "tags": tags,
+                "expires_at": time.time() + self.ttl,
+            }
+            for tag in tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+            return True
+
+    def invalidate(self, tags):
+        with self._lock:
+            self._generation += 1
+            keys = set()
+            for tag in tags:
+                keys |= self._keys_by_tag.get(tag, set())
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._keys_by_tag.clear()
+            self._counters = dict.fromkeys(STAT_COUNTERS, 0)
+
+    def size(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry["tags"]:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    key TEXT PRIMARY KEY,
+    page TEXT NOT NULL,
+    stored_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_pages_stored_at ON pages (stored_at);
+CREATE TABLE IF NOT EXISTS page_tags (
+    tag TEXT NOT NULL,
+    key TEXT NOT NULL REFERENCES pages (key) ON DELETE CASCADE,
+    PRIMARY KEY (tag, key)
+);
+CREATE INDEX IF NOT EXISTS ix_page_tags_key ON page_tags (key);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (name, value) VALUES ('generation', 0);
+"""
+
+
+class SQLiteBackend:
+    """Pages stored in an SQLite file, shared by every worker process.
+
+    Once full, the pages stored longest ago are evicted first (FIFO, not
+    LRU): tracking reads would turn every hit into a write to the shared
+    file.
+    """
+
+    def __init__(self, path, max_entries=1000, ttl=300):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        self._schema_ready = False
+        self._pending_lock = threading.Lock()
+        self._reset_pending()
+
+    def _reset_pending(self):
+        self._pending = dict.fromkeys(STAT_COUNTERS, 0)
+        self._pending_total = 0
+        self._pending_since = time.monotonic()
+        self._pending_pid = os.getpid()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        # Connections must not be shared with a forked child process.
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            if not self._schema_ready:
+                conn.executescript(SQLITE_SCHEMA)
+                self._schema_ready = True
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def generation(self):
+        row = (
+            self._connect()
+            .execute("SELECT value FROM meta WHERE name = 'generation'")
+            .fetchone()
+        )
+        return row[0] if row else 0
+
+    def get(self, key):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT page FROM pages WHERE key = ? AND expires_at > ?",
+            (key, time.time()),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def count(self, name, amount=1):
+        with self._pending_lock:
+            if self._pending_pid != os.getpid():
+                self._reset_pending()
+            self._pending[name] += amount
+            self._pending_total += 1
+            due = (
+                self._pending_total >= COUNT_FLUSH_SIZE
+                or time.monotonic() - self._pending_since >= COUNT_FLUSH_SECONDS
+            )
+        if due:
+            self.flush()
+
+    def _write_pending(self, conn):
+        """Write the buffered counters; call inside a transaction."""
+        with self._pending_lock:
+            if self._pending_pid != os.getpid():
+                self._reset_pending()
+            counts = self._pending
+            self._reset_pending()
+        conn.executemany(
+            "INSERT INTO meta (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            [(name, value) for name, value in counts.items() if value],
+        )
+
+    def flush(self):
+        """Write the buffered counters now."""
+        conn = self._connect()
+        with conn:
+            self._write_pending(conn)
+
+    def counters(self):
+        self.flush()
+        rows = self._connect().execute(
+            "SELECT name, value FROM meta WHERE name != 'generation'"
+        )
+        return dict(rows)
+
+    def set(self, key, page, tags, generation):
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            # BEGIN IMMEDIATE makes the generation check and the insert
+            # atomic with respect to invalidations from other processes.
+            conn.execute("BEGIN IMMEDIATE")
+            if self.generation() != generation:
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO pages (key, page, stored_at, expires_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, json.dumps(page), now, now + self.ttl),
+            )
+            conn.execute("DELETE FROM page_tags WHERE key = ?", (key,))
+            conn.executemany(
+                "INSERT INTO page_tags (tag, key) VALUES (?, ?)",
+                [(tag, key) for tag in tags],
+            )
+            conn.execute(
+                "DELETE FROM pages WHERE key IN ("
+                "  SELECT key FROM pages ORDER BY stored_at DESC LIMIT -1 OFFSET ?"
+                ")",
+                (self.max_entries,),
+            )
+            self._write_pending(conn)
+        return True
+
+    def invalidate(self, tags):
+        tags = list(tags)
+        conn = self._connect()
+        with conn:
+            conn.execute("UPDATE meta SET value = value + 1 WHERE name = 'generation'")
+            self._write_pending(conn)
+            placeholders = ", ".join("?" for _ in tags)
+            return conn.execute(
+                f"DELETE FROM pages WHERE key IN ("
+                f"  SELECT key FROM page_tags WHERE tag IN ({placeholders})"
+                f")",
+                tags,
+            ).rowcount
+
+    def clear(self):
+        conn = self._connect()
+        with self._pending_lock:
+            self._reset_pending()
+        with conn:
+            conn.execute("UPDATE meta SET value = value + 1 WHERE name = 'generation'")
+            conn.execute("DELETE FROM pages")
+            conn.execute("DELETE FROM meta WHERE name != 'generation'")
+
+    def size(self):
+        return self._connect().execute("SELECT count(*) FROM pages").fetchone()[0]
+
+
+class PageCache:
+    """Front end to a backend; a backend that fails counts as a miss."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def _count(self, name, amount=1):
+        try:
+            self.backend.count(name, amount)
+        except sqlite3.Error:
+            pass
+
+    def get(self, key):
+        try:
+            page = self.backend.get(key)
+        except sqlite3.Error:
+            page = None
+        self._count("hits" if page is not None else "misses")
+        return page
+
+    def set(self, key, page, tags, generation):
+        try:
+            stored = self.backend.set(key, page, tags, generation)
+        except sqlite3.Error:
+            stored = False
+        if stored:
+            self._count("stores")
+        return stored
+
+    def generation(self):
+        try:
+            return self.backend.generation()
+        except sqlite3.Error:
+            return None
+
+    def invalidate(self, tags):
+        if not tags:
+            return 0
+        try:
+            removed = self.backend.invalidate(tags)
+        except sqlite3.Error:
+            return 0
+        self._count("invalidations", removed)
+        return removed
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        """Return hit/miss counters and the number of cached pages.
+
+        The memory backend counts this process only; the SQLite backend counts
+        every process sharing the file, though other processes' counts may be
+        up to COUNT_FLUSH_SECONDS behind.
+        """
+        counters = self.backend.counters()
+        hits = counters.get("hits", 0)
+        lookups = hits + counters.get("misses", 0)
+        return {
+            "hits": hits,
+            "misses": counters.get("misses", 0),
+            "hit_ratio": hits / lookups if lookups else 0.0,
+            "stores": counters.get("stores", 0),
+            "invalidations": counters.get("invalidations", 0),
+            "entries": self.backend.size(),
+        }
+
+
+def cache_key(endpoint, view_args, args):
+    """Build a cache key from the endpoint, URL variables and query string.
+
+    Empty arguments are dropped and the rest sorted, so equivalent URLs share
+    an entry.
+    """
+    normalized = sorted(
+        (name, value.strip())
+        for name, values in args.lists()
+        for value in values
+        if value.strip()
+    )
+    return json.dumps(
+        [endpoint, sorted(view_args.items()), normalized], separators=(",", ":")
+    )
+
+
+def get_page_cache(app=None):
+    """Return the app's PageCache, or None if page caching is disabled."""
+    app = app or current_app
+    return app.extensions.get("page_cache")
+
+
+def add_cache_tags(*tags):
+    """Add invalidation tags to the page being rendered."""
+    g.setdefault("page_cache_tags", set()).update(tags)
+
+
+def cached_page(*tags):
+    """Cache the rendered GET response of a view.
+
+    ``tags`` may contain ``{name}`` placeholders filled from the URL variables,
+    e.g. ``cached_page("book:{book_id}")``; views can add more tags while
+    rendering with add_cache_tags(). Responses are neither served from nor
+    stored in the cache when flashed messages are involved, since those are
+    specific to one visitor.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**view_args):
+            cache = get_page_cache()
+            if cache is None or request.method != "GET" or "_flashes" in session:
+                return view(**view_args)
+
+            key = cache_key(request.endpoint, view_args, request.args)
+            page = cache.get(key)
+            if page is not None:
+                response = make_response(page["body"], page["status"])
+                response.mimetype = page["mimetype"]
+                response.headers["X-Cache"] = "HIT"
+                return response
+
+            generation = cache.generation()
+            response = make_response(view(**view_args))
+            if (
+                response.status_code == 200
+                and not session.modified
+                and generation is not None
+            ):
+                page_tags = {tag.format(**view_args) for tag in tags}
+                page_tags |= g.get("page_cache_tags", set())
+                cache.set(
+                    key,
+                    {
+                        "body": response.get_data(as_text=True),
+                        "status": response.status_code,
+                        "mimetype": response.mimetype,
+                    },
+                    sorted(page_tags),
+                    generation,
+                )
+            response.headers["X-Cache"] = "MISS"
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+# --- Invalidation on commit ---
+
+
+def _tags_for_change(obj):
+    """Return the tags of every page that shows ``obj``."""
+    if isinstance(obj, Book):
+        tags = {LISTING_TAG, f"book:{obj.id}", f"author:{obj.author_id}"}
+        # A book moved to another author also leaves the old author's page.
+        history = inspect(obj).attrs.author_id.history
+        tags.update(f"author:{author_id}" for author_id in history.deleted or ())
+        return tags
+    if isinstance(obj, Author):
+        return {LISTING_TAG, f"author:{obj.id}"}
+    return set()
+
+
+def _columns_changed(obj):
+    """Return True if a column shown on pages changed, ignoring relationships
+    such as a book's enrichment bookkeeping."""
+    state = inspect(obj)
+    return any(
+        state.attrs[column.key].history.has_changes()
+        for column in state.mapper.column_attrs
+    )
+
+
+def _collect_changes(session, flush_context, instances):
+    pending = session.info.setdefault("page_cache_tags", set())
+    for obj in session.new | session.deleted:
+        pending |= _tags_for_change(obj)
+    for obj in session.dirty:
+        if _columns_changed(obj):
+            pending |= _tags_for_change(obj)
+
+
+def _collect_new_ids(session, flush_context):
+    # New rows only have an id after the flush.
+    pending = session.info.setdefault("page_cache_tags", set())
+    for obj in session.new:
+        pending |= _tags_for_change(obj)
+
+
+def _invalidate_after_commit(session):
+    tags = session.info.pop("page_cache_tags", None)
+    if not tags:
+        return
+    tags.discard("book:None")
+    tags.discard("author:None")
+    try:
+        cache = get_page_cache()
+    except RuntimeError:
+        # No app context (e.g. a session used outside Flask).
+        return
+    if cache is not None:
+        cache.invalidate(tags)
+
+
+def _discard_after_rollback(session, previous_transaction):
+    session.info.pop("page_cache_tags", None)
+
+
+_listeners_installed = False
+
+
+def _install_listeners():
+    global _listeners_installed
+    if _listeners_installed:
+        return
+    event.listen(Session, "before_flush", _collect_changes)
+    event.listen(Session, "after_flush", _collect_new_ids)
+    event.listen(Session, "after_commit", _invalidate_after_commit)
+    event.listen(Session, "after_soft_rollback", _discard_after_rollback)
+    _listeners_installed = True
+
+
+def invalidate_all():
+    """Drop every cached page; for bulk writes that bypass the ORM."""
+    cache = get_page_cache()
+    if cache is not None:
+        cache.clear()
+
+
+# --- CLI ---
+
+
+@click.command("page-cache-stats")
+@with_appcontext
+def page_cache_stats_command():
+    """Show page cache hit/miss counters and size."""
+    cache = get_page_cache()
+    if cache is None:
+        click.echo("The page cache is disabled.")
+        return
+    if isinstance(cache.backend, MemoryBackend):
+        click.echo("The memory backend only counts the running server process.")
+    for name, value in cache.stats().items():
+        if name == "hit_ratio":
+            value = f"{value:.1%}"
+        click.echo(f"{name:>13}: {value}")
+
+
+@click.command("page-cache-clear")
+@with_appcontext
+def page_cache_clear_command():
+    """Drop every cached page."""
+    invalidate_all()
+    click.echo("Page cache cleared.")
+
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    backend_name = app.config["PAGE_CACHE_BACKEND"]
+    if backend_name == "sqlite":
+        backend = SQLiteBackend(
+            app.config["PAGE_CACHE_PATH"],
+            max_entries=app.config["PAGE_CACHE_MAX_ENTRIES"],
+            ttl=app.config["PAGE_CACHE_TTL"],
+        )
+    elif backend_name == "memory":
+        backend = MemoryBackend(
+            max_entries=app.config["PAGE_CACHE_MAX_ENTRIES"],
+            ttl=app.config["PAGE_CACHE_TTL"],
+        )
+    else:
+        backend = None
+    app.extensions["page_cache"] = PageCache(backend) if backend else None
+    _install_listeners()
+    app.cli.add_command(page_cache_stats_command)
+    app.cli.add_command(page_cache_clear_command)
@@ -0,0 +1,268 @@
+"""Row versions and conditional GET support for the listing and detail pages.
+
+Triggers bump ``version`` and ``updated_at`` on a book whenever it changes,
+on its author whenever the author or any of their books changes, and on the
+single ``library_state`` row whenever any book or author changes. Being
+triggers, they also see bulk inserts and raw SQL.
+
+The pages derive strong ETags and Last-Modified dates from those versions
+with one indexed lookup, so a matching ``If-None-Match`` or
+``If-Modified-Since`` is answered with 304 before the page is queried or
+rendered. Last-Modified only has whole seconds, so it is left out while the
+second of the last change is still current; until then the ETag is the only
+validator.
+"""
+
+import functools
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import sqlalchemy as sa
+from flask import current_app, make_response, request, session
+from werkzeug.http import is_resource_modified
+
+from data_models import db, Author, Book, LibraryState, SQL_NOW
+
+DEFAULT_CONFIG = {
+    "CONDITIONAL_GET_ENABLED": True,
+}
+
+# Columns maintained by the triggers themselves; changing them is not a
+# change to the row.
+VERSION_COLUMNS = ("version", "updated_at")
+
+BUMP_LIBRARY = (
+    f"UPDATE library_state SET version = version + 1, updated_at = {SQL_NOW};"
+)
+
+
+def _bump_author(author_id):
+    return (
+        f"UPDATE authors SET version = version + 1, updated_at = {SQL_NOW} "
+        f"WHERE id = {author_id};"
+    )
+
+
+def _content_columns(table):
+    return ", ".join(
+        column.name for column in table.columns if column.name not in VERSION_COLUMNS
+    )
+
+
+def version_triggers():
+    """Return ``(name, body)`` for every version trigger.
+
+    ``AFTER UPDATE OF`` lists every model column except the version columns,
+    so the triggers' own updates never fire them again.
+    """
+    book_columns = _content_columns(Book.__table__)
+    author_columns = _content_columns(Author.__table__)
+    return [
+        (
+            "book_version_after_insert",
+            f"""AFTER INSERT ON book BEGIN
+                UPDATE book SET updated_at = {SQL_NOW}
+                WHERE id = new.id AND updated_at IS NULL;
+                {_bump_author("new.author_id")}
+                {BUMP_LIBRARY}
+            END""",
+        ),
+        (
+            "book_version_after_update",
+            f"""AFTER UPDATE OF {book_columns} ON book BEGIN
+                UPDATE book SET version = old.version + 1, updated_at = {SQL_NOW}
+                WHERE id = new.id;
+                {_bump_author("old.author_id")}
+                UPDATE authors SET version = version + 1, updated_at = {SQL_NOW}
+                WHERE id = new.author_id AND new.author_id != old.author_id;
+                {BUMP_LIBRARY}
+            END""",
+        ),
+        (
+            "book_version_after_delete",
+            f"""AFTER DELETE ON book BEGIN
+                {_bump_author("old.author_id")}
+                {BUMP_LIBRARY}
+            END""",
+        ),
+        (
+            "author_version_after_insert",
+            f"""AFTER INSERT ON authors BEGIN
+                UPDATE authors SET updated_at = {SQL_NOW}
+                WHERE id = new.id AND updated_at IS NULL;
+                {BUMP_LIBRARY}
+            END""",
+        ),
+        (
+            "author_version_after_update",
+            f"""AFTER UPDATE OF {author_columns} ON authors BEGIN
+                {_bump_author("new.id")}
+                {BUMP_LIBRARY}
+            END""",
+        ),
+        (
+            "author_version_after_delete",
+            f"""AFTER DELETE ON authors BEGIN
+                {BUMP_LIBRARY}
+            END""",
+        ),
+    ]
+
+
+def ensure_version_triggers():
+    """(Re)create the version triggers and the library_state row.
+
+    Triggers are recreated on every start so that their column lists follow
+    the models. Requires an app context and an up-to-date schema.
+    """
+    with db.engine.begin() as conn:
+        for name, body in version_triggers():
+            conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+            conn.exec_driver_sql(f"CREATE TRIGGER {name} {body}")
+        conn.exec_driver_sql(
+            "INSERT OR IGNORE INTO library_state (id, version, updated_at) "
+            f"VALUES (1, 1, {SQL_NOW})"
+        )
+
+
+# --- Version lookups ---
+
+
+def library_version():
+    """Return ``(version, updated_at)`` of the whole library."""
+    row = db.session.execute(
+        sa.select(LibraryState.version, LibraryState.updated_at).where(
+            LibraryState.id == 1
+        )
+    ).first()
+    return (row.version, row.updated_at) if row else (0, None)
+
+
+def book_version(book_id):
+    """Return ``(versions, updated_at)`` for a book page, or None if missing.
+
+    The page also shows the author's name, so the author's version counts.
+    """
+    row = db.session.execute(
+        sa.select(Book.version, Book.updated_at, Author.version, Author.updated_at)
+        .join(Author, Author.id == Book.author_id)
+        .where(Book.id == book_id)
+    ).first()
+    if row is None:
+        return None
+    return [row[0], row[2]], _latest(row[1], row[3])
+
+
+def author_version(author_id):
+    """Return ``(version, updated_at)`` for an author page, or None if missing."""
+    row = db.session.execute(
+        sa.select(Author.version, Author.updated_at).where(Author.id == author_id)
+    ).first()
+    return (row.version, row.updated_at) if row else None
+
+
+def _latest(*dates):
+    dates = [date for date in dates if date is not None]
+    return max(dates) if dates else None
+
+
+def _last_modified(updated_at):
+    """Return the Last-Modified date for ``updated_at``, or None if there is none.
+
+    A change later in the same second would keep the same whole-second date,
+    so there is none until that second is over.
+    """
+    if updated_at is None:
+        return None
+    last_modified = updated_at.replace(microsecond=0)
+    if datetime.utcnow() - last_modified < timedelta(seconds=1):
+        return None
+    return last_modified.replace(tzinfo=timezone.utc)
+
+
+def _release_token(app):
+    """Identify the deployed templates, so that upgrades change every ETag."""
+    newest = 0.0
+    for folder in (app.template_folder, app.static_folder):
+        folder = os.path.join(app.root_path, folder or "")
+        for root, _, files in os.walk(folder):
+            for name in files:
+                newest = max(newest, os.path.getmtime(os.path.join(root, name)))
+    return str(int(newest))
+
+
+def page_etag(version):
+    """Return a strong ETag for the current request's page at ``version``."""
+    args = sorted(
+        (name, value.strip())
+        for name, values in request.args.lists()
+        for value in values
+        if value.strip()
+    )
+    key = json.dumps(
+        [
+            current_app.extensions["row_versions_release"],
+            request.endpoint,
+            sorted(request.view_args.items()),
+            args,
+            version,
+        ],
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+
+def conditional_page(version_fn):
+    """Answer conditional GETs for a view from ``version_fn``.
+
+    ``version_fn`` receives the view's URL variables and returns
+    ``(version, updated_at)``, or None to let the view handle a missing row.
+    Requests that carry flashed messages are always rendered, since the
+    message is not part of the version.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**view_args):
+            if (
+                not current_app.config["CONDITIONAL_GET_ENABLED"]
+                or request.method not in ("GET", "HEAD")
+                or "_flashes" in session
+            ):
+                return view(**view_args)
+
+            current = version_fn(**view_args)
+            if current is None:
+                return view(**view_args)
+            version, updated_at = current
+            etag = page_etag(version)
+            last_modified = _last_modified(updated_at)
+
+            if is_resource_modified(
+                request.environ, etag=etag, last_modified=last_modified
+            ):
+                response = make_response(view(**view_args))
+                if response.status_code != 200 or session.modified:
+                    return response
+            else:
+                response = make_response("", 304)
+            response.set_etag(etag)
+            # Setting None would send the current time.
+            if last_modified is not None:
+                response.last_modified = last_modified
+            # Cacheable, but always revalidated.
+            response.cache_control.no_cache = True
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    app.extensions["row_versions_release"] = _release_token(app)
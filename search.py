@@ -0,0 +1,191 @@
+"""Full-text book search backed by an SQLite FTS5 index.
+
+``book_fts`` indexes each book's title, author name and synopsis under the
+book's id. Triggers on ``book`` and ``authors`` keep it in sync with every
+write, including bulk inserts and raw SQL, and matches are ranked with bm25.
+"""
+
+import re
+
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy.exc import OperationalError
+
+from data_models import db
+
+DEFAULT_CONFIG = {
+    # "fts" uses the FTS5 index when SQLite supports it; "like" always uses
+    # the original substring search.
+    "SEARCH_BACKEND": "fts",
+}
+
+# bm25 column weights: a title match outranks an author match, which
+# outranks a synopsis match.
+BM25_WEIGHTS = (10.0, 5.0, 1.0)
+
+FTS_TABLE_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS book_fts USING fts5(
+    title, author_name, synopsis,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+)
+"""
+
+FTS_TRIGGERS_SQL = (
+    """
+    CREATE TRIGGER IF NOT EXISTS book_fts_after_insert AFTER INSERT ON book
+    BEGIN
+        INSERT INTO book_fts (rowid, title, author_name, synopsis)
+        VALUES (
+            new.id,
+            new.title,
+            (SELECT name FROM authors WHERE id = new.author_id),
+            new.synopsis
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS book_fts_after_delete AFTER DELETE ON book
+    BEGIN
+        DELETE FROM book_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS book_fts_after_update
+    AFTER UPDATE OF title, synopsis, author_id ON book
+    BEGIN
+        DELETE FROM book_fts WHERE rowid = old.id;
+        INSERT INTO book_fts (rowid, title, author_name, synopsis)
+        VALUES (
+            new.id,
+            new.title,
+            (SELECT name FROM authors WHERE id = new.author_id),
+            new.synopsis
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS book_fts_after_author_update
+    AFTER UPDATE OF name ON authors
+    BEGIN
+        UPDATE book_fts SET author_name = new.name
+        WHERE rowid IN (SELECT id FROM book WHERE author_id = new.id);
+    END
+    """,
+)
+
+REBUILD_SQL = (
+    "DELETE FROM book_fts",
+    """
+    INSERT INTO book_fts (rowid, title, author_name, synopsis)
+    SELECT book.id, book.title, authors.name, book.synopsis
+    FROM book JOIN authors ON authors.id = book.author_id
+    """,
+    "INSERT INTO book_fts (book_fts) VALUES ('optimize')",
+)
+
+# Query-side description of the virtual table. It has its own MetaData so
+# db.create_all() never tries to create it as an ordinary table.
+book_fts = sa.Table(
+    "book_fts",
+    sa.MetaData(),
+    sa.Column("rowid", sa.Integer, primary_key=True),
+    sa.Column("title", sa.Text),
+    sa.Column("author_name", sa.Text),
+    sa.Column("synopsis", sa.Text),
+)
+
+
+def ensure_search_index():
+    """Create the FTS table and triggers if needed (requires an app context).
+
+    The index is filled on first creation. Returns False, leaving search on
+    the LIKE fallback, when this SQLite build has no FTS5 support.
+    """
+    available = False
+    try:
+        with db.engine.begin() as conn:
+            exists = conn.execute(
+                sa.text(
+                    "SELECT 1 FROM sqlite_master "
+                    "WHERE type = 'table' AND name = 'book_fts'"
+                )
+            ).first()
+            conn.execute(sa.text(FTS_TABLE_SQL))
+            for statement in FTS_TRIGGERS_SQL:
+                conn.execute(sa.text(statement))
+            if not exists:
+                for statement in REBUILD_SQL:
+                    conn.execute(sa.text(statement))
+        available = True
+    except OperationalError as e:
+        print(f"Full-text search unavailable, falling back to LIKE: {e}")
+    current_app.extensions["book_search_fts"] = available
+    return available
+
+
+def fts_enabled():
+    """Return True if searches should use the FTS index."""
+    return current_app.config["SEARCH_BACKEND"] == "fts" and current_app.extensions.get(
+        "book_search_fts", False
+    )
+
+
+def fts_match_expression(search_query):
+    """Turn free text into an FTS5 MATCH expression, or None if it has no words.
+
+    Every word must match, and the last one is treated as a prefix so results
+    update sensibly while the user is still typing.
+    """
+    words = re.findall(r"\w+", search_query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search_rank_subquery(search_query):
+    """Return a ``(book_id, rank)`` subquery of books matching ``search_query``.
+
+    Lower ranks are better matches. Returns None if the query has no words.
+    """
+    match = fts_match_expression(search_query)
+    if match is None:
+        return None
+    fts = sa.literal_column("book_fts")
+    return (
+        sa.select(
+            book_fts.c.rowid.label("book_id"),
+            sa.func.bm25(fts, *BM25_WEIGHTS).label("rank"),
+        )
+        .where(fts.op("MATCH")(match))
+        .subquery("search_rank")
+    )
+
+
+def rebuild_search_index():
+    """Repopulate the FTS index from the book and authors tables."""
+    with db.engine.begin() as conn:
+        for statement in REBUILD_SQL:
+            conn.execute(sa.text(statement))
+
+
+@click.command("search-rebuild")
+@with_appcontext
+def search_rebuild_command():
+    """Rebuild the full-text search index."""
+    if not ensure_search_index():
+        click.echo("This SQLite build has no FTS5 support; nothing to rebuild.")
+        return
+    rebuild_search_index()
+    count = db.session.execute(sa.text("SELECT count(*) FROM book_fts")).scalar()
+    click.echo(f"Indexed {count} books for full-text search.")
+
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    app.cli.add_command(search_rebuild_command)
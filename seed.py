@@ -2,6 +2,7 @@ import click
 from flask.cli import with_appcontext
 from datetime import datetime
 from data_models import db, Author, Book
+from isbns import normalize_isbn
 
 
 @click.command("seed-db")
@@ -979,8 +980,10 @@ def seed_db_command():
                         if data["publication_date"]
                         else None
                     )
+                    isbn, isbn_valid = normalize_isbn(data["isbn"])
                     book = Book(
-                        isbn=data["isbn"],
+                        isbn=isbn,
+                        isbn_valid=isbn_valid,
                         title=data["title"],
                         publication_date=publication_date_obj,
                         author_id=author_id,
@@ -0,0 +1,217 @@
+"""Single-flight de-duplication of metadata provider lookups.
+
+When several threads or worker processes need the same lookup at the same
+time (the same ISBN, or the same title and author), only one of them asks
+the provider. The others wait for it and share its result.
+
+Within a process, callers wait on the call in flight. Across processes, the
+caller that runs a lookup holds a row in a small SQLite lock table and
+stores the result there when it is done; callers in other processes poll
+that row. A lock whose owner died expires after ``lock_timeout`` seconds and
+is taken over, and a stored result is reused for ``result_ttl`` seconds.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS flights (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    result TEXT,
+    finished_at REAL
+);
+"""
+
+ACQUIRED, FINISHED, BUSY = "acquired", "finished", "busy"
+
+
+class _Call:
+    """A lookup in flight in this process."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one lookup per key at a time, across threads and processes.
+
+    ``path`` is the SQLite lock table file; with None, lookups are only
+    de-duplicated within the process.
+    """
+
+    def __init__(self, path=None, lock_timeout=30, result_ttl=10, poll_interval=0.05):
+        self.path = path
+        self.lock_timeout = lock_timeout
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._schema_ready = False
+        self._counts = dict.fromkeys(("lookups", "shared", "shared_remote"), 0)
+
+    def _connect(self):
+        """Return this thread's connection, opening one if needed."""
+        conn = getattr(self._local, "conn", None)
+        # Connections must not be shared with a forked child process.
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._schema_ready:
+                conn.executescript(SCHEMA)
+                self._schema_ready = True
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def stats(self):
+        """Return how many lookups ran and how many callers shared one."""
+        with self._lock:
+            return dict(self._counts)
+
+    def do(self, key, fn):
+        """Return ``fn()``, sharing one call among concurrent callers of ``key``.
+
+        Results are shared with other processes as JSON, so ``fn`` must return
+        something JSON-serializable (tuples come back as lists). An exception
+        raised by ``fn`` is raised to every caller waiting in this process.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            self._count("shared")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._do_across_processes(key, fn)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def _do_across_processes(self, key, fn):
+        if self.path is None:
+            self._count("lookups")
+            return fn()
+        token = uuid.uuid4().hex
+        try:
+            while True:
+                state, result = self._try_acquire(key, token)
+                if state == FINISHED:
+                    self._count("shared_remote")
+                    return result
+                if state == ACQUIRED:
+                    break
+                time.sleep(self.poll_interval)
+        except sqlite3.Error:
+            # A lock table that cannot be used only costs the de-duplication.
+            token = None
+
+        self._count("lookups")
+        try:
+            result = fn()
+        except BaseException:
+            self._release(key, token)
+            raise
+        self._finish(key, token, result)
+        return result
+
+    def _try_acquire(self, key, token):
+        """Take the lock on ``key`` unless another live owner holds it.
+
+        Returns ``(state, result)``: ACQUIRED, FINISHED with a recent result,
+        or BUSY while another process is still looking it up.
+        """
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            acquired = conn.execute(
+                "INSERT INTO flights (key, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, "
+                "expires_at = excluded.expires_at, result = NULL, finished_at = NULL "
+                "WHERE (finished_at IS NULL AND expires_at <= ?) "
+                "OR finished_at <= ?",
+                (key, token, now + self.lock_timeout, now, now - self.result_ttl),
+            ).rowcount
+            if acquired:
+                return ACQUIRED, None
+            row = conn.execute(
+                "SELECT result, finished_at FROM flights WHERE key = ?", (key,)
+            ).fetchone()
+        if row is not None and row[1] is not None:
+            return FINISHED, json.loads(row[0])
+        return BUSY, None
+
+    def _finish(self, key, token, result):
+        if token is None:
+            return
+        try:
+            value = json.dumps(result)
+        except (TypeError, ValueError):
+            self._release(key, token)
+            return
+        now = time.time()
+        try:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "UPDATE flights SET result = ?, finished_at = ? "
+                    "WHERE key = ? AND owner = ?",
+                    (value, now, key, token),
+                )
+                # Forget stale results and the locks of owners that died.
+                conn.execute(
+                    "DELETE FROM flights "
+                    "WHERE coalesce(finished_at + ?, expires_at) <= ?",
+                    (self.result_ttl, now),
+                )
+        except sqlite3.Error:
+            pass
+
+    def _release(self, key, token):
+        """Drop an unfinished lock, so that waiting processes retry at once."""
+        if token is None:
+            return
+        try:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "DELETE FROM flights WHERE key = ? AND owner = ?", (key, token)
+                )
+        except sqlite3.Error:
+            pass
+
+
+def single_flight_from_config(config):
+    """Build a SingleFlight from app config, or None when it is disabled."""
+    if not config.get("LOOKUP_SINGLE_FLIGHT_ENABLED", True):
+        return None
+    return SingleFlight(
+        config["LOOKUP_LOCK_PATH"],
+        lock_timeout=config["LOOKUP_LOCK_TIMEOUT"],
+        result_ttl=config["LOOKUP_RESULT_TTL"],
+    )
@@ -0,0 +1,260 @@
+"""SQLite connection profile and a multi-process stress test.
+
+Every new database connection gets the pragmas below. WAL lets readers
+carry on while a writer commits, and busy_timeout makes a writer wait for
+the lock instead of failing at once with "database is locked", which
+matters once several worker processes share the file. The remaining
+pragmas size the page cache, memory map and temporary storage.
+
+``init_app`` must run before ``db.init_app``, as it also sets the engine's
+pool options.
+"""
+
+import multiprocessing
+import os
+import queue
+import random
+import sqlite3
+import time
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+
+DEFAULT_CONFIG = {
+    "SQLITE_JOURNAL_MODE": "WAL",
+    # NORMAL is durable in WAL mode except for the last commits before a power
+    # failure; FULL also survives those.
+    "SQLITE_SYNCHRONOUS": "NORMAL",
+    # Milliseconds to wait for a lock before failing with "database is locked".
+    "SQLITE_BUSY_TIMEOUT": 5000,
+    # Negative values are KiB: 64 MiB of page cache per connection.
+    "SQLITE_CACHE_SIZE": -64 * 1024,
+    "SQLITE_MMAP_SIZE": 256 * 1024 * 1024,
+    "SQLITE_TEMP_STORE": "MEMORY",
+    # Connections kept open per process, plus overflow under load.
+    "SQLITE_POOL_SIZE": 10,
+    "SQLITE_MAX_OVERFLOW": 20,
+    "SQLITE_POOL_TIMEOUT": 30,
+}
+
+JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+SYNCHRONOUS_LEVELS = {"OFF", "NORMAL", "FULL", "EXTRA"}
+TEMP_STORES = {"DEFAULT", "FILE", "MEMORY"}
+
+
+def pragmas_from_config(config):
+    """Return the ``(name, value)`` pragmas to run on each new connection."""
+
+    def choice(key, allowed):
+        value = str(config[key]).upper()
+        if value not in allowed:
+            raise ValueError(f"{key} must be one of {', '.join(sorted(allowed))}")
+        return value
+
+    return [
+        ("busy_timeout", int(config["SQLITE_BUSY_TIMEOUT"])),
+        ("journal_mode", choice("SQLITE_JOURNAL_MODE", JOURNAL_MODES)),
+        ("synchronous", choice("SQLITE_SYNCHRONOUS", SYNCHRONOUS_LEVELS)),
+        ("cache_size", int(config["SQLITE_CACHE_SIZE"])),
+        ("mmap_size", int(config["SQLITE_MMAP_SIZE"])),
+        ("temp_store", choice("SQLITE_TEMP_STORE", TEMP_STORES)),
+    ]
+
+
+def engine_options(config):
+    """Return SQLALCHEMY_ENGINE_OPTIONS for the profile."""
+    return {
+        "pool_size": config["SQLITE_POOL_SIZE"],
+        "max_overflow": config["SQLITE_MAX_OVERFLOW"],
+        "pool_timeout": config["SQLITE_POOL_TIMEOUT"],
+        # The driver's own lock timeout, in seconds, matching busy_timeout.
+        "connect_args": {"timeout": config["SQLITE_BUSY_TIMEOUT"] / 1000},
+    }
+
+
+def _pragma_listener(pragmas):
+    def apply_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas:
+                cursor.execute(f"PRAGMA {name} = {value}")
+        finally:
+            cursor.close()
+
+    return apply_pragmas
+
+
+def current_settings(conn):
+    """Return the effective value of each profile pragma on ``conn``."""
+    return {
+        name: conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+        for name, _ in pragmas_from_config(DEFAULT_CONFIG)
+    }
+
+
+@click.command("sqlite-settings")
+@with_appcontext
+def sqlite_settings_command():
+    """Show the pragmas in effect on a pooled database connection."""
+    from data_models import db
+
+    with db.engine.connect() as conn:
+        for name, value in current_settings(conn).items():
+            click.echo(f"{name:>13}: {value}")
+
+
+# --- Stress test ---
+
+
+def _stress_worker(worker, seconds, write_ratio, seed, startup, barrier, results):
+    """Mix page reads and rating writes for ``seconds``; runs in a new process."""
+    # Importing the app updates the schema and triggers; one process at a
+    # time, so that only the timed requests compete for the lock.
+    with startup:
+        from app import app
+        from benchmarks import benchmark_environment, percentile
+        from data_models import db, Book
+
+        with app.app_context():
+            max_id = db.session.query(db.func.max(Book.id)).scalar() or 1
+            db.session.remove()
+
+    app.config["PROPAGATE_EXCEPTIONS"] = True
+    rng = random.Random(seed + worker)
+    counts = {"reads": 0, "writes": 0, "lock_errors": 0, "other_errors": 0}
+    latencies = {"reads": [], "writes": []}
+    with app.app_context(), benchmark_environment(app, use_cache=False):
+        client = app.test_client()
+        barrier.wait()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            book_id = rng.randint(1, max_id)
+            kind = "writes" if rng.random() < write_ratio else "reads"
+            started = time.perf_counter()
+            try:
+                if kind == "writes":
+                    client.post(
+                        f"/book/{book_id}/rate", data={"rating": rng.randint(1, 10)}
+                    )
+                elif rng.random() < 0.5:
+                    client.get(f"/book/{book_id}")
+                else:
+                    client.get(
+                        "/", query_string={"sort": rng.choice(["title", "author"])}
+                    )
+            except OperationalError as e:
+                db.session.rollback()
+                key = "lock_errors" if "locked" in str(e) else "other_errors"
+                counts[key] += 1
+                continue
+            finally:
+                db.session.remove()
+            counts[kind] += 1
+            latencies[kind].append(time.perf_counter() - started)
+
+    for kind, values in latencies.items():
+        counts[f"{kind}_p95_ms"] = percentile(values, 0.95) * 1000 if values else 0.0
+    results.put(counts)
+
+
+@click.command("sqlite-stress")
+@click.option("--processes", default=4, show_default=True, help="Worker processes.")
+@click.option("--seconds", default=10.0, show_default=True, help="Test duration.")
+@click.option(
+    "--write-ratio",
+    default=0.2,
+    show_default=True,
+    help="Fraction of requests that write.",
+)
+@click.option(
+    "--baseline",
+    is_flag=True,
+    help="Run without the profile: rollback journal and no busy timeout.",
+)
+@click.option("--seed", default=0, show_default=True, help="Random seed.")
+@with_appcontext
+def sqlite_stress_command(processes, seconds, write_ratio, baseline, seed):
+    """Hammer the database from several processes and count lock errors.
+
+    Each process sends a mix of page reads and rating writes through the
+    app. Write routes change ratings, so use a scratch database (see
+    bench-generate). Exits with status 1 if any request hit a lock error.
+    """
+    from data_models import db
+
+    if baseline:
+        os.environ["FLASK_SQLITE_JOURNAL_MODE"] = "DELETE"
+        os.environ["FLASK_SQLITE_BUSY_TIMEOUT"] = "0"
+    # Leaving WAL mode needs the database to itself.
+    db.engine.dispose()
+    context = multiprocessing.get_context("spawn")
+    startup = context.Lock()
+    barrier = context.Barrier(processes)
+    results = context.Queue()
+    workers = [
+        context.Process(
+            target=_stress_worker,
+            args=(i, seconds, write_ratio, seed, startup, barrier, results),
+        )
+        for i in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    reports = []
+    while len(reports) < len(workers):
+        try:
+            reports.append(results.get(timeout=1))
+        except queue.Empty:
+            # A worker that died never reports.
+            if not any(worker.is_alive() for worker in workers) and results.empty():
+                break
+    for worker in workers:
+        worker.join()
+    if not reports:
+        raise click.ClickException("Every worker process failed.")
+
+    totals = {
+        key: sum(report[key] for report in reports)
+        for key in ("reads", "writes", "lock_errors", "other_errors")
+    }
+    click.echo(
+        f"{'baseline' if baseline else 'profile'}: {processes} processes, "
+        f"{seconds:.0f}s, {totals['reads']} reads "
+        f"({totals['reads'] / seconds:.0f}/s), {totals['writes']} writes "
+        f"({totals['writes'] / seconds:.0f}/s), {totals['lock_errors']} lock errors, "
+        f"{totals['other_errors']} other errors"
+    )
+    failed = len(workers) - len(reports)
+    if failed:
+        click.echo(f"  {failed} worker processes failed before reporting.")
+    for i, report in enumerate(reports):
+        click.echo(
+            f"  process {i}: p95 read {report['reads_p95_ms']:.1f} ms, "
+            f"p95 write {report['writes_p95_ms']:.1f} ms, "
+            f"{report['lock_errors']} lock errors"
+        )
+    if totals["lock_errors"] or failed:
+        raise click.ClickException(
+            f"{totals['lock_errors']} requests hit a lock, {failed} workers failed."
+        )
+
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    uri = app.config["SQLALCHEMY_DATABASE_URI"]
+    if not uri.startswith("sqlite"):
+        return
+    # In-memory databases use a single-connection pool without these options.
+    if ":memory:" not in uri and uri != "sqlite://":
+        options = engine_options(app.config)
+        options.update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+    event.listen(Engine, "connect", _pragma_listener(pragmas_from_config(app.config)))
+    app.cli.add_command(sqlite_settings_command)
+    app.cli.add_command(sqlite_stress_command)